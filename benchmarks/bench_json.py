@@ -0,0 +1,59 @@
+"""
+Compares the installed JSON backends on the two heaviest JSON steps of a run:
+parsing a real-sized ip-ranges.json and serializing a policy with thousands of prefixes.
+
+    python -m benchmarks.bench_json --scale 1 --repeat 10
+"""
+import argparse
+import statistics
+import time
+
+from benchmarks.synthetic import synthetic_feed
+from restrict_download_region import jsoncodec
+from restrict_download_region.policy import serialize_bucket_policy
+from restrict_download_region.restrict_region import generate_ip_address_policy
+
+
+def timed(run, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--prefixes', type=int, default=4000, help="prefixes in the serialized policy")
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    feed = synthetic_feed(args.scale)
+    document = jsoncodec.BACKENDS['json'].loads(feed)
+    prefixes = ([entry['ip_prefix'] for entry in document['prefixes']] +
+                [entry['ipv6_prefix'] for entry in document['ipv6_prefixes']])[:args.prefixes]
+    policy = {'Version': '2012-10-17', 'Statement': [generate_ip_address_policy('my-bucket', prefixes)]}
+    print("feed of %d bytes, policy with %d prefixes" % (len(feed), len(prefixes)))
+
+    results = {}
+    serialized = set()
+    for name, backend in sorted(jsoncodec.BACKENDS.items()):
+        jsoncodec.backend = backend
+        results[name] = (timed(lambda: jsoncodec.loads(feed.decode('utf-8')), args.repeat),
+                         timed(lambda: serialize_bucket_policy(policy), args.repeat))
+        serialized.add(serialize_bucket_policy(policy))
+    if len(serialized) != 1:
+        raise SystemExit("the backends serialized the policy differently")
+
+    baseline = results['json']
+    for name, (parse, serialize) in sorted(results.items()):
+        print("%-8s parse feed %9.3f ms (%4.1fx)   serialize policy %9.3f ms (%4.1fx)" % (
+            name, parse * 1000, baseline[0] / parse, serialize * 1000, baseline[1] / serialize))
+    if len(results) == 1:
+        print("install orjson to compare against it")
+
+
+if __name__ == '__main__':
+    main()
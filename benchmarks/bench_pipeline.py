@@ -0,0 +1,214 @@
+"""
+Times every stage of the policy generation pipeline (feed parsing, region
+filtering, aggregation, statement generation, policy merging, fitting the
+policy into the size limit and serialization) on synthetic feeds of
+increasing scale, and records the median time and peak traced memory of
+each stage as JSON so runs can be compared.
+
+    python -m benchmarks.bench_pipeline --scales 1,10,100 --output results.json
+    python -m benchmarks.bench_pipeline --scales 1,10 --compare results.json
+"""
+import argparse
+import contextlib
+import copy
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from benchmarks.synthetic import synthetic_feed
+from restrict_download_region import restrict_region
+from restrict_download_region.budget import NONE, POLICY_SIZE_LIMIT, SUPERNET, fit_statement_to_policy
+from restrict_download_region.cidr import aggregate_prefixes
+from restrict_download_region.ip_ranges import read_ip_prefixes_for_region
+from restrict_download_region.restrict_region import IP_RANGES_CHUNK_SIZE, generate_ip_address_policy, \
+    ip_prefixes_for_region, process_ip_restrict_policy, update_bucket_policy
+
+RESULTS_FORMAT_VERSION = 1
+BUCKET_NAME = 'benchmark-bucket'
+
+# a stage is set up outside of the measurement and returns the callable that is measured
+Stage = Tuple[str, Callable[[], Callable[[], object]]]
+
+
+class Regression(NamedTuple):
+    stage: str
+    scale: float
+    metric: str
+    baseline: float
+    current: float
+
+
+class _PolicyWriter:
+    """
+    Stands in for the S3 client, update_bucket_policy only serializes the policy
+    """
+
+    def put_bucket_policy(self, Bucket: str, Policy: str):
+        self.policy = Policy
+
+    def delete_bucket_policy(self, Bucket: str):
+        self.policy = None
+
+
+def pipeline_stages(feed: bytes, region: str) -> List[Stage]:
+    document = json.loads(feed)
+    prefixes = ip_prefixes_for_region(document['prefixes'], 'ip_prefix', region) + \
+        ip_prefixes_for_region(document['ipv6_prefixes'], 'ipv6_prefix', region)
+    aggregated = aggregate_prefixes(prefixes)
+    # an existing policy with unrelated statements and an outdated ip restriction
+    existing_policy = {
+        'Version': '2012-10-17',
+        'Statement': [{
+            'Sid': 'AllowAccount%d' % index,
+            'Effect': 'Allow',
+            'Principal': {'AWS': 'arn:aws:iam::%012d:root' % index},
+            'Action': 's3:GetObject',
+            'Resource': 'arn:aws:s3:::%s/*' % BUCKET_NAME
+        } for index in range(5)] + [generate_ip_address_policy(BUCKET_NAME, aggregated[1:])]
+    }
+    updated_policy = copy.deepcopy(existing_policy)
+    with _without_budget():
+        process_ip_restrict_policy(BUCKET_NAME, 'Update', updated_policy, aggregated)
+    chunks = [feed[i:i + IP_RANGES_CHUNK_SIZE] for i in range(0, len(feed), IP_RANGES_CHUNK_SIZE)]
+
+    return [
+        ('parse_full', lambda: lambda: json.loads(feed)),
+        ('parse_streaming', lambda: lambda: read_ip_prefixes_for_region(iter(chunks), region)),
+        ('ip_prefixes_for_region', lambda: lambda: (
+            ip_prefixes_for_region(document['prefixes'], 'ip_prefix', region) +
+            ip_prefixes_for_region(document['ipv6_prefixes'], 'ipv6_prefix', region))),
+        ('aggregate_prefixes', lambda: lambda: aggregate_prefixes(prefixes)),
+        ('generate_ip_address_policy', lambda: lambda: generate_ip_address_policy(BUCKET_NAME, aggregated)),
+        ('merge_changed_policy', lambda: _merge(existing_policy, aggregated)),
+        ('merge_unchanged_policy', lambda: _merge(updated_policy, aggregated)),
+        ('fit_policy_budget', lambda: _fit(existing_policy, aggregated)),
+        ('serialize_policy', lambda: lambda: update_bucket_policy(_PolicyWriter(), BUCKET_NAME, updated_policy)),
+    ]
+
+
+@contextlib.contextmanager
+def _without_budget():
+    # the policies of larger feeds exceed the size limit, fitting them is timed as a stage of its own
+    strategy = restrict_region.POLICY_BUDGET_STRATEGY
+    restrict_region.POLICY_BUDGET_STRATEGY = NONE
+    try:
+        yield
+    finally:
+        restrict_region.POLICY_BUDGET_STRATEGY = strategy
+
+
+def _merge(policy: dict, prefixes: List[str]) -> Callable[[], bool]:
+    # process_ip_restrict_policy modifies the policy, every run gets its own copy
+    policy = copy.deepcopy(policy)
+
+    def run() -> bool:
+        with _without_budget():
+            return process_ip_restrict_policy(BUCKET_NAME, 'Update', policy, prefixes)
+    return run
+
+
+def _fit(policy: dict, prefixes: List[str]) -> Callable[[], object]:
+    # fit_statement_to_policy shrinks the prefixes in place, every run gets its own statement.
+    # The address space may be widened without bound so that every scale fits.
+    statement = generate_ip_address_policy(BUCKET_NAME, prefixes)
+    policy = dict(policy, Statement=policy['Statement'][:-1] + [statement])
+    return lambda: fit_statement_to_policy(policy, statement['Condition']['NotIpAddress']['aws:SourceIp'],
+                                           POLICY_SIZE_LIMIT, SUPERNET, max_ratio=float('inf'))
+
+
+def measure(setup: Callable[[], Callable[[], object]], repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        run = setup()
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+
+    # tracing slows python down, so memory is measured in a separate run
+    run = setup()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds_median': statistics.median(timings),
+        'seconds_min': min(timings),
+        'peak_bytes': peak
+    }
+
+
+def run_suite(scales: List[float], region: str = 'us-east-1', repeat: int = 5) -> dict:
+    results = []
+    for scale in scales:
+        feed = synthetic_feed(scale)
+        for stage, setup in pipeline_stages(feed, region):
+            result = {'stage': stage, 'scale': scale, 'feed_bytes': len(feed), 'repeat': repeat}
+            result.update(measure(setup, repeat))
+            results.append(result)
+    return {
+        'version': RESULTS_FORMAT_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'region': region,
+        'results': results
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[Regression]:
+    """
+    Stages, at scales present in both runs, whose median time or peak memory grew
+    by more than the threshold (0.2 is 20%)
+    """
+    if baseline.get('version') != current.get('version'):
+        raise ValueError("cannot compare results format version %s with %s" % (
+            baseline.get('version'), current.get('version')))
+    baseline_results = {(result['stage'], result['scale']): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        previous = baseline_results.get((result['stage'], result['scale']))
+        if previous is None:
+            continue
+        for metric in ('seconds_median', 'peak_bytes'):
+            if result[metric] > previous[metric] * (1 + threshold):
+                regressions.append(Regression(result['stage'], result['scale'], metric,
+                                              previous[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1,10,100',
+                        help="comma separated feed scales, 1 is roughly the size of the real feed")
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="results JSON of a previous run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative growth reported as a regression (default 0.2)")
+    args = parser.parse_args()
+
+    current = run_suite([float(scale) for scale in args.scales.split(',')], args.region, args.repeat)
+    for result in current['results']:
+        print("%-28s x%-6g median %9.4fs  min %9.4fs  peak %9.1f MiB" % (
+            result['stage'], result['scale'], result['seconds_median'], result['seconds_min'],
+            result['peak_bytes'] / 1024 / 1024))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(current, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION %s x%g %s: %g -> %g" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
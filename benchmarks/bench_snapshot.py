@@ -0,0 +1,68 @@
+"""
+Compares cold loads of a prefix set from a binary snapshot against parsing the same
+prefixes from a JSON artifact and from the whole feed, on a synthetic feed.
+
+    python -m benchmarks.bench_snapshot --scale 10
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_feed
+from restrict_download_region.cidr import aggregate_prefixes, fingerprint_prefixes
+from restrict_download_region.publisher import RegionArtifact
+from restrict_download_region.restrict_region import ip_prefixes_for_region
+from restrict_download_region.snapshot import load_snapshot, pack_snapshot
+
+
+def timed(load, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        load()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=10)
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    feed = synthetic_feed(args.scale)
+    document = json.loads(feed)
+    # every service, so the set is as large as the feed allows for one region
+    prefixes = aggregate_prefixes([entry['ip_prefix'] for entry in document['prefixes']
+                                   if entry['region'] == args.region] +
+                                  [entry['ipv6_prefix'] for entry in document['ipv6_prefixes']
+                                   if entry['region'] == args.region])
+    artifact = RegionArtifact(args.region, 'AMAZON', document['syncToken'], fingerprint_prefixes(prefixes), prefixes)
+    artifact_json = artifact.to_json()
+    snapshot = pack_snapshot(prefixes, document['syncToken'])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'prefixes.snapshot')
+        with open(path, 'wb') as f:
+            f.write(snapshot)
+
+        results = [
+            ('feed json', len(feed), timed(lambda: ip_prefixes_for_region(
+                json.loads(feed)['prefixes'], 'ip_prefix', args.region), args.repeat)),
+            ('artifact json', len(artifact_json), timed(lambda: RegionArtifact.from_json(artifact_json),
+                                                        args.repeat)),
+            ('snapshot mmap', len(snapshot), timed(lambda: load_snapshot(path), args.repeat)),
+            ('snapshot mmap + strings', len(snapshot), timed(lambda: load_snapshot(path).prefixes(), args.repeat)),
+        ]
+
+    print("%d prefixes of %s" % (len(prefixes), args.region))
+    for name, size, seconds in results:
+        print("%-24s %10d bytes  median %9.3f ms" % (name, size, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Measures cold start: the time to import restrict_region and the latency of the
+first invocation in a fresh interpreter, with the S3 API stubbed and ip-ranges.json
+served from memory. Each sample runs in its own subprocess.
+
+    python -m benchmarks.bench_startup --samples 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SAMPLE = r'''
+import json, sys, time
+started = time.perf_counter()
+import restrict_download_region.restrict_region as restrict_region
+imported = time.perf_counter()
+boto3_imported = 'boto3' in sys.modules
+
+from unittest import mock
+from benchmarks.synthetic import synthetic_feed
+
+feed = synthetic_feed(scale=1)
+response = mock.Mock(status=200, data=feed, headers={})
+response.stream.return_value = iter([feed])
+restrict_region.http = mock.Mock()
+restrict_region.http.request.return_value = response
+
+
+def stubbed_client(service_name, **kwargs):
+    import boto3
+    from botocore.stub import Stubber
+    client = boto3.session.Session().client(service_name, **kwargs)
+    stubber = Stubber(client)
+    stubber.add_client_error('get_bucket_policy', 'NoSuchBucketPolicy')
+    stubber.add_response('put_bucket_policy', {})
+    stubber.activate()
+    return client
+
+
+with mock.patch('boto3.client', stubbed_client):
+    invoke_started = time.perf_counter()
+    restrict_region.handler({}, None)
+    invoked = time.perf_counter()
+
+print(json.dumps({
+    'import_seconds': imported - started,
+    'first_invocation_seconds': invoked - invoke_started,
+    'boto3_imported_by_module_import': boto3_imported,
+}))
+'''
+
+
+def run_sample(environment: dict) -> dict:
+    output = subprocess.run([sys.executable, '-c', SAMPLE], env=environment, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=5)
+    args = parser.parse_args()
+
+    environment = dict(os.environ,
+                       AWS_REGION='us-east-1',
+                       AWS_DEFAULT_REGION='us-east-1',
+                       AWS_ACCESS_KEY_ID='benchmark',
+                       AWS_SECRET_ACCESS_KEY='benchmark',
+                       BUCKET_NAME='benchmark-bucket',
+                       IP_RANGES_CACHE_DIR='',
+                       PYTHONPATH=os.getcwd())
+    samples = [run_sample(environment) for _ in range(args.samples)]
+
+    for key in ('import_seconds', 'first_invocation_seconds'):
+        values = [sample[key] for sample in samples]
+        print("%-26s median %.3fs  min %.3fs  max %.3fs" % (
+            key, statistics.median(values), min(values), max(values)))
+    print("boto3 imported by module import: %s" % samples[0]['boto3_imported_by_module_import'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares loading ip-ranges.json in full against the streaming, filter-while-parsing
+reader on a synthetic feed.
+
+    python -m benchmarks.bench_streaming --scale 10
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from benchmarks.synthetic import synthetic_feed_chunks
+from restrict_download_region.ip_ranges import stream_ip_prefixes_for_region
+from restrict_download_region.restrict_region import IP_RANGES_CHUNK_SIZE, ip_prefixes_for_region
+
+
+def full_load(chunks, region):
+    first_prefix_at = None
+    started = time.perf_counter()
+    # equivalent of urllib3 preloading resp.data
+    all_ip_prefixes = json.loads(b''.join(chunks).decode('utf-8'))
+    prefixes = ip_prefixes_for_region(all_ip_prefixes['prefixes'], 'ip_prefix', region) + \
+        ip_prefixes_for_region(all_ip_prefixes['ipv6_prefixes'], 'ipv6_prefix', region)
+    first_prefix_at = time.perf_counter() - started
+    return prefixes, first_prefix_at
+
+
+def streaming_load(chunks, region):
+    first_prefix_at = None
+    started = time.perf_counter()
+    prefixes = []
+    for prefix in stream_ip_prefixes_for_region(iter(chunks), region):
+        if first_prefix_at is None:
+            first_prefix_at = time.perf_counter() - started
+        prefixes.append(prefix)
+    return prefixes, first_prefix_at
+
+
+def measure(load, chunks, region) -> dict:
+    tracemalloc.start()
+    started = time.perf_counter()
+    prefixes, first_prefix_at = load(chunks, region)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'prefixes': prefixes,
+        'seconds': elapsed,
+        'first_prefix_seconds': first_prefix_at,
+        'peak_bytes': peak
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=10)
+    parser.add_argument('--region', default='us-east-1')
+    args = parser.parse_args()
+
+    chunks = list(synthetic_feed_chunks(args.scale, IP_RANGES_CHUNK_SIZE))
+    print("feed size: %d bytes in %d chunks" % (sum(len(chunk) for chunk in chunks), len(chunks)))
+
+    full = measure(full_load, chunks, args.region)
+    streaming = measure(streaming_load, chunks, args.region)
+    assert full['prefixes'] == streaming['prefixes'], "streaming reader returned different prefixes"
+
+    for name, result in (('full', full), ('streaming', streaming)):
+        print("%-10s total %.3fs  first prefix %.3fs  peak %.1f MiB" % (
+            name, result['seconds'], result['first_prefix_seconds'], result['peak_bytes'] / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Deterministic synthetic ip-ranges.json feeds for benchmarks and tests.
+A scale of 1 is roughly the size of the real feed (~10k entries, ~1.3 MB).
+"""
+import ipaddress
+import json
+import random
+from typing import Iterator
+
+REGIONS = ['af-south-1', 'ap-east-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3',
+           'ap-south-1', 'ap-southeast-1', 'ap-southeast-2', 'ca-central-1', 'eu-central-1',
+           'eu-north-1', 'eu-south-1', 'eu-west-1', 'eu-west-2', 'eu-west-3', 'me-south-1',
+           'sa-east-1', 'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'GLOBAL']
+SERVICES = ['AMAZON', 'AMAZON', 'AMAZON', 'EC2', 'S3', 'CLOUDFRONT', 'ROUTE53_HEALTHCHECKS', 'DYNAMODB']
+
+IPV4_ENTRIES_PER_SCALE = 8000
+IPV6_ENTRIES_PER_SCALE = 2000
+SYNC_TOKEN = '1613483053'
+
+
+def _entries(rand: random.Random, count: int, version: int) -> Iterator[dict]:
+    for _ in range(count):
+        region = rand.choice(REGIONS)
+        service = rand.choice(SERVICES)
+        if version == 4:
+            prefix_length = rand.randint(16, 32)
+            network = rand.getrandbits(32) >> (32 - prefix_length) << (32 - prefix_length)
+            yield {
+                'ip_prefix': '%d.%d.%d.%d/%d' % (network >> 24, network >> 16 & 255, network >> 8 & 255,
+                                                 network & 255, prefix_length),
+                'region': region,
+                'service': service,
+                'network_border_group': region
+            }
+        else:
+            prefix_length = rand.randint(36, 64)
+            network = (0x2600 << 112 | rand.getrandbits(48) << 64) >> (128 - prefix_length) << (128 - prefix_length)
+            yield {
+                'ipv6_prefix': '%s/%d' % (ipaddress.IPv6Address(network), prefix_length),
+                'region': region,
+                'service': service,
+                'network_border_group': region
+            }
+
+
+def synthetic_feed_chunks(scale: float = 1, chunk_size: int = 64 * 1024, seed: int = 0) -> Iterator[bytes]:
+    """
+    Lazily generates the utf-8 encoded feed in chunks of roughly chunk_size bytes,
+    so the whole document never has to exist in memory at once
+    """
+    rand = random.Random(seed)
+    pending = []
+    pending_size = 0
+
+    def pieces():
+        yield '{\n  "syncToken": "%s",\n  "createDate": "2021-02-16-13-44-13",\n' % SYNC_TOKEN
+        for key, count, version in (('prefixes', int(IPV4_ENTRIES_PER_SCALE * scale), 4),
+                                    ('ipv6_prefixes', int(IPV6_ENTRIES_PER_SCALE * scale), 6)):
+            yield '  "%s": [' % key
+            for index, entry in enumerate(_entries(rand, count, version)):
+                yield (',\n    ' if index else '\n    ') + json.dumps(entry)
+            yield '\n  ]' + (',\n' if key == 'prefixes' else '\n')
+        yield '}\n'
+
+    for piece in pieces():
+        pending.append(piece)
+        pending_size += len(piece)
+        if pending_size >= chunk_size:
+            yield ''.join(pending).encode('utf-8')
+            pending = []
+            pending_size = 0
+    if pending:
+        yield ''.join(pending).encode('utf-8')
+
+
+def synthetic_feed(scale: float = 1, seed: int = 0) -> bytes:
+    return b''.join(synthetic_feed_chunks(scale, seed=seed))
@@ -0,0 +1,5 @@
+import sys
+
+from restrict_download_region.render import main
+
+sys.exit(main())
@@ -0,0 +1,166 @@
+"""
+Classifies the requests in S3 server access logs by the region owning their remote ip
+and checks them against the ip restriction policy generated for the bucket's region.
+
+    python -m restrict_download_region.access_logs --ip-ranges ip-ranges.json \\
+        --region us-east-1 access-logs/* > summary.json
+
+Lines are streamed from the files (or stdin) one at a time, with --violations every
+request the policy should have decided differently is written as a JSON line to stderr.
+"""
+import argparse
+import ipaddress
+import json
+import re
+import sys
+from collections import Counter
+from typing import Dict, Iterable, NamedTuple, Optional, TextIO
+
+from restrict_download_region.cidr import aggregate_prefixes
+from restrict_download_region.ip_ranges import RegionIndex, iter_ip_ranges
+from restrict_download_region.lookup import IpRangeLookup
+from restrict_download_region.restrict_region import generate_ip_address_policy
+
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/LogFormat.html
+# bucket owner, bucket, [time], remote ip, requester, request id, operation, key, "request uri", http status
+LOG_LINE = re.compile(r'\S+ (\S+) \[[^\]]*\] (\S+) \S+ \S+ (\S+) \S+ "(?:[^"\\]|\\.)*" (\d{3}|-)')
+GET_OBJECT = 'REST.GET.OBJECT'
+
+IN_REGION = 'in-region'
+OTHER_REGION = 'other-region'
+EXTERNAL = 'external'
+# requests through a VPC endpoint are logged with the private address of the client
+PRIVATE = 'private'
+INVALID = 'invalid'
+
+
+class Request(NamedTuple):
+    bucket: str
+    remote_ip: str
+    operation: str
+    status: Optional[int]
+
+
+def parse_log_line(line: str) -> Optional[Request]:
+    match = LOG_LINE.match(line)
+    if not match:
+        return None
+    bucket, remote_ip, operation, status = match.groups()
+    return Request(bucket, remote_ip, operation, int(status) if status != '-' else None)
+
+
+class AccessLogClassifier:
+    """
+    Counts requests per classification of their remote ip and compares the outcome of
+    every object download with what the generated policy is meant to decide
+    """
+
+    def __init__(self, feed_lookup: IpRangeLookup, region: str, allowed: IpRangeLookup):
+        self.feed_lookup = feed_lookup
+        self.region = region
+        self.allowed = allowed
+        self.classifications = Counter()
+        self.regions = Counter()
+        self.decisions = Counter()
+        self.lines = 0
+        self.unparsable = 0
+
+    @classmethod
+    def for_region(cls, feed_lookup: IpRangeLookup, region_prefixes: Iterable[str], region: str,
+                   bucket_name: str = 'bucket') -> 'AccessLogClassifier':
+        """
+        The addresses allowed to download are taken from the statement generate_ip_address_policy
+        produces for the region's prefixes, the statement the buckets actually carry
+        """
+        statement = generate_ip_address_policy(bucket_name, aggregate_prefixes(list(region_prefixes)))
+        source_ips = statement['Condition']['NotIpAddress']['aws:SourceIp']
+        return cls(feed_lookup, region, IpRangeLookup.from_prefixes(source_ips, region))
+
+    def classify(self, remote_ip: str) -> str:
+        try:
+            owner_region = self.feed_lookup.region(remote_ip)
+        except ValueError:
+            return INVALID
+        if owner_region == self.region:
+            return IN_REGION
+        if owner_region is not None:
+            self.regions[owner_region] += 1
+            return OTHER_REGION
+        if ipaddress.ip_address(remote_ip).is_private:
+            return PRIVATE
+        return EXTERNAL
+
+    def add(self, line: str) -> Optional[dict]:
+        """
+        Returns the details of a download the policy should have decided differently
+        """
+        self.lines += 1
+        request = parse_log_line(line)
+        if request is None:
+            self.unparsable += 1
+            return None
+        classification = self.classify(request.remote_ip)
+        self.classifications[classification] += 1
+        if request.operation != GET_OBJECT or request.status is None or classification == INVALID:
+            return None
+
+        # the policy denies downloads from outside the region, unless they come through a vpc endpoint
+        expected_allowed = classification == PRIVATE or request.remote_ip in self.allowed
+        denied = request.status == 403
+        if expected_allowed and denied:
+            decision = 'denied-in-region'
+        elif not expected_allowed and 200 <= request.status < 300:
+            decision = 'allowed-out-of-region'
+        else:
+            self.decisions['as-intended'] += 1
+            return None
+        self.decisions[decision] += 1
+        return {'decision': decision, 'classification': classification, 'bucket': request.bucket,
+                'remote_ip': request.remote_ip, 'status': request.status}
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            'region': self.region,
+            'lines': self.lines,
+            'unparsable': self.unparsable,
+            'classifications': dict(self.classifications),
+            'other_regions': dict(self.regions),
+            'downloads': dict(self.decisions)
+        }
+
+
+def classify_lines(classifier: AccessLogClassifier, lines: Iterable[str], violations: Optional[TextIO] = None):
+    for line in lines:
+        violation = classifier.add(line)
+        if violation and violations:
+            violations.write(json.dumps(violation) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ip-ranges', required=True, help="path of a downloaded ip-ranges.json")
+    parser.add_argument('--region', required=True, help="region of the logged buckets")
+    parser.add_argument('--violations', action='store_true',
+                        help="write every download the policy should have decided differently to stderr")
+    parser.add_argument('logs', nargs='*', help="access log files, stdin when there are none")
+    args = parser.parse_args(argv)
+
+    with open(args.ip_ranges, 'rb') as f:
+        items = list(iter_ip_ranges(iter(lambda: f.read(64 * 1024), b'')))
+    classifier = AccessLogClassifier.for_region(IpRangeLookup.from_ip_ranges(items),
+                                                RegionIndex.from_ip_ranges(items).prefixes(args.region),
+                                                args.region)
+
+    violations = sys.stderr if args.violations else None
+    if not args.logs:
+        classify_lines(classifier, sys.stdin, violations)
+    for path in args.logs:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            classify_lines(classifier, f, violations)
+
+    json.dump(classifier.summary(), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import heapq
+import ipaddress
+import json
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from restrict_download_region.policy import serialize_bucket_policy
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/BucketRestrictions.html
+POLICY_SIZE_LIMIT = 20 * 1024
+
+# merge neighbouring networks into their common supernet, allowing a few more addresses
+SUPERNET = 'supernet'
+# leave out the networks covering the fewest addresses, denying them
+DROP = 'drop'
+# leave oversized policies to be rejected by S3
+NONE = 'none'
+STRATEGIES = (SUPERNET, DROP, NONE)
+
+
+class PolicyBudgetError(ValueError):
+    """
+    Raised when the prefixes can't be made to fit without changing more address space than allowed
+    """
+
+
+class BudgetReport(NamedTuple):
+    strategy: str
+    size: int
+    limit: int
+    original_prefix_count: int
+    prefix_count: int
+    # ip version -> number of addresses allowed by the fitted prefixes but not by the original ones
+    widened_addresses: Dict[int, int]
+    # ip version -> number of addresses allowed by the original prefixes but not by the fitted ones
+    dropped_addresses: Dict[int, int]
+
+    @property
+    def changed(self) -> bool:
+        return self.prefix_count != self.original_prefix_count or \
+            any(self.widened_addresses.values()) or any(self.dropped_addresses.values())
+
+
+def policy_size(bucket_policy: dict) -> int:
+    return len(serialize_bucket_policy(bucket_policy).encode('utf-8'))
+
+
+def fit_statement_to_policy(bucket_policy: dict, source_ips: List[str],
+                            limit: int = POLICY_SIZE_LIMIT,
+                            strategy: str = SUPERNET,
+                            max_ratio: float = 0.1) -> BudgetReport:
+    """
+    Shrinks source_ips, the list of prefixes of a statement contained in bucket_policy,
+    in place until the serialized policy is no larger than limit.
+    max_ratio bounds the share of each ip version's address space that may be widened
+    or dropped. Policies already within the limit cost a single serialization.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("unknown policy budget strategy %s, expected one of %s" % (strategy, ", ".join(STRATEGIES)))
+
+    size = policy_size(bucket_policy)
+    if size <= limit or strategy == NONE:
+        return BudgetReport(strategy, size, limit, len(source_ips), len(source_ips), {}, {})
+
+    # everything but the prefix list counts against the budget as it is
+    budget = limit - (size - _list_size(source_ips))
+    fitted, widened, dropped = fit_prefixes(source_ips, budget, strategy, max_ratio)
+    original_prefix_count = len(source_ips)
+    source_ips[:] = fitted
+
+    size = policy_size(bucket_policy)
+    if size > limit:
+        raise PolicyBudgetError("policy is %d bytes after fitting, over the limit of %d bytes" % (size, limit))
+    report = BudgetReport(strategy, size, limit, original_prefix_count, len(fitted), widened, dropped)
+    log.warning("fitted %d prefixes into %d prefixes to keep the policy at %d of %d bytes, "
+                "widened %s and dropped %s addresses per ip version",
+                original_prefix_count, len(fitted), size, limit, widened, dropped)
+    return report
+
+
+def fit_prefixes(prefixes: List[str], budget: int, strategy: str,
+                 max_ratio: float) -> Tuple[List[str], Dict[int, int], Dict[int, int]]:
+    """
+    Returns the prefixes, IPv4 before IPv6, shrunk so that their serialized list takes
+    no more than budget bytes, with the widened and dropped address counts per ip version
+    """
+    networks = ipaddress.collapse_addresses([network for network in map(_network, prefixes) if network.version == 4]), \
+        ipaddress.collapse_addresses([network for network in map(_network, prefixes) if network.version == 6])
+    families = [_Family(version, list(family)) for version, family in zip((4, 6), networks)]
+    size = _list_size([str(network) for family in families for network in family.networks])
+
+    if strategy == SUPERNET:
+        _supernet(families, size, budget, max_ratio)
+    elif strategy == DROP:
+        _drop(families, size, budget, max_ratio)
+
+    fitted = [str(network) for family in families for network in family.result()]
+    return fitted, {family.version: family.widened for family in families}, \
+        {family.version: family.dropped for family in families}
+
+
+def _network(prefix: str):
+    return ipaddress.ip_network(prefix, strict=False)
+
+
+def _list_size(prefixes: List[str]) -> int:
+    return len(json.dumps(prefixes, separators=(',', ':')).encode('utf-8'))
+
+
+def _entry_size(prefix: str) -> int:
+    # quotes plus the comma separating it from its neighbour
+    return len(prefix) + 3
+
+
+class _Node:
+    __slots__ = ('start', 'end', 'prev', 'next', 'alive')
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.prev: Optional['_Node'] = None
+        self.next: Optional['_Node'] = None
+        self.alive = True
+
+
+class _Family:
+    """
+    The disjoint networks of one ip version in address order, as a linked list of
+    integer ranges that merges keep sorted and disjoint
+    """
+
+    def __init__(self, version: int, networks: list):
+        self.version = version
+        self.bits = 32 if version == 4 else 128
+        self.networks = networks
+        self.address_space = sum(network.num_addresses for network in networks)
+        self.widened = 0
+        self.dropped = 0
+        self.nodes = [_Node(int(network.network_address), int(network.broadcast_address)) for network in networks]
+        for left, right in zip(self.nodes, self.nodes[1:]):
+            left.next = right
+            right.prev = left
+
+    def supernet(self, left: _Node, right: _Node) -> Tuple[int, int]:
+        host_bits = (left.start ^ right.end).bit_length()
+        start = left.start >> host_bits << host_bits
+        return start, start + (1 << host_bits) - 1
+
+    def absorbed(self, left: _Node, right: _Node) -> Tuple[int, int, List[_Node]]:
+        """
+        Supernet of two neighbours and every node it covers
+        """
+        start, end = self.supernet(left, right)
+        nodes = [left]
+        node = left.prev
+        while node and node.start >= start:
+            nodes.insert(0, node)
+            node = node.prev
+        node = left.next
+        while node and node.end <= end:
+            nodes.append(node)
+            node = node.next
+        return start, end, nodes
+
+    def merge_cost(self, left: _Node, right: _Node) -> Tuple[int, float]:
+        start, end, nodes = self.absorbed(left, right)
+        widened = end - start + 1 - sum(node.end - node.start + 1 for node in nodes)
+        return widened, widened / self.address_space
+
+    def prefix(self, start: int, end: int) -> str:
+        return str(ipaddress.ip_network((start, self.bits - (end - start + 1).bit_length() + 1)))
+
+    def result(self) -> list:
+        return [ipaddress.ip_network((node.start, self.bits - (node.end - node.start + 1).bit_length() + 1))
+                for node in self.nodes if node.alive]
+
+
+def _supernet(families: List[_Family], size: int, budget: int, max_ratio: float):
+    """
+    Greedily merges the pair of neighbouring networks whose supernet adds the smallest
+    share of its ip version's address space, until the list fits
+    """
+    heap = []
+    sequence = 0
+    for family in families:
+        for node in family.nodes[:-1]:
+            heap.append((family.merge_cost(node, node.next)[1], sequence, family, node, node.next))
+            sequence += 1
+    heapq.heapify(heap)
+
+    while size > budget:
+        if not heap:
+            raise PolicyBudgetError("no networks left to merge, the prefixes can't fit in %d bytes" % budget)
+        ratio, _, family, left, right = heapq.heappop(heap)
+        if not (left.alive and right.alive and left.next is right):
+            continue
+        # merges elsewhere may have changed what this supernet would cover
+        widened, current_ratio = family.merge_cost(left, right)
+        if current_ratio != ratio:
+            heapq.heappush(heap, (current_ratio, sequence, family, left, right))
+            sequence += 1
+            continue
+        if (family.widened + widened) / family.address_space > max_ratio:
+            raise PolicyBudgetError(
+                "fitting the prefixes in %d bytes widens IPv%d address space by more than %g" % (
+                    budget, family.version, max_ratio))
+
+        start, end, nodes = family.absorbed(left, right)
+        merged = nodes[0]
+        for node in nodes:
+            size -= _entry_size(family.prefix(node.start, node.end))
+        for node in nodes[1:]:
+            node.alive = False
+        merged.start, merged.end, merged.next = start, end, nodes[-1].next
+        if merged.next:
+            merged.next.prev = merged
+        size += _entry_size(family.prefix(start, end))
+        family.widened += widened
+
+        for pair in ((merged.prev, merged), (merged, merged.next)):
+            if pair[0] and pair[1]:
+                heapq.heappush(heap, (family.merge_cost(*pair)[1], sequence, family) + pair)
+                sequence += 1
+
+
+def _drop(families: List[_Family], size: int, budget: int, max_ratio: float):
+    """
+    Leaves out the networks covering the fewest addresses first, until the list fits
+    """
+    candidates = sorted(((node.end - node.start + 1, family.version, node.start, family, node)
+                         for family in families for node in family.nodes), key=lambda candidate: candidate[:3])
+    remaining = len(candidates)
+    for addresses, _, _, family, node in candidates:
+        if size <= budget:
+            return
+        # S3 rejects an empty aws:SourceIp list
+        if remaining == 1:
+            break
+        if (family.dropped + addresses) / family.address_space > max_ratio:
+            continue
+        node.alive = False
+        family.dropped += addresses
+        size -= _entry_size(family.prefix(node.start, node.end))
+        remaining -= 1
+    if size > budget:
+        raise PolicyBudgetError("the prefixes can't fit in %d bytes without dropping more than %g "
+                                "of an ip version's address space" % (budget, max_ratio))
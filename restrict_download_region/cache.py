@@ -0,0 +1,192 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# entries are stored gzip compressed, uncompressed files of earlier versions are removed
+CACHE_FILE_SUFFIX = '.json.gz'
+UNCOMPRESSED_CACHE_FILE_SUFFIX = '.json'
+TEMPORARY_FILE_SUFFIX = '.tmp'
+# seconds after which a temporary file is assumed to belong to a writer that crashed
+ABANDONED_TEMPORARY_FILE_AGE = 60
+
+
+class CacheEntry(NamedTuple):
+    region: str
+    sync_token: str
+    prefixes: List[str]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    stored_at: float = 0.0
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """
+        Request headers that let ip-ranges.amazonaws.com answer 304 Not Modified
+        when the feed has not changed since this entry was stored
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class IpRangesCache:
+    """
+    Two tier cache of the parsed region slice of ip-ranges.json keyed by region and syncToken.
+    The in-memory tier survives between invocations of a warm container, the directory
+    tier (normally under /tmp) of gzip compressed files survives as long as the execution
+    environment does.
+    """
+
+    def __init__(self, directory: str, ttl: float, max_entries: int, max_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory: Dict[Tuple[str, str], CacheEntry] = {}
+
+    def get(self, region: str) -> Optional[CacheEntry]:
+        """
+        Returns the most recently stored entry for the region that has not expired
+        """
+        now = time.time()
+        self._evict_expired_from_memory(now)
+        in_memory = [entry for (entry_region, _), entry in self._memory.items() if entry_region == region]
+        if in_memory:
+            return max(in_memory, key=lambda entry: entry.stored_at)
+
+        entry = self._read_newest_file(region, now)
+        if entry:
+            self._remember(entry)
+        return entry
+
+    def put(self, entry: CacheEntry) -> CacheEntry:
+        entry = entry._replace(stored_at=time.time())
+        self._remember(entry)
+        self._write_file(entry)
+        return entry
+
+    def touch(self, entry: CacheEntry) -> CacheEntry:
+        """
+        Restarts the TTL of an entry that was revalidated against the origin
+        """
+        return self.put(entry)
+
+    def clear(self):
+        self._memory.clear()
+        for path in self._files(CACHE_FILE_SUFFIX) + self._files(UNCOMPRESSED_CACHE_FILE_SUFFIX):
+            _remove(path)
+
+    def _remember(self, entry: CacheEntry):
+        self._memory[(entry.region, entry.sync_token)] = entry
+        while len(self._memory) > self.max_entries:
+            oldest = min(self._memory, key=lambda key: self._memory[key].stored_at)
+            del self._memory[oldest]
+
+    def _evict_expired_from_memory(self, now: float):
+        for key in [key for key, entry in self._memory.items() if now - entry.stored_at > self.ttl]:
+            del self._memory[key]
+
+    def _path(self, region: str, sync_token: str) -> str:
+        return os.path.join(self.directory, '%s.%s%s' % (region, sync_token, CACHE_FILE_SUFFIX))
+
+    def _files(self, suffix: str) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if name.endswith(suffix)]
+
+    def _read_newest_file(self, region: str, now: float) -> Optional[CacheEntry]:
+        candidates = [path for path in self._files(CACHE_FILE_SUFFIX)
+                      if os.path.basename(path).startswith(region + '.')]
+        for path in sorted(candidates, key=_mtime, reverse=True):
+            entry = _load_entry(path)
+            if entry is None or entry.region != region:
+                log.warning("discarding corrupt ip-ranges cache file %s", path)
+                _remove(path)
+            elif now - entry.stored_at > self.ttl:
+                _remove(path)
+            else:
+                return entry
+        return None
+
+    def _write_file(self, entry: CacheEntry):
+        # write to a temporary file and atomically rename it so a concurrent reader or
+        # a crash mid-write can never observe a half written cache file
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=TEMPORARY_FILE_SUFFIX)
+            try:
+                with os.fdopen(fd, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as compressed:
+                    compressed.write(json.dumps(entry._asdict()).encode('utf-8'))
+                os.replace(temp_path, self._path(entry.region, entry.sync_token))
+            except BaseException:
+                _remove(temp_path)
+                raise
+        except OSError as e:
+            log.warning("unable to write ip-ranges cache file: %s", e)
+            return
+        self._evict_files()
+
+    def _evict_files(self):
+        """
+        Removes expired files, then the least recently stored ones until the
+        directory is within max_entries and max_bytes
+        """
+        now = time.time()
+        kept_entries = 0
+        kept_bytes = 0
+        for path in sorted(self._files(CACHE_FILE_SUFFIX), key=_mtime, reverse=True):
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if kept_entries >= self.max_entries or kept_bytes + size > self.max_bytes or \
+                    now - _mtime(path) > self.ttl:
+                _remove(path)
+            else:
+                kept_entries += 1
+                kept_bytes += size
+
+        # temporary files left behind by a writer that crashed before renaming them
+        for path in self._files(TEMPORARY_FILE_SUFFIX):
+            if now - _mtime(path) > ABANDONED_TEMPORARY_FILE_AGE:
+                _remove(path)
+        for path in self._files(UNCOMPRESSED_CACHE_FILE_SUFFIX):
+            _remove(path)
+
+
+def _load_entry(path: str) -> Optional[CacheEntry]:
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            entry = CacheEntry(**json.load(f))
+    except (OSError, EOFError, zlib.error, ValueError, TypeError):
+        # BadGzipFile is an OSError, a truncated file raises EOFError
+        return None
+    if not isinstance(entry.prefixes, list) or not isinstance(entry.sync_token, str):
+        return None
+    return entry
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
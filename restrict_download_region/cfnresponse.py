@@ -2,6 +2,8 @@
 # The following code is from: https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/cfn-lambda-function-code-cfnresponsemodule.html
 # The cfn-response module is available only when using the ZipFile property in the template.yaml, which this Lambda was previously using.
 # Now that the Lambda's code is refactored into separate a separate Python file, we must bundle it with the code.
+# send was changed to bound the request with a timeout, retry failed requests with backoff and return
+# whether CloudFormation received the response. The body is serialized by jsoncodec.
 ##############################################################################################################################################
 
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
@@ -9,15 +11,23 @@
 
 from __future__ import print_function
 import urllib3
-import json
+import time
+
+import restrict_download_region.jsoncodec as jsoncodec
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+# a float timeout bounds the connect and the read separately, an attempt can take twice as long
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
 http = urllib3.PoolManager()
 
 
-def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None):
+def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None,
+         timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
     responseUrl = event['ResponseURL']
 
     print(responseUrl)
@@ -33,21 +43,31 @@ def send(event, context, responseStatus, responseData, physicalResourceId=None,
         'Data': responseData
     }
 
-    json_responseBody = json.dumps(responseBody)
+    json_responseBody = jsoncodec.dumps(responseBody)
 
     print("Response body:")
     print(json_responseBody)
 
     headers = {
         'content-type': '',
-        'content-length': str(len(json_responseBody))
+        'content-length': str(len(json_responseBody.encode('utf-8')))
     }
 
-    try:
-        response = http.request(
-            'PUT', responseUrl, headers=headers, body=json_responseBody)
-        print("Status code:", response.status)
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = http.request(
+                'PUT', responseUrl, headers=headers, body=json_responseBody, timeout=timeout, retries=False)
+            print("Status code:", response.status)
+            if 200 <= response.status < 300:
+                return True
+            # the pre-signed url was rejected, e.g. because it expired, retrying won't help
+            if response.status < 500 and response.status != 429:
+                return False
+
+        except Exception as e:
 
-    except Exception as e:
+            print("send(..) failed executing http.request(..):", e)
 
-        print("send(..) failed executing http.request(..):", e)
+    return False
@@ -0,0 +1,51 @@
+import hashlib
+import ipaddress
+import json
+import logging
+from typing import List
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def aggregate_prefixes(prefixes: List[str]) -> List[str]:
+    """
+    Merges adjacent and overlapping networks into the minimal set of CIDR
+    blocks covering exactly the same address space.
+    IPv4 blocks are returned first, followed by IPv6 blocks, each in address order.
+    """
+    aggregated = _collapse(prefixes)
+
+    log.info("aggregated %d prefixes (%d bytes) into %d prefixes (%d bytes)",
+             len(prefixes), serialized_size(prefixes),
+             len(aggregated), serialized_size(aggregated))
+    return aggregated
+
+
+def serialized_size(prefixes: List[str]) -> int:
+    """
+    Number of bytes the prefix list occupies once serialized into a policy
+    """
+    return len(json.dumps(prefixes, separators=(',', ':')))
+
+
+def fingerprint_prefixes(prefixes: List[str]) -> str:
+    """
+    Stable fingerprint of the address space covered by the prefixes,
+    independent of their order, duplicates and aggregation
+    """
+    return hashlib.sha256(','.join(_collapse(prefixes)).encode('utf-8')).hexdigest()
+
+
+def _collapse(prefixes: List[str]) -> List[str]:
+    ipv4_networks = []
+    ipv6_networks = []
+    for prefix in prefixes:
+        network = ipaddress.ip_network(prefix, strict=False)
+        if network.version == 4:
+            ipv4_networks.append(network)
+        else:
+            ipv6_networks.append(network)
+
+    return [str(network) for network in ipaddress.collapse_addresses(ipv4_networks)] + \
+        [str(network) for network in ipaddress.collapse_addresses(ipv6_networks)]
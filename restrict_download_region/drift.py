@@ -0,0 +1,160 @@
+"""
+Drift scanning of the ip restriction statements of many buckets.
+
+A bucket is current when its policy holds exactly one restriction statement that is
+unchanged apart from its prefixes and covers the address space of the current feed.
+Every bucket is compared against the same two fingerprints, one of the statement with
+its prefixes left out and one of the region's address space, so a scan of thousands
+of buckets is bound by the GetBucketPolicy calls and not by the comparison.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import restrict_download_region.jsoncodec as jsoncodec
+from restrict_download_region.cidr import fingerprint_prefixes
+from restrict_download_region.policy import BucketPolicy, canonical_statement
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# the statement matches the current feed
+CURRENT = 'CURRENT'
+# the policy has no restriction statement
+MISSING = 'MISSING'
+# the statement is intact but restricts to an earlier feed's address space
+STALE = 'STALE'
+# the statement was edited or duplicated
+DRIFTED = 'DRIFTED'
+# the policy could not be read or repaired
+ERROR = 'ERROR'
+# not scanned before the deadline
+SKIPPED = 'SKIPPED'
+STATUSES = (CURRENT, MISSING, STALE, DRIFTED, ERROR, SKIPPED)
+REPAIRABLE = (MISSING, STALE, DRIFTED)
+
+SOURCE_IP_CONDITION = ('NotIpAddress', 'aws:SourceIp')
+
+
+class DriftResult(NamedTuple):
+    bucket_name: str
+    status: str
+    detail: Optional[str] = None
+    repaired: bool = False
+
+
+class ExpectedStatement:
+    """
+    Fingerprints of the restriction statement a run would write, statement_for(bucket_name)
+    builds it for a bucket from the current prefixes
+    """
+
+    def __init__(self, statement_for: Callable[[str], dict], prefixes: List[str]):
+        self.statement_for = statement_for
+        self.address_space = fingerprint_prefixes(prefixes)
+
+    def shape(self, bucket_name: str) -> str:
+        return statement_shape(self.statement_for(bucket_name))
+
+
+def statement_shape(statement: dict) -> str:
+    """
+    The canonical statement without its source ip prefixes, which are compared by address space instead
+    """
+    operator, key = SOURCE_IP_CONDITION
+    condition = statement.get('Condition')
+    if isinstance(condition, dict) and isinstance(condition.get(operator), dict) and key in condition[operator]:
+        statement = dict(statement, Condition=dict(condition, **{operator: dict(condition[operator], **{key: '*'})}))
+    return jsoncodec.dumps(canonical_statement(statement), sort_keys=True)
+
+
+def classify_policy(bucket_name: str, bucket_policy: dict, expected: ExpectedStatement) -> Tuple[str, Optional[str]]:
+    """
+    Returns the status of the bucket's restriction statement and what differs
+    """
+    sid = expected.statement_for(bucket_name)['Sid']
+    statements = [statement.document for statement in BucketPolicy.from_dict(bucket_policy) if statement.sid == sid]
+    if not statements:
+        return MISSING, "no %s statement" % sid
+    if len(statements) > 1:
+        return DRIFTED, "%d %s statements" % (len(statements), sid)
+    statement = statements[0]
+    if statement_shape(statement) != expected.shape(bucket_name):
+        return DRIFTED, "%s was edited" % sid
+
+    operator, key = SOURCE_IP_CONDITION
+    source_ips = statement['Condition'][operator][key]
+    try:
+        address_space = fingerprint_prefixes([source_ips] if isinstance(source_ips, str) else source_ips)
+    except (TypeError, ValueError):
+        return DRIFTED, "%s holds an invalid prefix" % sid
+    if address_space != expected.address_space:
+        return STALE, "%s restricts to a different address space" % sid
+    return CURRENT, None
+
+
+class DriftReport:
+    """
+    Results of a scan by bucket, in the order the buckets were given
+    """
+
+    def __init__(self, results: Dict[str, DriftResult]):
+        self.results = results
+
+    def by_status(self, status: str) -> List[DriftResult]:
+        return [result for result in self.results.values() if result.status == status]
+
+    def counts(self) -> Dict[str, int]:
+        return {status: len(self.by_status(status)) for status in STATUSES}
+
+    def to_dict(self) -> dict:
+        """
+        Counts of every status and the buckets that are not current, leaving
+        out the thousands of current ones a fleet mostly consists of
+        """
+        return {
+            'counts': self.counts(),
+            'repaired': [result.bucket_name for result in self.results.values() if result.repaired],
+            'buckets': {status: {result.bucket_name: result.detail for result in self.by_status(status)}
+                        for status in STATUSES if status != CURRENT and self.by_status(status)}
+        }
+
+
+def scan_buckets(bucket_names: List[str], scan: Callable[[str], DriftResult], max_workers: int,
+                 time_left: Optional[Callable[[], float]] = None,
+                 margin: float = 0.0) -> DriftReport:
+    """
+    Scans the buckets on max_workers threads. No further bucket is started once
+    time_left() returns less than margin seconds, those are reported as SKIPPED.
+    An exception only fails the bucket that raised it.
+    """
+    remaining = iter(bucket_names)
+    lock = threading.Lock()
+    results = {}
+
+    def worker():
+        while time_left is None or time_left() >= margin:
+            with lock:
+                bucket_name = next(remaining, None)
+            if bucket_name is None:
+                return
+            try:
+                result = scan(bucket_name)
+            except Exception as e:
+                log.exception("failed to scan %s", bucket_name)
+                result = DriftResult(bucket_name, ERROR, str(e))
+            with lock:
+                results[bucket_name] = result
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drift-scan') as executor:
+        for _ in range(max(1, min(max_workers, len(bucket_names)))):
+            executor.submit(worker)
+
+    report = DriftReport({bucket_name: results.get(bucket_name) or DriftResult(bucket_name, SKIPPED)
+                          for bucket_name in bucket_names})
+    log.info("scanned %d of %d buckets in %.1f s: %s", len(results), len(bucket_names),
+             time.perf_counter() - started, report.counts())
+    return report
@@ -0,0 +1,151 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from restrict_download_region.throttle import call_directly
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+UPDATED = 'UPDATED'
+UNCHANGED = 'UNCHANGED'
+FAILED = 'FAILED'
+
+
+class BucketResult(NamedTuple):
+    bucket_name: str
+    status: str
+    error: Optional[str] = None
+
+
+# buckets of the account this function may not or can no longer read are not candidates
+INACCESSIBLE_BUCKET_ERROR_CODES = ('AccessDenied', 'AllAccessDisabled', 'NoSuchBucket')
+
+
+class DiscoveryError(Exception):
+    """
+    Raised after every candidate was checked when it could not be told for some of them
+    whether they are to be restricted. bucket_names holds the buckets that were discovered.
+    """
+
+    def __init__(self, bucket_names: List[str], errors: Dict[str, str]):
+        self.bucket_names = bucket_names
+        self.errors = errors
+        super().__init__("could not discover whether %d buckets are to be restricted: %s" % (
+            len(errors), ", ".join("%s (%s)" % item for item in errors.items())))
+
+
+class BucketUpdateError(Exception):
+    """
+    Raised after every bucket was processed when at least one of them failed
+    """
+
+    def __init__(self, results: Dict[str, BucketResult]):
+        self.results = results
+        failed = [result for result in results.values() if result.status == FAILED]
+        super().__init__("failed to update %d of %d buckets: %s" % (
+            len(failed), len(results),
+            ", ".join("%s (%s)" % (result.bucket_name, result.error) for result in failed)))
+
+
+def apply_to_buckets(bucket_names: List[str], apply: Callable[[str], bool],
+                     max_workers: int) -> Dict[str, BucketResult]:
+    """
+    Calls apply for every bucket on a bounded thread pool. apply returns whether the
+    bucket's policy was changed; an exception only fails the bucket that raised it.
+    """
+    def apply_isolated(bucket_name: str) -> BucketResult:
+        try:
+            return BucketResult(bucket_name, UPDATED if apply(bucket_name) else UNCHANGED)
+        except Exception as e:
+            log.exception("failed to update the policy of %s", bucket_name)
+            return BucketResult(bucket_name, FAILED, str(e))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = {result.bucket_name: result for result in executor.map(apply_isolated, bucket_names)}
+
+    for result in results.values():
+        log.info("%s: %s", result.bucket_name, result.status)
+    return results
+
+
+def discover_bucket_names(s3_client, ssm_client_factory: Callable,
+                          bucket_names: Optional[str] = None,
+                          parameter_name: Optional[str] = None,
+                          tag: Optional[str] = None,
+                          region: Optional[str] = None,
+                          max_workers: int = 1,
+                          call: Callable = call_directly) -> List[str]:
+    """
+    Collects the buckets to restrict from a comma separated list, an SSM
+    parameter holding such a list, and/or the buckets in the region carrying
+    a tag written as key=value. The S3 calls are made through call(operation, **kwargs),
+    which paces and retries them.
+    """
+    discovered = []
+    if bucket_names:
+        discovered += _split_bucket_names(bucket_names)
+    if parameter_name:
+        parameter = ssm_client_factory().get_parameter(Name=parameter_name)['Parameter']
+        discovered += _split_bucket_names(parameter['Value'])
+    if tag:
+        try:
+            discovered += buckets_with_tag(s3_client, tag, region, max_workers, call)
+        except DiscoveryError as e:
+            raise DiscoveryError(list(dict.fromkeys(discovered + e.bucket_names)), e.errors)
+
+    # preserve order but drop duplicates
+    return list(dict.fromkeys(discovered))
+
+
+def buckets_with_tag(s3_client, tag: str, region: Optional[str], max_workers: int,
+                     call: Callable = call_directly) -> List[str]:
+    if '=' not in tag:
+        raise ValueError("BUCKET_TAG must be written as key=value")
+    tag_key, tag_value = tag.split('=', 1)
+
+    from botocore.exceptions import ClientError
+
+    def matches(bucket_name: str) -> bool:
+        # a bucket can only be restricted to the prefixes of its own region
+        if region and bucket_region(s3_client, bucket_name, call) != region:
+            return False
+        try:
+            tag_set = call(s3_client.get_bucket_tagging, Bucket=bucket_name)['TagSet']
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchTagSet':
+                return False
+            raise
+        return any(item['Key'] == tag_key and item['Value'] == tag_value for item in tag_set)
+
+    def check(bucket_name: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns whether the bucket matches, or the error that left it undecided
+        """
+        try:
+            return matches(bucket_name), None
+        except Exception as e:
+            if isinstance(e, ClientError) and e.response['Error']['Code'] in INACCESSIBLE_BUCKET_ERROR_CODES:
+                log.warning("skipping %s, its region or tags can't be read: %s", bucket_name, e)
+                return False, None
+            # still failing after the retries of call, the bucket is reported instead of silently left out
+            log.exception("could not read the region or tags of %s", bucket_name)
+            return False, str(e)
+
+    candidates = [bucket['Name'] for bucket in call(s3_client.list_buckets)['Buckets']]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        checked = list(executor.map(check, candidates))
+    matched = [bucket_name for bucket_name, (bucket_matched, _) in zip(candidates, checked) if bucket_matched]
+    errors = {bucket_name: error for bucket_name, (_, error) in zip(candidates, checked) if error}
+    if errors:
+        raise DiscoveryError(matched, errors)
+    return matched
+
+
+def bucket_region(s3_client, bucket_name: str, call: Callable = call_directly) -> str:
+    # buckets in us-east-1 have no location constraint
+    return call(s3_client.get_bucket_location, Bucket=bucket_name).get('LocationConstraint') or 'us-east-1'
+
+
+def _split_bucket_names(bucket_names: str) -> List[str]:
+    return [bucket_name.strip() for bucket_name in bucket_names.split(',') if bucket_name.strip()]
@@ -0,0 +1,200 @@
+"""
+Timeout-bounded and hedged downloads of ip-ranges.json.
+
+The pool times out connects and reads and retries failed requests a bounded number
+of times. Given a deadline, retries stop at it and a request that hasn't finished by
+then is abandoned, however slowly its body is still arriving. A hedged request sends
+a second, identical GET when the first one hasn't answered by the given percentile of
+the latencies seen so far, and the first response to arrive wins, so one slow
+connection doesn't use up the Lambda's time.
+"""
+import logging
+import math
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Optional
+
+import urllib3
+from urllib3.exceptions import MaxRetryError, ResponseError
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# the cdn answers these while it is overloaded or a deployment is rolling out
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+class FetchError(Exception):
+    pass
+
+
+def check_status(resp: urllib3.HTTPResponse, url: str, not_modified: bool = False):
+    """
+    The pool returns the last response once its retries ran out. Raises instead of letting
+    an error page reach the parser, where it would only show up as malformed JSON.
+    """
+    if resp.status == 200 or (not_modified and resp.status == 304):
+        return
+    resp.release_conn()
+    raise FetchError("%s returned %d" % (url, resp.status))
+
+
+class DeadlineRetry(urllib3.Retry):
+    """
+    Retry that also gives up once the backoff before the next attempt would end past
+    deadline, a time.monotonic() value, so an abandoned request stops retrying too
+    """
+
+    def __init__(self, *args, deadline: Optional[float] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deadline = deadline
+
+    def new(self, **kw) -> 'DeadlineRetry':
+        kw.setdefault('deadline', self.deadline)
+        return super().new(**kw)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None,
+                  _stacktrace=None) -> 'DeadlineRetry':
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if self.deadline is not None and time.monotonic() + retry.get_backoff_time() >= self.deadline:
+            raise MaxRetryError(_pool, url, error or ResponseError("no time left to retry"))
+        return retry
+
+
+def create_pool(connect_timeout: float, read_timeout: float, retries: int) -> urllib3.PoolManager:
+    return urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout),
+        retries=DeadlineRetry(total=retries, connect=retries, read=retries, status=retries,
+                              status_forcelist=RETRY_STATUS_CODES, allowed_methods=['GET'],
+                              backoff_factor=0.1, raise_on_status=False))
+
+
+def retries_until(pool: urllib3.PoolManager, deadline: float) -> urllib3.Retry:
+    return pool.connection_pool_kw['retries'].new(deadline=deadline)
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+_requests = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bounded-request')
+
+
+def request_before(pool: urllib3.PoolManager, url: str, deadline: float, **kwargs) -> urllib3.HTTPResponse:
+    """
+    GETs url, raising FetchError when the response, and its body unless it is streamed,
+    hasn't arrived by deadline. The read timeout only bounds each read from the socket.
+    """
+    future = _requests.submit(pool.request, 'GET', url, retries=retries_until(pool, deadline), **kwargs)
+    done, _ = wait((future,), timeout=time_left(deadline))
+    if not done:
+        future.add_done_callback(_discard)
+        raise FetchError("%s did not respond in time" % url)
+    return future.result()
+
+
+@contextmanager
+def cut_off(resp: urllib3.HTTPResponse, url: str, deadline: float):
+    """
+    Shuts the connection of a streamed response down at deadline, so a body that
+    trickles in can't keep its reader waiting, which then sees a FetchError
+    """
+    passed = threading.Event()
+
+    def shut_down():
+        passed.set()
+        sock = getattr(resp.connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    timer = threading.Timer(time_left(deadline), shut_down)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except Exception as e:
+        if passed.is_set():
+            raise FetchError("%s was not read in time" % url) from e
+        raise
+    finally:
+        timer.cancel()
+
+
+class HedgedRequests:
+    """
+    Sends GET requests, hedged after the percentile of the last window latencies.
+    Until min_samples latencies are known, initial_delay is used instead.
+    """
+
+    def __init__(self, percentile: float, initial_delay: float, window: int = 32, min_samples: int = 5):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        # outlives the invocation, the losing request may still be running when it ends
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='hedged-request')
+
+    def hedge_after(self) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        return latencies[max(0, math.ceil(self.percentile / 100 * len(latencies)) - 1)]
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def request(self, pool: urllib3.PoolManager, url: str, deadline: Optional[float] = None,
+                **kwargs) -> urllib3.HTTPResponse:
+        """
+        Returns the first response, or raises the error of the first request when both failed.
+        Like request_before, gives up with a FetchError at deadline.
+        """
+        started = time.perf_counter()
+        if deadline is not None:
+            kwargs['retries'] = retries_until(pool, deadline)
+        primary = self._executor.submit(pool.request, 'GET', url, **kwargs)
+        pending = {primary}
+        hedge_after = self.hedge_after()
+        left = time_left(deadline)
+        done, pending = wait(pending, timeout=hedge_after if left is None else min(hedge_after, left))
+        if not done and time_left(deadline) != 0:
+            log.info("no response from %s after %.3f s, sending a hedged request", url, time.perf_counter() - started)
+            pending.add(self._executor.submit(pool.request, 'GET', url, **kwargs))
+
+        while True:
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner or not pending:
+                break
+            done, pending = wait(pending, timeout=time_left(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+
+        for future in pending:
+            future.add_done_callback(_discard)
+        if winner is None:
+            if not primary.done():
+                raise FetchError("%s did not respond in time" % url)
+            # both failed, report the first request's error
+            raise primary.exception()
+        self.record(time.perf_counter() - started)
+        for future in done:
+            if future is not winner:
+                _discard(future)
+        return winner.result()
+
+
+def _discard(future: Future):
+    response: Optional[urllib3.HTTPResponse] = None if future.exception() else future.result()
+    if response is not None:
+        # don't return the connection of a response that may not have been read to the pool
+        response.close()
@@ -0,0 +1,254 @@
+import codecs
+import json
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# top level keys of ip-ranges.json whose arrays are streamed one entry at a time
+PREFIX_LISTS = ('prefixes', 'ipv6_prefixes')
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SEPARATOR = re.compile(r'[ \t\n\r]*,[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+class _ChunkBuffer:
+    """
+    Text buffer over an iterable of utf-8 encoded byte chunks that only holds
+    the not yet consumed part of the document in memory
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """
+        Appends the next chunk to the buffer, returning False at the end of the stream
+        """
+        if self.eof:
+            return False
+        # drop everything already consumed so the buffer stays chunk-sized
+        self.text = self.text[self.pos:]
+        self.pos = 0
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self.eof = True
+            self.text += self._utf8.decode(b'', final=True)
+        else:
+            self.text += self._utf8.decode(chunk)
+        return True
+
+    def next_char(self) -> str:
+        """
+        Skips whitespace and returns the next character without consuming it
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of ip-ranges document")
+
+    def expect(self, char: str):
+        if self.next_char() != char:
+            raise ValueError("expected %r at offset %d of ip-ranges document" % (char, self.pos))
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decodes the next complete JSON value, reading more chunks until it is available
+        """
+        self.next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.text) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self) -> Iterator:
+        """
+        Yields the elements of the array starting at the current position one at a time
+        """
+        self.expect('[')
+        if self.next_char() == ']':
+            self.pos += 1
+            return
+        yield self.decode_value()
+        while True:
+            # fast path while the separator and the whole next element are already buffered
+            separator = _SEPARATOR.match(self.text, self.pos)
+            if separator:
+                try:
+                    value, end = _decoder.raw_decode(self.text, separator.end())
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    if end < len(self.text):
+                        self.pos = end
+                        yield value
+                        continue
+            if self.next_char() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+            yield self.decode_value()
+
+
+def iter_ip_ranges(chunks: Iterable[bytes]) -> Iterator[Tuple[str, object]]:
+    """
+    Incrementally parses an ip-ranges.json document delivered as byte chunks.
+    Yields (key, entry) for every element of the prefixes and ipv6_prefixes arrays
+    and (key, value) for every other top level key (e.g. syncToken), without ever
+    materializing the full document.
+    """
+    buffer = _ChunkBuffer(chunks)
+    buffer.expect('{')
+    if buffer.next_char() == '}':
+        return
+    while True:
+        key = buffer.decode_value()
+        buffer.expect(':')
+        if key in PREFIX_LISTS and buffer.next_char() == '[':
+            for entry in buffer.iter_array():
+                yield key, entry
+        else:
+            yield key, buffer.decode_value()
+
+        if buffer.next_char() == '}':
+            return
+        buffer.expect(',')
+
+
+def stream_ip_prefixes_for_region(chunks: Iterable[bytes], region: str, service: str = 'AMAZON') -> Iterator[str]:
+    """
+    Yields the ip_prefix/ipv6_prefix of every entry matching the region and service
+    as soon as it has been parsed
+    """
+    for key, entry in iter_ip_ranges(chunks):
+        if key in PREFIX_LISTS and entry['service'] == service and entry['region'] == region:
+            yield entry['ip_prefix'] if key == 'prefixes' else entry['ipv6_prefix']
+
+
+def read_ip_prefixes_for_region(chunks: Iterable[bytes], region: str,
+                                service: str = 'AMAZON') -> Tuple[Optional[str], List[str]]:
+    """
+    Returns the feed's syncToken along with the ip_prefix/ipv6_prefix of every
+    entry matching the region and service
+    """
+    sync_token = None
+    prefixes = []
+    for key, value in iter_ip_ranges(chunks):
+        if key in PREFIX_LISTS:
+            if value['service'] == service and value['region'] == region:
+                prefixes.append(value['ip_prefix'] if key == 'prefixes' else value['ipv6_prefix'])
+        elif key == 'syncToken':
+            sync_token = value
+    return sync_token, prefixes
+
+
+class RegionIndex:
+    """
+    Index over the whole ip-ranges feed, built in one pass, that answers prefix queries
+    by region, service and network border group with a dictionary lookup.
+    Any of the three may be left out of a query (None) to match every value, except
+    that a network border group is only looked up together with its region and service.
+    """
+
+    def __init__(self, sync_token: Optional[str] = None, create_date: Optional[str] = None):
+        self.sync_token = sync_token
+        self.create_date = create_date
+        # (region, service, network_border_group) -> ([ipv4 prefixes], [ipv6 prefixes])
+        self._entries: Dict[Tuple[str, str, str], Tuple[List[str], List[str]]] = {}
+        self._queries: Optional[Dict[Tuple[Optional[str], Optional[str], Optional[str]], Tuple[str, ...]]] = None
+
+    @classmethod
+    def from_ip_ranges(cls, items: Iterable[Tuple[str, object]]) -> 'RegionIndex':
+        """
+        Builds the index from the (key, value) pairs produced by iter_ip_ranges
+        """
+        index = cls()
+        for key, value in items:
+            if key == 'prefixes':
+                index.add(value['ip_prefix'], value['region'], value['service'], value['network_border_group'])
+            elif key == 'ipv6_prefixes':
+                index.add(value['ipv6_prefix'], value['region'], value['service'], value['network_border_group'])
+            elif key == 'syncToken':
+                index.sync_token = value
+            elif key == 'createDate':
+                index.create_date = value
+        return index
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'RegionIndex':
+        """
+        Builds the index from an already parsed ip-ranges.json document
+        """
+        def items():
+            for key, value in document.items():
+                if key in PREFIX_LISTS:
+                    for entry in value:
+                        yield key, entry
+                else:
+                    yield key, value
+        return cls.from_ip_ranges(items())
+
+    def add(self, prefix: str, region: str, service: str, network_border_group: str):
+        ipv4_prefixes, ipv6_prefixes = self._entries.setdefault((region, service, network_border_group), ([], []))
+        (ipv6_prefixes if ':' in prefix else ipv4_prefixes).append(prefix)
+        self._queries = None
+
+    def prefixes(self, region: Optional[str] = None, service: Optional[str] = 'AMAZON',
+                 network_border_group: Optional[str] = None) -> Tuple[str, ...]:
+        """
+        IPv4 prefixes followed by IPv6 prefixes matching the query. The answer is built once
+        and shared by every caller, as a tuple so that no caller can change it for the others.
+        """
+        if self._queries is None:
+            self._queries = self._build_queries()
+        return self._queries.get((region, service, network_border_group), ())
+
+    def regions(self) -> List[str]:
+        return sorted({region for region, _, _ in self._entries})
+
+    def services(self) -> List[str]:
+        return sorted({service for _, service, _ in self._entries})
+
+    def to_dict(self) -> dict:
+        return {
+            'syncToken': self.sync_token,
+            'createDate': self.create_date,
+            'entries': [[region, service, network_border_group, ipv4_prefixes, ipv6_prefixes]
+                        for (region, service, network_border_group), (ipv4_prefixes, ipv6_prefixes)
+                        in self._entries.items()]
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'RegionIndex':
+        index = cls(data.get('syncToken'), data.get('createDate'))
+        for region, service, network_border_group, ipv4_prefixes, ipv6_prefixes in data['entries']:
+            index._entries[(region, service, network_border_group)] = (list(ipv4_prefixes), list(ipv6_prefixes))
+        return index
+
+    def _build_queries(self) -> Dict[Tuple[Optional[str], Optional[str], Optional[str]], Tuple[str, ...]]:
+        """
+        Precomputes the answer of every query shape, keeping IPv4 ahead of IPv6
+        """
+        ipv4_answers: Dict[Tuple, List[str]] = {}
+        ipv6_answers: Dict[Tuple, List[str]] = {}
+        for (region, service, network_border_group), (ipv4_prefixes, ipv6_prefixes) in self._entries.items():
+            for key in ((region, service, network_border_group), (region, service, None),
+                        (region, None, None), (None, service, None), (None, None, None)):
+                ipv4_answers.setdefault(key, []).extend(ipv4_prefixes)
+                ipv6_answers.setdefault(key, []).extend(ipv6_prefixes)
+        return {key: tuple(ipv4_answers[key] + ipv6_answers[key]) for key in ipv4_answers}
@@ -0,0 +1,66 @@
+"""
+JSON codec used for the feed, bucket policies and custom resource responses.
+
+orjson, a dependency in the Pipfile, parses the multi-megabyte ip-ranges.json and
+serializes large policies several times faster than the json module, which is the
+fallback where it isn't installed. Both backends produce the same compact output: no
+whitespace, non-ASCII characters as UTF-8 rather than escapes, and optionally sorted
+keys. JSON_BACKEND=json forces the standard library.
+"""
+import json
+import os
+from typing import Callable, Dict, NamedTuple, Union
+
+try:
+    import orjson
+except ImportError:
+    # e.g. the render CLI run outside of the pipenv environment
+    orjson = None
+
+
+class Backend(NamedTuple):
+    name: str
+    loads: Callable[[Union[bytes, str]], object]
+    dumps: Callable[[object, bool], str]
+
+
+def _json_dumps(obj, sort_keys: bool) -> str:
+    return json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys, ensure_ascii=False)
+
+
+def _orjson_dumps(obj, sort_keys: bool) -> str:
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode('utf-8')
+    except TypeError:
+        # e.g. integers beyond 64 bits or non-string keys, which the json module handles
+        return _json_dumps(obj, sort_keys)
+
+
+BACKENDS: Dict[str, Backend] = {'json': Backend('json', json.loads, _json_dumps)}
+if orjson is not None:
+    BACKENDS['orjson'] = Backend('orjson', orjson.loads, _orjson_dumps)
+
+
+def select_backend(name: str = None) -> Backend:
+    """
+    The named backend, or the fastest one installed. Raises ValueError for a backend that isn't installed.
+    """
+    if not name:
+        return BACKENDS.get('orjson') or BACKENDS['json']
+    if name not in BACKENDS:
+        raise ValueError("JSON backend %s is not installed, expected one of %s" % (name, ", ".join(BACKENDS)))
+    return BACKENDS[name]
+
+
+backend = select_backend(os.environ.get('JSON_BACKEND'))
+
+
+def loads(data: Union[bytes, str]):
+    """
+    Raises a json.JSONDecodeError, a ValueError, for malformed documents with either backend
+    """
+    return backend.loads(data)
+
+
+def dumps(obj, sort_keys: bool = False) -> str:
+    return backend.dumps(obj, sort_keys)
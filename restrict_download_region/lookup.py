@@ -0,0 +1,140 @@
+import ipaddress
+import socket
+from array import array
+from bisect import bisect_right
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+
+class Owner(NamedTuple):
+    prefix: str
+    region: str
+    service: str
+    network_border_group: Optional[str] = None
+
+
+class _Intervals:
+    """
+    Disjoint, sorted address intervals of one ip version, each mapped to the owners
+    of every network covering it, most specific network first
+    """
+
+    def __init__(self, version: int, starts, ends, owners: List[Tuple[Owner, ...]]):
+        self.version = version
+        self.starts = starts
+        self.ends = ends
+        self.owners = owners
+
+    @classmethod
+    def build(cls, version: int, networks: List[Tuple[int, int, Owner]]) -> '_Intervals':
+        # sweep over the network boundaries, keeping the set of networks covering the current position
+        events = sorted([(start, 1, index) for index, (start, _, _) in enumerate(networks)] +
+                        [(end + 1, 0, index) for index, (_, end, _) in enumerate(networks)])
+        starts, ends, owners = [], [], []
+        shared: Dict[FrozenSet[int], Tuple[Owner, ...]] = {}
+        active = set()
+        for position, (address, is_start, index) in enumerate(events):
+            if is_start:
+                active.add(index)
+            else:
+                active.discard(index)
+            following = events[position + 1][0] if position + 1 < len(events) else None
+            if not active or following == address:
+                continue
+            key = frozenset(active)
+            if key not in shared:
+                shared[key] = tuple(networks[i][2] for i in sorted(
+                    key, key=lambda i: (networks[i][1] - networks[i][0], networks[i][2])))
+            if owners and owners[-1] is shared[key] and ends[-1] + 1 == address:
+                ends[-1] = following - 1
+            else:
+                starts.append(address)
+                ends.append(following - 1)
+                owners.append(shared[key])
+
+        if version == 4:
+            # 4 bytes per address instead of a python int
+            starts, ends = array('I', starts), array('I', ends)
+        return cls(version, starts, ends, owners)
+
+    def find(self, address: int) -> Tuple[Owner, ...]:
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and address <= self.ends[index]:
+            return self.owners[index]
+        return ()
+
+
+class IpRangeLookup:
+    """
+    Answers which regions and services own an IPv4 or IPv6 address with a binary search
+    over the disjoint intervals the feed's networks split the address space into
+    """
+
+    def __init__(self, ipv4: _Intervals, ipv6: _Intervals, sync_token: Optional[str] = None):
+        self._ipv4 = ipv4
+        self._ipv6 = ipv6
+        self.sync_token = sync_token
+
+    @classmethod
+    def from_ip_ranges(cls, items: Iterable[Tuple[str, object]]) -> 'IpRangeLookup':
+        """
+        Builds the lookup from the (key, value) pairs produced by iter_ip_ranges
+        """
+        sync_token = None
+        owners = []
+        for key, value in items:
+            if key == 'prefixes':
+                owners.append(Owner(value['ip_prefix'], value['region'], value['service'],
+                                    value.get('network_border_group')))
+            elif key == 'ipv6_prefixes':
+                owners.append(Owner(value['ipv6_prefix'], value['region'], value['service'],
+                                    value.get('network_border_group')))
+            elif key == 'syncToken':
+                sync_token = value
+        return cls.from_owners(owners, sync_token)
+
+    @classmethod
+    def from_owners(cls, owners: Iterable[Owner], sync_token: Optional[str] = None) -> 'IpRangeLookup':
+        networks = {4: [], 6: []}
+        for owner in owners:
+            network = ipaddress.ip_network(owner.prefix, strict=False)
+            networks[network.version].append(
+                (int(network.network_address), int(network.broadcast_address), owner))
+        return cls(_Intervals.build(4, networks[4]), _Intervals.build(6, networks[6]), sync_token)
+
+    @classmethod
+    def from_prefixes(cls, prefixes: Iterable[str], region: str = '', service: str = '') -> 'IpRangeLookup':
+        """
+        Lookup over a plain prefix list, such as the aws:SourceIp list of a policy
+        """
+        return cls.from_owners(Owner(prefix, region, service) for prefix in prefixes)
+
+    def owners(self, ip: str) -> Tuple[Owner, ...]:
+        """
+        Owners of every network containing the address, most specific network first.
+        Raises ValueError for anything that isn't an ip address.
+        """
+        if ':' in ip:
+            return self._ipv6.find(int.from_bytes(_inet_pton(socket.AF_INET6, ip), 'big'))
+        return self._ipv4.find(int.from_bytes(_inet_pton(socket.AF_INET, ip), 'big'))
+
+    def region(self, ip: str, service: Optional[str] = 'AMAZON') -> Optional[str]:
+        """
+        Region of the most specific network of the service containing the address
+        """
+        for owner in self.owners(ip):
+            if service is None or owner.service == service:
+                return owner.region
+        return None
+
+    def __contains__(self, ip: str) -> bool:
+        return bool(self.owners(ip))
+
+    def __len__(self) -> int:
+        return len(self._ipv4.starts) + len(self._ipv6.starts)
+
+
+def _inet_pton(family: int, ip: str) -> bytes:
+    try:
+        return socket.inet_pton(family, ip)
+    except OSError:
+        raise ValueError("%r is not an ip address" % ip)
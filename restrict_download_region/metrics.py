@@ -0,0 +1,124 @@
+import json
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# CloudWatch Embedded Metric Format
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+METRIC_UNITS = {
+    'Duration': 'Milliseconds',
+    'Bytes': 'Bytes',
+    'TransferBytes': 'Bytes',
+    'PrefixCount': 'Count',
+    'PolicySize': 'Bytes',
+    'Retries': 'Count',
+    'ThrottleWait': 'Milliseconds',
+    'Concurrency': 'Count'
+}
+DIMENSION = 'Phase'
+
+
+def stdout_sink(document: dict):
+    """
+    Lambda turns EMF documents written as single lines on stdout into metrics.
+    The logging module can't be used, the Lambda log format prefixes every line.
+    """
+    sys.stdout.write(json.dumps(document, separators=(',', ':')) + '\n')
+    sys.stdout.flush()
+
+
+class MemorySink:
+    """
+    Keeps the emitted documents, for tests and local runs
+    """
+
+    def __init__(self):
+        self.documents: List[dict] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, document: dict):
+        with self._lock:
+            self.documents.append(document)
+
+    def phases(self, name: str) -> List[dict]:
+        return [document for document in self.documents if document.get(DIMENSION) == name]
+
+
+class Phase:
+    """
+    Measures one phase of an invocation. The metrics are emitted when the phase ends,
+    so phases that completed are reported even if a later one runs into the timeout.
+    """
+
+    def __init__(self, sink: Callable[[dict], None], namespace: str, name: str, properties: Dict[str, object]):
+        self._sink = sink
+        self._namespace = namespace
+        self._document: Dict[str, object] = dict(properties)
+        self._document[DIMENSION] = name
+        self._values: Dict[str, float] = {}
+        self._started = None
+
+    def set(self, metric: str, value: float):
+        self._values[metric] = value
+
+    def add(self, metric: str, value: float):
+        self._values[metric] = self._values.get(metric, 0) + value
+
+    def __enter__(self) -> 'Phase':
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._values['Duration'] = (time.perf_counter() - self._started) * 1000
+        if exc_type is not None:
+            self._document['Error'] = exc_type.__name__
+        self._document.update(self._values)
+        self._document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self._namespace,
+                'Dimensions': [[DIMENSION]],
+                'Metrics': [{'Name': metric, 'Unit': METRIC_UNITS.get(metric, 'None')}
+                            for metric in self._values]
+            }]
+        }
+        try:
+            self._sink(self._document)
+        except Exception:
+            # metrics must never fail the policy update
+            pass
+        return False
+
+
+class _DisabledPhase:
+    def set(self, metric: str, value: float):
+        pass
+
+    def add(self, metric: str, value: float):
+        pass
+
+    def __enter__(self) -> '_DisabledPhase':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_DISABLED_PHASE = _DisabledPhase()
+
+
+class Metrics:
+    """
+    Emits the duration, and whatever sizes the phase records, of every phase
+    as an EMF document. Without a sink every phase is the same no-op object.
+    """
+
+    def __init__(self, namespace: str, sink: Optional[Callable[[dict], None]] = None):
+        self.namespace = namespace
+        self.sink = sink
+
+    def phase(self, name: str, **properties):
+        if self.sink is None:
+            return _DISABLED_PHASE
+        return Phase(self.sink, self.namespace, name, properties)
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, NamedTuple, Optional
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+IP_SPACE_CHANGED_TOPIC_ARN = 'arn:aws:sns:us-east-1:806199016981:AmazonIpSpaceChanged'
+# only ever download the feed from Amazon, whatever url the message advertises
+TRUSTED_URL_PREFIX = 'https://ip-ranges.amazonaws.com/'
+
+
+class IpSpaceChanged(NamedTuple):
+    """
+    Contents of an AmazonIpSpaceChanged notification
+    https://docs.aws.amazon.com/general/latest/gr/aws-ip-ranges.html#subscribe-notifications
+    """
+    sync_token: str
+    md5: str
+    url: str
+    create_time: Optional[str] = None
+
+
+def parse_ip_space_changed(event: dict) -> Optional[IpSpaceChanged]:
+    """
+    Returns the AmazonIpSpaceChanged message carried by an SNS event,
+    or None when the event is not such a notification
+    """
+    records = event.get('Records') if isinstance(event, dict) else None
+    if not records:
+        return None
+    sns = records[0].get('Sns') or {}
+    if sns.get('TopicArn') != IP_SPACE_CHANGED_TOPIC_ARN:
+        return None
+    try:
+        message = json.loads(sns.get('Message', ''))
+    except (ValueError, TypeError):
+        log.debug("SNS message is not an AmazonIpSpaceChanged notification")
+        return None
+    return ip_space_changed_from_message(message)
+
+
+def ip_space_changed_from_message(message: dict) -> Optional[IpSpaceChanged]:
+    """
+    Returns the notification held by a decoded AmazonIpSpaceChanged message,
+    or None when it is malformed or advertises an untrusted url
+    """
+    try:
+        notification = IpSpaceChanged(str(message['synctoken']), message['md5'], message['url'],
+                                      message.get('create-time'))
+    except (TypeError, KeyError):
+        log.debug("message is not an AmazonIpSpaceChanged notification")
+        return None
+
+    if not isinstance(notification.url, str) or not notification.url.startswith(TRUSTED_URL_PREFIX):
+        log.warning("ignoring untrusted ip-ranges url %s", notification.url)
+        return None
+    return notification
+
+
+def ip_space_changed_message(notification: IpSpaceChanged) -> dict:
+    """
+    The inverse of ip_space_changed_from_message, in the format Amazon publishes
+    """
+    message = {'synctoken': notification.sync_token, 'md5': notification.md5, 'url': notification.url}
+    if notification.create_time:
+        message['create-time'] = notification.create_time
+    return message
+
+
+def is_sync_token_newer(sync_token: Optional[str], than: Optional[str]) -> bool:
+    """
+    syncTokens are publication times in seconds since the epoch
+    """
+    if sync_token is None:
+        return False
+    if than is None:
+        return True
+    try:
+        return int(sync_token) > int(than)
+    except ValueError:
+        return sync_token != than
+
+
+class AppliedSyncTokens:
+    """
+    Remembers the last feed syncToken applied to each bucket, in memory and
+    (when a directory is given) in a file that outlives the python process
+    """
+
+    def __init__(self, directory: Optional[str]):
+        self.directory = directory
+        self._memory: Dict[str, str] = {}
+
+    def get(self, bucket_name: str) -> Optional[str]:
+        if bucket_name not in self._memory and self.directory:
+            try:
+                with open(self._path(bucket_name)) as f:
+                    sync_token = json.load(f)['sync_token']
+                if isinstance(sync_token, str):
+                    self._memory[bucket_name] = sync_token
+            except (OSError, ValueError, TypeError, KeyError):
+                pass
+        return self._memory.get(bucket_name)
+
+    def is_applied(self, bucket_name: str, sync_token: str) -> bool:
+        """
+        True when the bucket already carries a policy built from this feed or a newer one
+        """
+        applied = self.get(bucket_name)
+        return applied is not None and not is_sync_token_newer(sync_token, applied)
+
+    def put(self, bucket_name: str, sync_token: str):
+        self._memory[bucket_name] = sync_token
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'sync_token': sync_token}, f)
+            os.replace(temp_path, self._path(bucket_name))
+        except OSError as e:
+            log.warning("unable to persist applied syncToken: %s", e)
+
+    def _path(self, bucket_name: str) -> str:
+        return os.path.join(self.directory, bucket_name + '.applied')
@@ -0,0 +1,220 @@
+"""
+Canonical model of a bucket policy.
+
+Statements are compared by a digest of their canonical form: keys in sorted order,
+condition value lists sorted, and ip address conditions reduced to the address space
+they cover. Condition values are sets to IAM, and the statements of a policy are
+matched by Sid, so neither their order nor the way the prefixes are aggregated makes
+two policies differ.
+"""
+import hashlib
+from collections import Counter
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import restrict_download_region.jsoncodec as jsoncodec
+from restrict_download_region.cidr import fingerprint_prefixes
+
+IP_CONDITION_OPERATORS = ('IpAddress', 'NotIpAddress')
+
+
+def serialize_bucket_policy(bucket_policy: dict) -> str:
+    """
+    The policy document exactly as it is sent to S3: compact, with sorted keys and sorted condition values,
+    so the same policy always serializes to the same bytes
+    """
+    statements = bucket_policy.get('Statement', [])
+    if isinstance(statements, dict):
+        return _dumps(dict(bucket_policy, Statement=canonical_statement(statements)))
+    return _dumps(dict(bucket_policy, Statement=[canonical_statement(statement) for statement in statements]))
+
+
+def canonical_statement(statement: dict) -> dict:
+    """
+    Copy of the statement with every condition value list sorted, the rest of the statement is shared
+    """
+    condition = statement.get('Condition')
+    if not isinstance(condition, dict):
+        return statement
+    return dict(statement, Condition={
+        operator: {key: _sorted_values(values) for key, values in conditions.items()}
+        if isinstance(conditions, dict) else conditions
+        for operator, conditions in condition.items()})
+
+
+class PolicyStatement:
+    """
+    A statement of a bucket policy together with the digest of its canonical form
+    """
+    __slots__ = ('document', 'sid', 'digest')
+
+    def __init__(self, document: dict):
+        self.document = document
+        self.sid = document.get('Sid')
+        self.digest = hashlib.sha256(_dumps(_digest_form(document)).encode('utf-8')).hexdigest()
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, PolicyStatement) and self.digest == other.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return 'PolicyStatement(sid=%r, digest=%r)' % (self.sid, self.digest[:12])
+
+
+class BucketPolicy:
+    """
+    Parsed once from the document S3 returns, keeps every statement's digest
+    """
+    __slots__ = ('document', 'statements')
+
+    def __init__(self, document: dict, statements: List[PolicyStatement]):
+        self.document = document
+        self.statements = statements
+
+    @classmethod
+    def from_dict(cls, document: dict) -> 'BucketPolicy':
+        statements = document.get('Statement', [])
+        # a policy with a single statement may hold it without the list
+        if isinstance(statements, dict):
+            statements = [statements]
+        return cls(document, [PolicyStatement(statement) for statement in statements])
+
+    @classmethod
+    def from_json(cls, policy: str) -> 'BucketPolicy':
+        return cls.from_dict(jsoncodec.loads(policy))
+
+    def __iter__(self) -> Iterator[PolicyStatement]:
+        return iter(self.statements)
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    def statement(self, sid: str) -> Optional[PolicyStatement]:
+        return next((statement for statement in self.statements if statement.sid == sid), None)
+
+    def without(self, sid: str) -> 'BucketPolicy':
+        """
+        The policy without the statements with the Sid, this policy is left as it is
+        """
+        return self._with_statements([statement for statement in self.statements if statement.sid != sid])
+
+    def to_dict(self) -> dict:
+        return dict(self.document, Statement=[statement.document for statement in self.statements])
+
+    def serialize(self) -> str:
+        return serialize_bucket_policy(self.to_dict())
+
+    def _with_statements(self, statements: List[PolicyStatement]) -> 'BucketPolicy':
+        return BucketPolicy(self.document, statements)
+
+
+class PolicyDiff(NamedTuple):
+    added: List[PolicyStatement]
+    removed: List[PolicyStatement]
+    # (current, desired) pairs of statements with the same Sid
+    changed: List[Tuple[PolicyStatement, PolicyStatement]]
+
+    @property
+    def empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+    def summary(self) -> str:
+        return ', '.join('%s %s' % (kind, ', '.join(sids)) for kind, sids in (
+            ('added', [_label(statement) for statement in self.added]),
+            ('removed', [_label(statement) for statement in self.removed]),
+            ('changed', [_label(current) for current, _ in self.changed])) if sids) or 'no changes'
+
+
+def diff_policies(current: BucketPolicy, desired: BucketPolicy) -> PolicyDiff:
+    """
+    Structural diff of two policies in time linear in their number of statements.
+    Statements are matched by Sid, those without one by their digest, the order of the statements doesn't matter.
+    """
+    current_by_sid, current_unnamed = _by_sid(current)
+    desired_by_sid, desired_unnamed = _by_sid(desired)
+
+    added, removed, changed = [], [], []
+    for sid, statements in desired_by_sid.items():
+        previous = current_by_sid.get(sid, [])
+        if len(statements) == 1 and len(previous) == 1:
+            if statements[0].digest != previous[0].digest:
+                changed.append((previous[0], statements[0]))
+        else:
+            # statements sharing a Sid can only be matched by their digests
+            added.extend(_missing(statements, previous))
+            removed.extend(_missing(previous, statements))
+    for sid, statements in current_by_sid.items():
+        if sid not in desired_by_sid:
+            removed.extend(statements)
+
+    for digest, statement in desired_unnamed.items():
+        if digest not in current_unnamed:
+            added.append(statement)
+    for digest, statement in current_unnamed.items():
+        if digest not in desired_unnamed:
+            removed.append(statement)
+    return PolicyDiff(added, removed, changed)
+
+
+def _by_sid(policy: BucketPolicy) -> Tuple[Dict[str, List[PolicyStatement]], Dict[str, PolicyStatement]]:
+    by_sid, unnamed = {}, {}
+    for statement in policy:
+        if statement.sid is None:
+            unnamed[statement.digest] = statement
+        else:
+            by_sid.setdefault(statement.sid, []).append(statement)
+    return by_sid, unnamed
+
+
+def _missing(statements: List[PolicyStatement], others: List[PolicyStatement]) -> List[PolicyStatement]:
+    """
+    The statements without a counterpart with the same digest in others, counting duplicates
+    """
+    remaining = Counter(statement.digest for statement in others)
+    missing = []
+    for statement in statements:
+        if remaining[statement.digest]:
+            remaining[statement.digest] -= 1
+        else:
+            missing.append(statement)
+    return missing
+
+
+def _digest_form(statement: dict) -> dict:
+    canonical = canonical_statement(statement)
+    condition = canonical.get('Condition')
+    if not isinstance(condition, dict):
+        return canonical
+    return dict(canonical, Condition={
+        operator: {key: _address_space(values) for key, values in conditions.items()}
+        if _is_ip_operator(operator) and isinstance(conditions, dict) else conditions
+        for operator, conditions in condition.items()})
+
+
+def _is_ip_operator(operator: str) -> bool:
+    operator = operator.split(':', 1)[-1]
+    if operator.endswith('IfExists'):
+        operator = operator[:-len('IfExists')]
+    return operator in IP_CONDITION_OPERATORS
+
+
+def _address_space(values):
+    try:
+        return 'address-space:' + fingerprint_prefixes([values] if isinstance(values, str) else values)
+    except (TypeError, ValueError):
+        return values
+
+
+def _sorted_values(values):
+    if not isinstance(values, list):
+        return values
+    return sorted(values, key=_dumps)
+
+
+def _label(statement: PolicyStatement) -> str:
+    return statement.sid if statement.sid is not None else statement.digest[:12]
+
+
+def _dumps(document) -> str:
+    return jsoncodec.dumps(document, sort_keys=True)
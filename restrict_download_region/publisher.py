@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import tempfile
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from restrict_download_region.cidr import aggregate_prefixes, fingerprint_prefixes
+from restrict_download_region.ip_ranges import RegionIndex
+from restrict_download_region.snapshot import Snapshot, pack_snapshot
+from restrict_download_region.throttle import call_directly
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+MANIFEST_KEY = 'manifest.json'
+# without s3:ListBucket on the store S3 answers a missing key with AccessDenied instead of NoSuchKey
+ABSENT_KEY_ERROR_CODES = ('NoSuchKey', '404', 'AccessDenied', '403')
+
+
+class PrefixStore:
+    """
+    Where the publisher writes the per-region artifacts and the bucket functions read them.
+    get returns None when nothing is stored under the key.
+    """
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+
+class S3PrefixStore(PrefixStore):
+    """
+    call(operation, **kwargs) makes the S3 calls, so that they can be paced and retried
+    """
+
+    def __init__(self, s3_client, bucket_name: str, key_prefix: str = '', call: Callable = call_directly):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key_prefix = key_prefix
+        self.call = call
+
+    def get(self, key: str) -> Optional[bytes]:
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.call(self.s3_client.get_object, Bucket=self.bucket_name, Key=self.key_prefix + key)
+            return response['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ABSENT_KEY_ERROR_CODES:
+                return None
+            raise
+
+    def put(self, key: str, data: bytes):
+        self.call(self.s3_client.put_object, Bucket=self.bucket_name, Key=self.key_prefix + key, Body=data,
+                  ContentType='application/json' if key.endswith('.json') else 'application/octet-stream')
+
+
+class LocalPrefixStore(PrefixStore):
+    """
+    Keeps the artifacts as files, readers never see a partially written one
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+
+class RegionArtifact(NamedTuple):
+    """
+    The aggregated prefixes of one region and service, as of the feed's syncToken
+    """
+    region: str
+    service: str
+    sync_token: Optional[str]
+    fingerprint: str
+    prefixes: List[str]
+
+    def to_json(self) -> bytes:
+        return json.dumps({
+            'region': self.region,
+            'service': self.service,
+            'syncToken': self.sync_token,
+            'fingerprint': self.fingerprint,
+            'prefixes': self.prefixes
+        }, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_json(cls, data: bytes) -> 'RegionArtifact':
+        """
+        Raises ValueError when the artifact is malformed or its prefixes don't match its fingerprint
+        """
+        try:
+            document = json.loads(data)
+            artifact = cls(document['region'], document['service'], document['syncToken'],
+                           document['fingerprint'], document['prefixes'])
+        except (TypeError, KeyError) as e:
+            raise ValueError("malformed region artifact: %s" % e)
+        if fingerprint_prefixes(artifact.prefixes) != artifact.fingerprint:
+            raise ValueError("prefixes of the %s artifact don't match its fingerprint" % artifact.region)
+        return artifact
+
+    def to_snapshot(self) -> bytes:
+        return pack_snapshot(self.prefixes, self.sync_token)
+
+    @classmethod
+    def from_snapshot(cls, region: str, service: str, data: bytes) -> 'RegionArtifact':
+        """
+        Raises ValueError when the snapshot is malformed or fails its checksum
+        """
+        snapshot = Snapshot(data)
+        if snapshot.fingerprint is None:
+            raise ValueError("the %s snapshot has no fingerprint" % region)
+        return cls(region, service, snapshot.sync_token, snapshot.fingerprint, snapshot.prefixes())
+
+
+def artifact_key(region: str, service: str = 'AMAZON', extension: str = 'json') -> str:
+    return '%s/%s.%s' % (service, region, extension)
+
+
+def publish_region_artifacts(index: RegionIndex, store: PrefixStore, service: str = 'AMAZON') -> Dict[str, str]:
+    """
+    Writes the artifacts, as JSON and as binary snapshot, of every region in the feed, then the manifest listing every
+    region's fingerprint. Every artifact is rewritten so that it carries the syncToken
+    of the feed, which tells readers the publisher has processed a notification.
+    Returns the fingerprint of every published region.
+    """
+    fingerprints = {}
+    for region in index.regions():
+        prefixes = aggregate_prefixes(index.prefixes(region, service))
+        if not prefixes:
+            continue
+        fingerprint = fingerprint_prefixes(prefixes)
+        artifact = RegionArtifact(region, service, index.sync_token, fingerprint, prefixes)
+        store.put(artifact_key(region, service, 'snapshot'), artifact.to_snapshot())
+        store.put(artifact_key(region, service), artifact.to_json())
+        fingerprints[region] = fingerprint
+
+    # written last, so it never refers to an artifact that isn't there yet
+    store.put(MANIFEST_KEY, json.dumps({
+        'syncToken': index.sync_token,
+        'createDate': index.create_date,
+        'service': service,
+        'fingerprints': fingerprints
+    }, sort_keys=True).encode('utf-8'))
+    log.info("published %d regions for syncToken %s", len(fingerprints), index.sync_token)
+    return fingerprints
+
+
+def read_region_artifact(store: PrefixStore, region: str, service: str = 'AMAZON') -> Optional[RegionArtifact]:
+    """
+    Reads the binary snapshot, or the JSON artifact of publishers that don't write snapshots
+    """
+    data = store.get(artifact_key(region, service, 'snapshot'))
+    if data is not None:
+        return RegionArtifact.from_snapshot(region, service, data)
+    data = store.get(artifact_key(region, service))
+    return RegionArtifact.from_json(data) if data is not None else None
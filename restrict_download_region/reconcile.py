@@ -0,0 +1,143 @@
+"""
+Bucket updates delivered through an SQS queue.
+
+In queue mode the function subscribed to AmazonIpSpaceChanged only sends one message
+per bucket to the queue. The queue's event source mapping hands the messages to a
+consumer function in batches, at a bounded concurrency, and the consumer reports
+the messages of the buckets that failed so SQS redelivers only those.
+"""
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import restrict_download_region.jsoncodec as jsoncodec
+from restrict_download_region.fanout import FAILED, BucketResult
+from restrict_download_region.notification import (IpSpaceChanged, ip_space_changed_from_message,
+                                                   ip_space_changed_message, is_sync_token_newer)
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# most entries SendMessageBatch accepts in one call
+SEND_BATCH_SIZE = 10
+
+
+class BucketUpdate(NamedTuple):
+    """
+    One queued bucket update. request_type is Delete to remove the restriction,
+    notification the AmazonIpSpaceChanged notification the update was queued for.
+    """
+    message_id: str
+    bucket_name: str
+    request_type: Optional[str] = None
+    notification: Optional[IpSpaceChanged] = None
+
+
+class EnqueueError(Exception):
+    """
+    Raised after every message was sent when SQS rejected some of them
+    """
+
+    def __init__(self, bucket_names: List[str]):
+        self.bucket_names = bucket_names
+        super().__init__("failed to queue the updates of %d buckets: %s" % (
+            len(bucket_names), ", ".join(bucket_names)))
+
+
+def bucket_update_body(bucket_name: str, request_type: Optional[str] = None,
+                       notification: Optional[IpSpaceChanged] = None) -> str:
+    body = {'BucketName': bucket_name}
+    if request_type:
+        body['RequestType'] = request_type
+    if notification:
+        body['IpSpaceChanged'] = ip_space_changed_message(notification)
+    return jsoncodec.dumps(body)
+
+
+def parse_bucket_update(record: dict) -> BucketUpdate:
+    """
+    Raises ValueError for a record that is not a well formed bucket update
+    """
+    try:
+        message_id = record['messageId']
+        body = jsoncodec.loads(record['body'])
+        bucket_name = body['BucketName']
+    except (TypeError, KeyError) as e:
+        raise ValueError("not a bucket update: %r" % e)
+    if not isinstance(bucket_name, str) or not bucket_name:
+        raise ValueError("not a bucket name: %r" % bucket_name)
+
+    notification = None
+    if body.get('IpSpaceChanged') is not None:
+        notification = ip_space_changed_from_message(body['IpSpaceChanged'])
+        if notification is None:
+            raise ValueError("not an AmazonIpSpaceChanged notification: %r" % body['IpSpaceChanged'])
+    return BucketUpdate(message_id, bucket_name, body.get('RequestType'), notification)
+
+
+def parse_bucket_updates(records: Iterable[dict]) -> Tuple[List[BucketUpdate], List[str]]:
+    """
+    Returns the bucket updates of an SQS event and the message ids of the records that
+    could not be parsed. Those are reported as failed, so they end up in the dead-letter queue.
+    """
+    updates = []
+    malformed = []
+    for record in records:
+        try:
+            updates.append(parse_bucket_update(record))
+        except ValueError:
+            log.exception("malformed bucket update message %s", record.get('messageId'))
+            malformed.append(record.get('messageId'))
+    return updates, malformed
+
+
+def latest_updates(updates: List[BucketUpdate]) -> Dict[str, BucketUpdate]:
+    """
+    A bucket is updated once per batch, following the message that was queued last
+    """
+    latest = {}
+    for update in updates:
+        latest.pop(update.bucket_name, None)
+        latest[update.bucket_name] = update
+    return latest
+
+
+def newest_notification(updates: Iterable[BucketUpdate]) -> Optional[IpSpaceChanged]:
+    newest = None
+    for update in updates:
+        if update.notification and (newest is None or
+                                    is_sync_token_newer(update.notification.sync_token, newest.sync_token)):
+            newest = update.notification
+    return newest
+
+
+def batch_item_failures(updates: List[BucketUpdate], results: Dict[str, BucketResult],
+                        malformed: List[str]) -> dict:
+    """
+    The partial batch response of a function with the ReportBatchItemFailures response type.
+    Every message of a failed bucket is reported, including the ones its latest update superseded.
+    """
+    failed = list(malformed)
+    failed += [update.message_id for update in updates
+               if update.bucket_name not in results or results[update.bucket_name].status == FAILED]
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
+
+
+def enqueue_bucket_updates(sqs_client, queue_url: str, bucket_names: List[str],
+                           request_type: Optional[str] = None,
+                           notification: Optional[IpSpaceChanged] = None):
+    """
+    Sends one message per bucket, SEND_BATCH_SIZE at a time. Raises EnqueueError
+    naming the buckets whose messages SQS did not accept.
+    """
+    rejected = []
+    for start in range(0, len(bucket_names), SEND_BATCH_SIZE):
+        batch = bucket_names[start:start + SEND_BATCH_SIZE]
+        response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(index), 'MessageBody': bucket_update_body(bucket_name, request_type, notification)}
+            for index, bucket_name in enumerate(batch)])
+        for failure in response.get('Failed', []):
+            log.error("SQS rejected the update of %s: %s", batch[int(failure['Id'])], failure.get('Message'))
+            rejected.append(batch[int(failure['Id'])])
+    log.info("queued the updates of %d buckets", len(bucket_names) - len(rejected))
+    if rejected:
+        raise EnqueueError(rejected)
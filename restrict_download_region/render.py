@@ -0,0 +1,162 @@
+"""
+Renders the ip restriction policies of many buckets offline, for review before they are applied.
+
+    python -m restrict_download_region --ip-ranges ip-ranges.json manifest.jsonl > policies.jsonl
+
+The manifest names one bucket per line, either as "bucket,region" or as a JSON object
+{"bucket": ..., "region": ..., "policy": ...} carrying the bucket's current policy, as a
+document or as the string GetBucketPolicy returns. --current-policies names a directory
+of <bucket>.json files to take the current policies from instead. A bucket is merged into
+its current policy exactly like the function would, and written as one JSON line holding
+the policy or, with --diff, the statements that would be added, removed and changed.
+
+The feed is parsed and indexed once, every region's prefixes are aggregated once, and
+the manifest is read and written one line at a time, so memory doesn't grow with it.
+"""
+import argparse
+import copy
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO
+
+import restrict_download_region.jsoncodec as jsoncodec
+from restrict_download_region.cidr import aggregate_prefixes
+from restrict_download_region.ip_ranges import RegionIndex, iter_ip_ranges
+from restrict_download_region.policy import BucketPolicy, diff_policies
+from restrict_download_region.restrict_region import process_ip_restrict_policy
+
+FEED_CHUNK_SIZE = 64 * 1024
+
+
+class ManifestEntry(NamedTuple):
+    line_number: int
+    bucket_name: str
+    region: str
+    policy: Optional[dict] = None
+
+
+def load_index(path: str) -> RegionIndex:
+    with open(path, 'rb') as f:
+        return RegionIndex.from_ip_ranges(iter_ip_ranges(iter(lambda: f.read(FEED_CHUNK_SIZE), b'')))
+
+
+def parse_manifest_line(line_number: int, line: str) -> Optional[ManifestEntry]:
+    """
+    Returns None for blank lines and comments, raises ValueError for malformed ones
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if not line.startswith('{'):
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) != 2 or not all(fields):
+            raise ValueError("expected bucket,region")
+        return ManifestEntry(line_number, fields[0], fields[1])
+
+    entry = jsoncodec.loads(line)
+    bucket_name, region, policy = entry.get('bucket'), entry.get('region'), entry.get('policy')
+    if not isinstance(bucket_name, str) or not bucket_name or not isinstance(region, str) or not region:
+        raise ValueError("expected the bucket and region")
+    if isinstance(policy, str):
+        policy = jsoncodec.loads(policy)
+    if policy is not None and not isinstance(policy, dict):
+        raise ValueError("policy is not a policy document")
+    return ManifestEntry(line_number, bucket_name, region, policy)
+
+
+class PolicyRenderer:
+    """
+    Renders the policies of the manifest's buckets from one index of the feed
+    """
+
+    def __init__(self, index: RegionIndex, service: str = 'AMAZON', current_policies: Optional[str] = None):
+        self.index = index
+        self.service = service
+        self.current_policies = current_policies
+        # region -> aggregated prefixes, bounded by the number of regions
+        self._prefixes: Dict[str, List[str]] = {}
+
+    def region_prefixes(self, region: str) -> List[str]:
+        if region not in self._prefixes:
+            prefixes = self.index.prefixes(region, self.service)
+            if not prefixes:
+                raise ValueError("the feed has no %s prefixes in %s" % (self.service, region))
+            self._prefixes[region] = aggregate_prefixes(prefixes)
+        return self._prefixes[region]
+
+    def current_policy(self, entry: ManifestEntry) -> dict:
+        if entry.policy is not None:
+            return entry.policy
+        if self.current_policies:
+            path = os.path.join(self.current_policies, entry.bucket_name + '.json')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    policy = jsoncodec.loads(f.read())
+                # the output of aws s3api get-bucket-policy wraps the document in a string
+                return jsoncodec.loads(policy['Policy']) if 'Policy' in policy else policy
+        return {'Version': '2012-10-17', 'Statement': []}
+
+    def render(self, entry: ManifestEntry, diff: bool = False) -> dict:
+        current = self.current_policy(entry)
+        desired = copy.deepcopy(current)
+        changed = process_ip_restrict_policy(entry.bucket_name, None, desired, self.region_prefixes(entry.region))
+        rendered = {'bucket': entry.bucket_name, 'region': entry.region, 'changed': changed}
+        if not diff:
+            rendered['policy'] = desired
+            return rendered
+
+        policy_diff = diff_policies(BucketPolicy.from_dict(current), BucketPolicy.from_dict(desired))
+        rendered.update(summary=policy_diff.summary(),
+                        added=[statement.document for statement in policy_diff.added],
+                        removed=[statement.document for statement in policy_diff.removed],
+                        changed_statements=[{'current': before.document, 'desired': after.document}
+                                            for before, after in policy_diff.changed])
+        return rendered
+
+    def render_lines(self, lines: Iterable[str], diff: bool = False) -> Iterator[dict]:
+        """
+        Yields the rendered policy of every manifest line as soon as it was read. A line
+        that can't be rendered yields its line number and the error, the others still are.
+        """
+        for line_number, line in enumerate(lines, 1):
+            try:
+                entry = parse_manifest_line(line_number, line)
+                if entry is None:
+                    continue
+                yield self.render(entry, diff)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                yield {'line': line_number, 'error': str(e)}
+
+
+def write_json_lines(documents: Iterable[dict], out: TextIO) -> int:
+    """
+    Returns the number of errors written
+    """
+    errors = 0
+    for document in documents:
+        if 'error' in document:
+            errors += 1
+        out.write(jsoncodec.dumps(document))
+        out.write('\n')
+    return errors
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m restrict_download_region', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ip-ranges', required=True, help="path of a downloaded ip-ranges.json")
+    parser.add_argument('--current-policies', help="directory of the current policies, one <bucket>.json per bucket")
+    parser.add_argument('--diff', action='store_true', help="write the changes to the current policies")
+    parser.add_argument('--service', default='AMAZON', help="service of the allowed prefixes")
+    parser.add_argument('manifest', nargs='?', help="bucket manifest, stdin when it is left out")
+    args = parser.parse_args(argv)
+
+    renderer = PolicyRenderer(load_index(args.ip_ranges), args.service, args.current_policies)
+    if not args.manifest:
+        errors = write_json_lines(renderer.render_lines(sys.stdin, args.diff), sys.stdout)
+    else:
+        with open(args.manifest, encoding='utf-8') as f:
+            errors = write_json_lines(renderer.render_lines(f, args.diff), sys.stdout)
+    if errors:
+        sys.stderr.write("%d manifest lines could not be rendered\n" % errors)
+    return 1 if errors else 0
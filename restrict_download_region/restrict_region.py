@@ -1,22 +1,132 @@
 import os
 import logging
-import botocore
-import boto3
-import json
+import hashlib
 import restrict_download_region.cfnresponse as cfnresponse
+import restrict_download_region.jsoncodec as jsoncodec
+from restrict_download_region.budget import POLICY_SIZE_LIMIT, fit_statement_to_policy
+from restrict_download_region.cache import CacheEntry, IpRangesCache
+from restrict_download_region.cidr import aggregate_prefixes
+from restrict_download_region.fanout import (FAILED, UNCHANGED, BucketResult, BucketUpdateError, DiscoveryError,
+                                             apply_to_buckets, discover_bucket_names)
+from restrict_download_region.fetch import HedgedRequests, check_status, create_pool, cut_off, request_before
+from restrict_download_region.ip_ranges import RegionIndex, read_ip_prefixes_for_region
+from restrict_download_region.metrics import Metrics, stdout_sink
+from restrict_download_region.notification import (AppliedSyncTokens, IpSpaceChanged, is_sync_token_newer,
+                                                   parse_ip_space_changed)
+from restrict_download_region.policy import BucketPolicy, diff_policies, serialize_bucket_policy
+from restrict_download_region.throttle import AdaptiveConcurrency, ThrottleController, TokenBucket
+from restrict_download_region.writer import write_policy
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import urllib3
-from typing import List, Dict
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# the modules of the publisher, queue and drift scan modes are imported by the functions that use them,
+# so that a cold start of the other modes doesn't pay for them
+if TYPE_CHECKING:
+    from restrict_download_region.drift import DriftResult, ExpectedStatement
+    from restrict_download_region.publisher import PrefixStore
+    from restrict_download_region.reconcile import BucketUpdate
 
 # AWS_REGION should always be defined in the context of a lambda
 AWS_REGION = os.environ.get('AWS_REGION')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
+# multi-bucket mode, used when BUCKET_NAME is not set: buckets are taken from a comma
+# separated list, an SSM parameter holding such a list and/or a key=value bucket tag
+BUCKET_NAMES = os.environ.get('BUCKET_NAMES')
+BUCKET_NAMES_PARAMETER = os.environ.get('BUCKET_NAMES_PARAMETER')
+BUCKET_TAG = os.environ.get('BUCKET_TAG')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 8))
+# queue mode: multi-bucket runs triggered by AmazonIpSpaceChanged send one message per bucket to this
+# SQS queue, whose consumer (queue_handler) applies them in batches
+BUCKET_UPDATE_QUEUE_URL = os.environ.get('BUCKET_UPDATE_QUEUE_URL')
+# parse ip-ranges.json while it is being downloaded instead of loading the whole document
+STREAM_IP_RANGES = os.environ.get('STREAM_IP_RANGES', 'false').lower() == 'true'
+
+# ip-ranges.json downloads time out and are retried a bounded number of times. With IP_RANGES_HEDGE_PERCENTILE
+# a second request is sent when the first hasn't answered by that percentile of the latencies seen so far,
+# or after IP_RANGES_HEDGE_AFTER_MS until enough downloads were made. The whole download, retries, backoff
+# and body included, is given up after IP_RANGES_TOTAL_TIMEOUT, which fits into the 30 s Lambda timeout
+IP_RANGES_CONNECT_TIMEOUT = float(os.environ.get('IP_RANGES_CONNECT_TIMEOUT', 3))
+IP_RANGES_READ_TIMEOUT = float(os.environ.get('IP_RANGES_READ_TIMEOUT', 10))
+IP_RANGES_RETRIES = int(os.environ.get('IP_RANGES_RETRIES', 2))
+IP_RANGES_TOTAL_TIMEOUT = float(os.environ.get('IP_RANGES_TOTAL_TIMEOUT', 15))
+IP_RANGES_HEDGE_PERCENTILE = float(os.environ.get('IP_RANGES_HEDGE_PERCENTILE', 0))
+IP_RANGES_HEDGE_AFTER_MS = int(os.environ.get('IP_RANGES_HEDGE_AFTER_MS', 2000))
+# ask for ip-ranges.json gzip compressed, it is decompressed chunk by chunk as it arrives
+IP_RANGES_COMPRESSION = os.environ.get('IP_RANGES_COMPRESSION', 'true').lower() == 'true'
+
+# parsed region slices are cached here between invocations, an empty value disables the cache
+IP_RANGES_CACHE_DIR = os.environ.get('IP_RANGES_CACHE_DIR', '/tmp/ip-ranges-cache')
+IP_RANGES_CACHE_TTL = int(os.environ.get('IP_RANGES_CACHE_TTL', 24 * 60 * 60))
+# prefetch the feed and create the S3 client during the Lambda init phase
+PREFETCH_IP_RANGES = os.environ.get('PREFETCH_IP_RANGES', 'false').lower() == 'true'
+# per-region artifacts published by a single function in publisher mode (PUBLISH_PREFIXES) and read
+# by the bucket functions, stored in an S3 bucket or, for local runs, a directory
+PUBLISH_PREFIXES = os.environ.get('PUBLISH_PREFIXES', 'false').lower() == 'true'
+PREFIX_STORE_BUCKET = os.environ.get('PREFIX_STORE_BUCKET')
+PREFIX_STORE_KEY_PREFIX = os.environ.get('PREFIX_STORE_KEY_PREFIX', 'ip-prefixes/')
+PREFIX_STORE_DIR = os.environ.get('PREFIX_STORE_DIR')
+# log per-phase timings and sizes in CloudWatch Embedded Metric Format
+EMIT_METRICS = os.environ.get('EMIT_METRICS', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'RestrictDownloadRegion')
+# keeps the bucket policy under S3's size limit by merging (supernet) or dropping (drop) prefixes,
+# changing at most POLICY_BUDGET_MAX_RATIO of the address space of each ip version
+POLICY_SIZE_LIMIT = int(os.environ.get('POLICY_SIZE_LIMIT', POLICY_SIZE_LIMIT))
+POLICY_BUDGET_STRATEGY = os.environ.get('POLICY_BUDGET_STRATEGY', 'supernet')
+POLICY_BUDGET_MAX_RATIO = float(os.environ.get('POLICY_BUDGET_MAX_RATIO', 0.1))
+# re-read the bucket policy around every write to detect concurrent edits by other automation,
+# retrying the merge up to POLICY_WRITE_ATTEMPTS times and verifying again after POLICY_WRITE_SETTLE_MS
+VERIFY_POLICY_WRITES = os.environ.get('VERIFY_POLICY_WRITES', 'false').lower() == 'true'
+POLICY_WRITE_ATTEMPTS = int(os.environ.get('POLICY_WRITE_ATTEMPTS', 5))
+POLICY_WRITE_SETTLE_MS = int(os.environ.get('POLICY_WRITE_SETTLE_MS', 0))
+# S3 calls throttled by S3 are retried with jittered exponential backoff, and the calls of this function
+# are limited to S3_REQUEST_RATE per second (0 for no limit) with bursts of up to S3_REQUEST_BURST calls
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', 5))
+S3_BACKOFF_BASE_MS = int(os.environ.get('S3_BACKOFF_BASE_MS', 100))
+S3_BACKOFF_MAX_MS = int(os.environ.get('S3_BACKOFF_MAX_MS', 5000))
+S3_REQUEST_RATE = float(os.environ.get('S3_REQUEST_RATE', 0))
+S3_REQUEST_BURST = float(os.environ.get('S3_REQUEST_BURST', 0))
+# drift scans (scan_handler) repair the buckets that are missing, stale or drifted when DRIFT_REPAIR is set,
+# and stop starting buckets DRIFT_SCAN_DEADLINE_MARGIN_MS before the Lambda times out
+DRIFT_REPAIR = os.environ.get('DRIFT_REPAIR', 'false').lower() == 'true'
+DRIFT_SCAN_DEADLINE_MARGIN_MS = int(os.environ.get('DRIFT_SCAN_DEADLINE_MARGIN_MS', 10000))
+# custom resources are answered with FAILED this long before the Lambda times out
+RESPONSE_DEADLINE_MARGIN_MS = int(os.environ.get('RESPONSE_DEADLINE_MARGIN_MS', 5000))
+
+# the final response leaves this much of the remaining time unused, and gives each attempt at least a second
+RESPONSE_SEND_RESERVE_MS = 250
+RESPONSE_MIN_ATTEMPT_TIMEOUT = 1.0
+
+IP_RANGES_URL = 'https://ip-ranges.amazonaws.com/ip-ranges.json'
+IP_RANGES_CHUNK_SIZE = 64 * 1024
+IP_RANGES_CACHE_MAX_ENTRIES = 8
+IP_RANGES_CACHE_MAX_BYTES = 4 * 1024 * 1024
 
 POLICY_STATEMENT_ID = "DenyGetObjectForNonMatchingIp"
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
-http = urllib3.PoolManager()
+http = create_pool(IP_RANGES_CONNECT_TIMEOUT, IP_RANGES_READ_TIMEOUT, IP_RANGES_RETRIES)
+hedged_requests = HedgedRequests(IP_RANGES_HEDGE_PERCENTILE, IP_RANGES_HEDGE_AFTER_MS / 1000) \
+    if IP_RANGES_HEDGE_PERCENTILE else None
+ip_ranges_cache = IpRangesCache(IP_RANGES_CACHE_DIR, IP_RANGES_CACHE_TTL,
+                                IP_RANGES_CACHE_MAX_ENTRIES, IP_RANGES_CACHE_MAX_BYTES) \
+    if IP_RANGES_CACHE_DIR else None
+applied_sync_tokens = AppliedSyncTokens(os.path.join(IP_RANGES_CACHE_DIR, 'applied') if IP_RANGES_CACHE_DIR else None)
+metrics = Metrics(METRICS_NAMESPACE, stdout_sink if EMIT_METRICS else None)
+# shared by all buckets, in multi-bucket mode the calls in flight shrink below MAX_WORKERS while S3 throttles
+s3_throttle = ThrottleController(TokenBucket(S3_REQUEST_RATE, S3_REQUEST_BURST), AdaptiveConcurrency(MAX_WORKERS),
+                                 S3_MAX_ATTEMPTS, S3_BACKOFF_BASE_MS / 1000, S3_BACKOFF_MAX_MS / 1000)
+
+# boto3 clients are created once per container, see get_client
+_clients = {}
+# botocore's own retries are turned off for S3, whose throttled calls s3_throttle retries and paces
+CLIENT_RETRIES = {'s3': {'mode': 'standard', 'total_max_attempts': 1}}
+_clients_lock = threading.Lock()
 
 
 def handler(event: dict, context: dict):
@@ -24,39 +134,474 @@ def handler(event: dict, context: dict):
     This lambda will either be triggered by a CloudFormation Custom Resource
     creation or by a recurring SNS topic
     """
+    # the AmazonIpSpaceChanged message identifies the feed that triggered this run
+    notification = parse_ip_space_changed(event)
+
     # context manager for the case when this lambda is triggered by aws custom resource
     with handle_custom_resource_status_message(event, context) as custom_resource_request_type:
+        if PUBLISH_PREFIXES:
+            publish_prefixes(notification)
+            return
+        if not BUCKET_NAME and (BUCKET_NAMES or BUCKET_NAMES_PARAMETER or BUCKET_TAG):
+            # custom resources are answered only once their buckets are updated, so they aren't queued
+            if BUCKET_UPDATE_QUEUE_URL and not custom_resource_request_type:
+                enqueue_buckets(notification)
+            else:
+                restrict_buckets(custom_resource_request_type, notification)
+            return
         if not BUCKET_NAME:
             raise ValueError("BUCKET_NAME must be defined in enviroment variables")
 
-        s3_client = boto3.client('s3')
+        # duplicate or replayed notifications need neither the feed nor the bucket policy
+        if notification and applied_sync_tokens.is_applied(BUCKET_NAME, notification.sync_token):
+            log.info("syncToken %s was already applied to %s, nothing to do",
+                     notification.sync_token, BUCKET_NAME)
+            return
+
+        s3_client = get_client('s3')
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # the ip prefixes are not needed to remove the ip restriction policy, otherwise
+            # download them while the bucket policy is read, the two don't depend on each other
+            region_ip_prefixes_future = None
+            if custom_resource_request_type != 'Delete':
+                region_ip_prefixes_future = executor.submit(get_ip_prefixes_for_region, notification)
 
-        # get current bucket_policy from the s3 bucket
-        bucket_policy = get_bucket_policy(s3_client, BUCKET_NAME)
+            # get current bucket_policy from the s3 bucket
+            bucket_policy = get_bucket_policy(s3_client, BUCKET_NAME)
+
+            region_ip_prefixes = region_ip_prefixes_future.result() if region_ip_prefixes_future else None
 
         # add/update/remove ip restirction policy depending on the region_ip_prefixes
-        process_ip_restrict_policy(BUCKET_NAME,
-                                   custom_resource_request_type, bucket_policy)
+        apply_ip_restrict_policy(s3_client, BUCKET_NAME, custom_resource_request_type,
+                                 bucket_policy, region_ip_prefixes)
+
+        if notification:
+            applied_sync_tokens.put(BUCKET_NAME, notification.sync_token)
+
+
+def get_client(service_name: str):
+    """
+    Returns a boto3 client that is created on first use and reused by later invocations
+    of the same container. boto3 is imported here rather than at module level because
+    importing it dominates cold start time, and runs that exit early never need it.
+    """
+    with _clients_lock:
+        if service_name not in _clients:
+            import boto3
+            if service_name in CLIENT_RETRIES:
+                from botocore.config import Config
+                _clients[service_name] = boto3.client(service_name, config=Config(retries=CLIENT_RETRIES[service_name]))
+            else:
+                _clients[service_name] = boto3.client(service_name)
+        return _clients[service_name]
+
+
+def s3_call(operation, **kwargs):
+    """
+    Paces and retries an S3 call that is not measured by a metrics phase of its own
+    """
+    return s3_throttle.call(None, operation, **kwargs)
+
+
+def discover_buckets(s3_client) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Returns the buckets to restrict and the errors of the buckets for which that couldn't be decided
+    """
+    try:
+        return discover_bucket_names(s3_client, lambda: get_client('ssm'), BUCKET_NAMES, BUCKET_NAMES_PARAMETER,
+                                     BUCKET_TAG, AWS_REGION, MAX_WORKERS, s3_call), {}
+    except DiscoveryError as e:
+        return e.bucket_names, e.errors
+
+
+def get_prefix_store() -> Optional['PrefixStore']:
+    if PREFIX_STORE_DIR:
+        from restrict_download_region.publisher import LocalPrefixStore
+        return LocalPrefixStore(PREFIX_STORE_DIR)
+    if PREFIX_STORE_BUCKET:
+        from restrict_download_region.publisher import S3PrefixStore
+        return S3PrefixStore(get_client('s3'), PREFIX_STORE_BUCKET, PREFIX_STORE_KEY_PREFIX, s3_call)
+    return None
+
+
+def publish_prefixes(notification: Optional[IpSpaceChanged] = None) -> Dict[str, str]:
+    """
+    Publisher mode: downloads the feed once and writes the aggregated prefixes
+    of every region to the prefix store
+    """
+    from restrict_download_region.publisher import publish_region_artifacts
+
+    store = get_prefix_store()
+    if store is None:
+        raise ValueError("PREFIX_STORE_BUCKET or PREFIX_STORE_DIR must be defined to publish prefixes")
+
+    with metrics.phase('fetch') as phase:
+        url = notification.url if notification else IP_RANGES_URL
+        resp = request_ip_ranges(url, time.monotonic() + IP_RANGES_TOTAL_TIMEOUT, headers=ip_ranges_headers())
+        check_status(resp, url)
+        phase.set('Bytes', len(resp.data))
+        phase.set('TransferBytes', resp.tell())
+    with metrics.phase('parse'):
+        index = RegionIndex.from_document(jsoncodec.loads(resp.data))
+    if notification:
+        verify_ip_ranges_checksum(notification, index.sync_token, hashlib.md5(resp.data).hexdigest())
+
+    with metrics.phase('publish') as phase:
+        fingerprints = publish_region_artifacts(index, store)
+        phase.set('PrefixCount', len(fingerprints))
+    return fingerprints
+
+
+def restrict_buckets(custom_resource_request_type: Optional[str],
+                     notification: Optional[IpSpaceChanged]) -> Dict[str, BucketResult]:
+    """
+    Multi-bucket mode: fetches and aggregates the prefixes once, then updates the
+    policies of all buckets concurrently. Every bucket is attempted even if some fail.
+    """
+    s3_client = get_client('s3')
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the ip prefixes are not needed to remove the ip restriction policy. Custom resource
+        # runs always need them, so they are downloaded while the buckets are discovered
+        region_ip_prefixes_future = None
+        if custom_resource_request_type != 'Delete' and not notification:
+            region_ip_prefixes_future = executor.submit(get_ip_prefixes_for_region, notification)
+
+        bucket_names, discovery_errors = discover_buckets(s3_client)
+
+        # duplicate or replayed notifications only concern buckets that haven't applied them yet
+        if notification:
+            bucket_names = [bucket_name for bucket_name in bucket_names
+                            if not applied_sync_tokens.is_applied(bucket_name, notification.sync_token)]
+        if not bucket_names and not discovery_errors:
+            log.info("no buckets to update")
+            return {}
+
+        region_ip_prefixes = None
+        if region_ip_prefixes_future:
+            region_ip_prefixes = region_ip_prefixes_future.result()
+        elif custom_resource_request_type != 'Delete' and bucket_names:
+            region_ip_prefixes = get_ip_prefixes_for_region(notification)
+
+    results = apply_to_buckets(
+        bucket_names,
+        lambda bucket_name: restrict_bucket(s3_client, bucket_name, custom_resource_request_type,
+                                            region_ip_prefixes),
+        MAX_WORKERS)
+    # buckets that might have to be restricted fail the run after all others were updated
+    for bucket_name, error in discovery_errors.items():
+        results[bucket_name] = BucketResult(bucket_name, FAILED, error)
+
+    if notification:
+        for result in results.values():
+            if result.status != FAILED:
+                applied_sync_tokens.put(result.bucket_name, notification.sync_token)
+    if any(result.status == FAILED for result in results.values()):
+        raise BucketUpdateError(results)
+    return results
+
+
+def enqueue_buckets(notification: Optional[IpSpaceChanged]) -> List[str]:
+    """
+    Queue mode: discovers the buckets like restrict_buckets and queues an update for each one
+    that hasn't applied the notification yet, returns the queued buckets
+    """
+    from restrict_download_region.reconcile import enqueue_bucket_updates
+
+    bucket_names, discovery_errors = discover_buckets(get_client('s3'))
+    if notification:
+        bucket_names = [bucket_name for bucket_name in bucket_names
+                        if not applied_sync_tokens.is_applied(bucket_name, notification.sync_token)]
+    if bucket_names:
+        enqueue_bucket_updates(get_client('sqs'), BUCKET_UPDATE_QUEUE_URL, bucket_names, notification=notification)
+    if discovery_errors:
+        raise DiscoveryError(bucket_names, discovery_errors)
+    return bucket_names
+
+
+def queue_handler(event: dict, context: dict) -> dict:
+    """
+    Consumer of the bucket update queue. A batch shares one download of the feed and its
+    buckets are updated concurrently. Returns the messages of the buckets that failed as
+    batchItemFailures, the event source mapping must have the ReportBatchItemFailures
+    response type for SQS to redeliver only those.
+    """
+    from restrict_download_region.reconcile import batch_item_failures, parse_bucket_updates
+
+    updates, malformed = parse_bucket_updates(event.get('Records') or [])
+    results = reconcile_buckets(updates) if updates else {}
+    response = batch_item_failures(updates, results, malformed)
+    log.info("%d of %d messages failed", len(response['batchItemFailures']), len(updates) + len(malformed))
+    return response
+
 
-        # update with newly modified bucket policy
-        update_bucket_policy(s3_client, BUCKET_NAME, bucket_policy)
+def reconcile_buckets(updates: List['BucketUpdate']) -> Dict[str, BucketResult]:
+    """
+    Applies the latest update of every bucket in the batch. The feed is fetched once, for the
+    newest notification in the batch; when that fails, every bucket that needed it fails.
+    """
+    from restrict_download_region.reconcile import latest_updates, newest_notification
+
+    latest = latest_updates(updates)
+    results = {}
+    pending = {}
+    for bucket_name, update in latest.items():
+        # duplicate or replayed messages, e.g. redelivered after a partial batch failure
+        if update.notification and applied_sync_tokens.is_applied(bucket_name, update.notification.sync_token):
+            results[bucket_name] = BucketResult(bucket_name, UNCHANGED)
+        else:
+            pending[bucket_name] = update
+
+    region_ip_prefixes = None
+    if any(update.request_type != 'Delete' for update in pending.values()):
+        try:
+            region_ip_prefixes = get_ip_prefixes_for_region(newest_notification(pending.values()))
+        except Exception as e:
+            log.exception("failed to fetch the ip prefixes of %s", AWS_REGION)
+            for bucket_name, update in list(pending.items()):
+                if update.request_type != 'Delete':
+                    results[bucket_name] = BucketResult(bucket_name, FAILED, str(e))
+                    del pending[bucket_name]
+
+    if pending:
+        s3_client = get_client('s3')
+        results.update(apply_to_buckets(
+            list(pending),
+            lambda bucket_name: restrict_bucket(s3_client, bucket_name, pending[bucket_name].request_type,
+                                                region_ip_prefixes),
+            MAX_WORKERS))
+
+    for bucket_name, update in pending.items():
+        if update.notification and results[bucket_name].status != FAILED:
+            applied_sync_tokens.put(bucket_name, update.notification.sync_token)
+    return results
+
+
+def scan_handler(event: dict, context) -> dict:
+    """
+    Verifies the restriction of every bucket found like in multi-bucket mode, e.g. on a schedule,
+    catching edited policies and runs that failed where nobody was told, like on the SNS path.
+    {"repair": true} in the event overrides DRIFT_REPAIR. Returns the counts of every status and
+    the buckets that were not current.
+    """
+    from restrict_download_region.drift import CURRENT, ERROR, DriftResult, ExpectedStatement, scan_buckets
+
+    repair = event.get('repair', DRIFT_REPAIR) if isinstance(event, dict) else DRIFT_REPAIR
+    s3_client = get_client('s3')
+    bucket_names, discovery_errors = ([BUCKET_NAME], {}) if BUCKET_NAME else discover_buckets(s3_client)
+    region_ip_prefixes = get_ip_prefixes_for_region()
+    expected = ExpectedStatement(lambda bucket_name: generate_ip_address_policy(bucket_name, region_ip_prefixes),
+                                 region_ip_prefixes)
+
+    time_left = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        def time_left() -> float:
+            return context.get_remaining_time_in_millis() / 1000
 
+    report = scan_buckets(bucket_names,
+                          lambda bucket_name: scan_bucket(s3_client, bucket_name, expected, region_ip_prefixes, repair),
+                          MAX_WORKERS, time_left, DRIFT_SCAN_DEADLINE_MARGIN_MS / 1000)
+    for bucket_name, error in discovery_errors.items():
+        report.results[bucket_name] = DriftResult(bucket_name, ERROR, error)
+    for result in report.results.values():
+        if result.status != CURRENT:
+            log.warning("%s: %s %s%s", result.bucket_name, result.status, result.detail or '',
+                        ", repaired" if result.repaired else '')
+    return report.to_dict()
 
-def get_ip_prefixes_for_region() -> List[str]:
+
+def scan_bucket(s3_client, bucket_name: str, expected: 'ExpectedStatement', region_ip_prefixes: List[str],
+                repair: bool) -> 'DriftResult':
+    from restrict_download_region.drift import CURRENT, ERROR, REPAIRABLE, STALE, DriftResult, classify_policy
+
+    bucket_policy = get_bucket_policy(s3_client, bucket_name)
+    status, detail = classify_policy(bucket_name, bucket_policy, expected)
+    if status == STALE and not process_ip_restrict_policy(bucket_name, None, copy.deepcopy(bucket_policy),
+                                                          region_ip_prefixes):
+        # the prefixes were fitted into the policy size limit, which a run would write the same way
+        status, detail = CURRENT, None
+    if not repair or status not in REPAIRABLE:
+        return DriftResult(bucket_name, status, detail)
+    try:
+        apply_ip_restrict_policy(s3_client, bucket_name, None, bucket_policy, region_ip_prefixes)
+    except Exception as e:
+        log.exception("failed to repair %s", bucket_name)
+        return DriftResult(bucket_name, ERROR, "%s, repair failed: %s" % (detail, e))
+    return DriftResult(bucket_name, status, detail, repaired=True)
+
+
+def restrict_bucket(s3_client, bucket_name: str, custom_resource_request_type: Optional[str],
+                    region_ip_prefixes: Optional[List[str]]) -> bool:
+    """
+    Read-modify-write of a single bucket's policy, returns whether the policy changed
+    """
+    bucket_policy = get_bucket_policy(s3_client, bucket_name)
+    return apply_ip_restrict_policy(s3_client, bucket_name, custom_resource_request_type,
+                                    bucket_policy, region_ip_prefixes)
+
+
+def apply_ip_restrict_policy(s3_client, bucket_name: str, custom_resource_request_type: Optional[str],
+                             bucket_policy: dict, region_ip_prefixes: Optional[List[str]]) -> bool:
+    """
+    Merges the ip restriction into the bucket policy that was read and writes it back,
+    unless nothing relevant to this bucket changed. Returns whether the policy changed.
+    """
+    def merge(policy: dict) -> bool:
+        with metrics.phase('merge', BucketName=bucket_name):
+            return process_ip_restrict_policy(bucket_name, custom_resource_request_type, policy, region_ip_prefixes)
+
+    if not VERIFY_POLICY_WRITES:
+        policy_changed = merge(bucket_policy)
+        if policy_changed:
+            update_bucket_policy(s3_client, bucket_name, bucket_policy)
+        return policy_changed
+
+    with metrics.phase('write_policy', BucketName=bucket_name):
+        return write_policy(lambda: get_bucket_policy(s3_client, bucket_name), merge,
+                            lambda policy: update_bucket_policy(s3_client, bucket_name, policy),
+                            bucket_policy, POLICY_WRITE_ATTEMPTS, settle=POLICY_WRITE_SETTLE_MS / 1000)
+
+
+def get_ip_prefixes_for_region(notification: Optional[IpSpaceChanged] = None) -> List[str]:
+    """
+    Returns the aggregated AMAZON prefixes of AWS_REGION. When the run was triggered by an
+    AmazonIpSpaceChanged notification, the feed is downloaded from the advertised url
+    and verified against the advertised md5.
+    """
     if not AWS_REGION:
         raise ValueError("AWS_REGION must be defined in environment variables.")
 
-    # generate new policy statement based on data from AWS
-    resp = http.request('GET', 'https://ip-ranges.amazonaws.com/ip-ranges.json')
-    all_ip_prefixes = json.loads(resp.data.decode('utf-8'))
-    return ip_prefixes_for_region(all_ip_prefixes['prefixes'], 'ip_prefix', AWS_REGION) + \
-        ip_prefixes_for_region(all_ip_prefixes['ipv6_prefixes'], 'ipv6_prefix', AWS_REGION)
+    cached = ip_ranges_cache.get(AWS_REGION) if ip_ranges_cache else None
+    if cached and notification and not is_sync_token_newer(notification.sync_token, cached.sync_token):
+        log.debug("cached syncToken %s is at least as new as the notification", cached.sync_token)
+        return cached.prefixes
+    if cached and notification:
+        # the cache is known to be stale, don't let the cdn answer 304 for it
+        cached = None
+
+    store = get_prefix_store()
+    if store:
+        from restrict_download_region.publisher import read_region_artifact
+
+        try:
+            with metrics.phase('fetch_artifact') as phase:
+                artifact = read_region_artifact(store, AWS_REGION)
+                phase.set('PrefixCount', len(artifact.prefixes) if artifact else 0)
+        except Exception:
+            # the feed is the source of truth, a store that can't be read only costs the download
+            log.exception("unreadable prefix artifact for %s, downloading ip-ranges.json", AWS_REGION)
+            artifact = None
+        # the publisher may not have processed the notification yet
+        if artifact and not (notification and is_sync_token_newer(notification.sync_token, artifact.sync_token)):
+            return artifact.prefixes
+        log.info("no prefix artifact for syncToken %s yet, downloading ip-ranges.json",
+                 notification.sync_token if notification else None)
+
+    # revalidate the cached region slice so an unchanged feed costs a 304 and no re-parse
+    headers = ip_ranges_headers(cached)
+    url = notification.url if notification else IP_RANGES_URL
+    md5 = hashlib.md5()
+    deadline = time.monotonic() + IP_RANGES_TOTAL_TIMEOUT
+
+    # generate new policy statement based on data from AWS. When streaming, the fetch
+    # phase ends with the response headers and the body is downloaded while it is parsed
+    with metrics.phase('fetch') as phase:
+        resp = request_ip_ranges(url, deadline, headers=headers, preload_content=not STREAM_IP_RANGES)
+        check_status(resp, url, not_modified=cached is not None)
+        if not STREAM_IP_RANGES:
+            phase.set('Bytes', len(resp.data))
+            phase.set('TransferBytes', resp.tell())
+    try:
+        if cached and resp.status == 304:
+            log.debug("ip-ranges.json not modified since syncToken %s", cached.sync_token)
+            ip_ranges_cache.touch(cached)
+            return cached.prefixes
+
+        if STREAM_IP_RANGES:
+            # filter the region's prefixes while the response body is still arriving,
+            # so only one chunk of the multi-megabyte document is held in memory at a time
+            with metrics.phase('parse') as phase, cut_off(resp, url, deadline):
+                chunks = _observed(resp.stream(IP_RANGES_CHUNK_SIZE), md5 if notification else None, phase)
+                sync_token, region_ip_prefixes = read_ip_prefixes_for_region(chunks, AWS_REGION)
+                phase.set('PrefixCount', len(region_ip_prefixes))
+                phase.set('TransferBytes', resp.tell())
+        else:
+            if notification:
+                md5.update(resp.data)
+            with metrics.phase('parse'):
+                all_ip_prefixes = jsoncodec.loads(resp.data)
+            sync_token = all_ip_prefixes.get('syncToken')
+            with metrics.phase('filter') as phase:
+                region_ip_prefixes = ip_prefixes_for_region(all_ip_prefixes['prefixes'], 'ip_prefix', AWS_REGION) + \
+                    ip_prefixes_for_region(all_ip_prefixes['ipv6_prefixes'], 'ipv6_prefix', AWS_REGION)
+                phase.set('PrefixCount', len(region_ip_prefixes))
+    finally:
+        resp.release_conn()
+
+    if notification:
+        verify_ip_ranges_checksum(notification, sync_token, md5.hexdigest())
+
+    # merge adjacent and overlapping networks to keep the policy under S3's size limit
+    with metrics.phase('aggregate') as phase:
+        region_ip_prefixes = aggregate_prefixes(region_ip_prefixes)
+        phase.set('PrefixCount', len(region_ip_prefixes))
+
+    if ip_ranges_cache and sync_token:
+        ip_ranges_cache.put(CacheEntry(AWS_REGION, sync_token, region_ip_prefixes,
+                                       etag=resp.headers.get('ETag'),
+                                       last_modified=resp.headers.get('Last-Modified')))
+    return region_ip_prefixes
+
+
+def ip_ranges_headers(cached: Optional[CacheEntry] = None) -> Dict[str, str]:
+    """
+    urllib3 decodes a gzip response as it is read, so the md5 is still taken over the feed itself
+    """
+    headers = {'Accept-Encoding': 'gzip'} if IP_RANGES_COMPRESSION else {}
+    if cached:
+        headers.update(cached.conditional_headers())
+    return headers
+
+
+def request_ip_ranges(url: str, deadline: float, **kwargs) -> urllib3.HTTPResponse:
+    if hedged_requests:
+        return hedged_requests.request(http, url, deadline, **kwargs)
+    return request_before(http, url, deadline, **kwargs)
+
+
+def verify_ip_ranges_checksum(notification: IpSpaceChanged, sync_token: Optional[str], md5_digest: str):
+    """
+    Raises when the downloaded feed is not the one the notification advertised,
+    unless a newer feed has been published in the meantime
+    """
+    if md5_digest == notification.md5:
+        return
+    if is_sync_token_newer(sync_token, notification.sync_token):
+        log.warning("downloaded syncToken %s is newer than the notification's %s, skipping md5 check",
+                    sync_token, notification.sync_token)
+        return
+    raise ValueError("md5 %s of ip-ranges.json with syncToken %s does not match the advertised md5 %s"
+                     " of syncToken %s" % (md5_digest, sync_token, notification.md5, notification.sync_token))
+
+
+def _observed(chunks: Iterable[bytes], md5, phase) -> Iterator[bytes]:
+    for chunk in chunks:
+        if md5 is not None:
+            md5.update(chunk)
+        phase.add('Bytes', len(chunk))
+        yield chunk
 
 
 def get_bucket_policy(s3_client, bucket_name: str) -> dict:
+    from botocore.exceptions import ClientError
+
     try:
-        return json.loads(s3_client.get_bucket_policy(Bucket=bucket_name)['Policy'])
-    except botocore.exceptions.ClientError as e:
+        with metrics.phase('get_bucket_policy', BucketName=bucket_name) as phase:
+            policy = s3_throttle.call(phase, s3_client.get_bucket_policy, Bucket=bucket_name)['Policy']
+            phase.set('PolicySize', len(policy))
+        return jsoncodec.loads(policy)
+    except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchBucketPolicy':
             return {
                 "Version": "2012-10-17",
@@ -68,23 +613,49 @@ def get_bucket_policy(s3_client, bucket_name: str) -> dict:
 
 def process_ip_restrict_policy(bucket_name: str,
                                custom_resource_request_type: str,
-                               bucket_policy: dict):
+                               bucket_policy: dict,
+                               region_ip_prefixes: Optional[List[str]] = None) -> bool:
     """
     Modifies the passed in bucket_policy and decides whether
-    to add or remove the IP restriction policy
+    to add or remove the IP restriction policy.
+    The region_ip_prefixes are fetched when they are not passed in.
+    Returns False, leaving bucket_policy untouched, when the policy already
+    restricts downloads to exactly the same address space.
     """
-    # filter out the previously set IP filtering policy
-    bucket_policy['Statement'] = [statement for statement in bucket_policy['Statement']
-                                  if (POLICY_STATEMENT_ID != statement.get("Sid"))]
+    current_policy = BucketPolicy.from_dict(bucket_policy)
 
     # skip adding new policy if deleting the custom resource
     if custom_resource_request_type == 'Delete':
-        return
+        # filter out the previously set IP filtering policy
+        desired_policy = current_policy.without(POLICY_STATEMENT_ID)
+        bucket_policy['Statement'] = desired_policy.to_dict()['Statement']
+        return len(desired_policy) != len(current_policy)
 
     # add new IP address policy statement
-    region_ip_prefixes = get_ip_prefixes_for_region()
+    if region_ip_prefixes is None:
+        region_ip_prefixes = get_ip_prefixes_for_region()
     new_ip_policy_statement = generate_ip_address_policy(bucket_name, region_ip_prefixes)
-    bucket_policy['Statement'].append(new_ip_policy_statement)
+    statements = current_policy.without(POLICY_STATEMENT_ID).to_dict()['Statement']
+    statements.append(new_ip_policy_statement)
+
+    # the statement has to fit in the policy next to the statements that are kept
+    with metrics.phase('budget', BucketName=bucket_name) as phase:
+        report = fit_statement_to_policy(dict(bucket_policy, Statement=statements),
+                                         new_ip_policy_statement['Condition']['NotIpAddress']['aws:SourceIp'],
+                                         POLICY_SIZE_LIMIT, POLICY_BUDGET_STRATEGY, POLICY_BUDGET_MAX_RATIO)
+        phase.set('PolicySize', report.size)
+        phase.set('PrefixCount', report.prefix_count)
+
+    # AmazonIpSpaceChanged fires for changes in any region, most of which don't affect this bucket
+    diff = diff_policies(current_policy, BucketPolicy.from_dict(dict(bucket_policy, Statement=statements)))
+    if diff.empty:
+        log.info("ip restriction policy of %s is already up to date", bucket_name)
+        return False
+    log.info("policy of %s: %s", bucket_name, diff.summary())
+
+    # replace the previously set IP filtering policy
+    bucket_policy['Statement'] = statements
+    return True
 
 
 def generate_ip_address_policy(bucket_name: str, region_ip_prefixes: List[str]):
@@ -95,7 +666,8 @@ def generate_ip_address_policy(bucket_name: str, region_ip_prefixes: List[str]):
         'Action': 's3:GetObject',
         'Resource': 'arn:aws:s3:::'+bucket_name+'/*',
         'Condition': {
-            'NotIpAddress': {'aws:SourceIp': region_ip_prefixes},
+            # a copy, fitting the policy size limit shrinks it in place and the prefixes are shared by all buckets
+            'NotIpAddress': {'aws:SourceIp': list(region_ip_prefixes)},
             # allows any S3 VPC Endpoint to bypass the ip restriction.
             # cross region gateway endpoints are not supported in AWS so any S3 VPC endpoint
             # traffic is implicitly same region.
@@ -107,9 +679,14 @@ def generate_ip_address_policy(bucket_name: str, region_ip_prefixes: List[str]):
 def update_bucket_policy(s3_client, bucket_name: str, bucket_policy: dict):
     # update existing policy or delete policy completely if there are no longer any policies left
     if bucket_policy['Statement']:
-        s3_client.put_bucket_policy(Bucket=bucket_name, Policy=json.dumps(bucket_policy))
+        with metrics.phase('serialize', BucketName=bucket_name) as phase:
+            policy = serialize_bucket_policy(bucket_policy)
+            phase.set('PolicySize', len(policy))
+        with metrics.phase('put_bucket_policy', BucketName=bucket_name) as phase:
+            s3_throttle.call(phase, s3_client.put_bucket_policy, Bucket=bucket_name, Policy=policy)
     else:
-        s3_client.delete_bucket_policy(Bucket=bucket_name)
+        with metrics.phase('delete_bucket_policy', BucketName=bucket_name) as phase:
+            s3_throttle.call(phase, s3_client.delete_bucket_policy, Bucket=bucket_name)
 
 
 def ip_prefixes_for_region(ip_ranges: List[Dict], prefix_key: str, region: str) -> List[str]:
@@ -117,22 +694,140 @@ def ip_prefixes_for_region(ip_ranges: List[Dict], prefix_key: str, region: str)
         item["service"] == "AMAZON" and item["region"] == region)]
 
 
+class CustomResourceResponder:
+    """
+    Sends at most one response to a custom resource request. A watchdog answers FAILED
+    shortly before the Lambda times out, otherwise CloudFormation would wait up to an
+    hour for a response from an invocation that was killed.
+    """
+
+    def __init__(self, event: dict, context, margin_ms: int):
+        self.event = event
+        self.context = context
+        self.margin_ms = margin_ms
+        self._responded = False
+        self._lock = threading.Lock()
+        self._watchdog = None
+
+    def start_watchdog(self):
+        get_remaining_time_in_millis = getattr(self.context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time_in_millis is None:
+            return
+        remaining_ms = get_remaining_time_in_millis()
+        # leave short timeouts at least half of their time to do the work
+        margin_ms = min(self.margin_ms, remaining_ms // 2)
+        self._watchdog = threading.Timer((remaining_ms - margin_ms) / 1000, self._on_deadline, (margin_ms,))
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def cancel_watchdog(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+
+    def respond(self, status: str, **kwargs) -> bool:
+        """
+        Returns whether the response was delivered, False as well when one was already sent
+        """
+        with self._lock:
+            if self._responded:
+                log.warning("a response was already sent, not sending %s", status)
+                return False
+            self._responded = True
+        with metrics.phase('cfnresponse_send'):
+            delivered = cfnresponse.send(self.event, self.context, status, {'Data': ''}, **kwargs)
+        if not delivered:
+            log.error("CloudFormation did not receive the %s response", status)
+        return delivered
+
+    def send_budget(self) -> dict:
+        """
+        Timeout and retries of a response that arrives before the Lambda times out,
+        cfnresponse's defaults when the remaining time is unknown
+        """
+        get_remaining_time_in_millis = getattr(self.context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time_in_millis is None:
+            return {}
+        return response_send_budget(get_remaining_time_in_millis())
+
+    def _on_deadline(self, margin_ms: int):
+        reason = "Timed out: the policy update did not finish %d ms before the Lambda timeout. " \
+                 "See the details in CloudWatch Log Stream: %s" % (
+                     margin_ms, getattr(self.context, 'log_stream_name', None))
+        log.error(reason)
+        # the response has to arrive before the Lambda is killed
+        self.respond(cfnresponse.FAILED, reason=reason, timeout=margin_ms / 2000, retries=0)
+
+
+def response_send_budget(remaining_ms: int) -> dict:
+    """
+    The most retries, up to cfnresponse's default, whose attempts and backoff all fit into the remaining
+    time with at least RESPONSE_MIN_ATTEMPT_TIMEOUT per attempt, and the longest timeout that still fits
+    """
+    seconds = max(0, remaining_ms - RESPONSE_SEND_RESERVE_MS) / 1000
+    for retries in range(cfnresponse.DEFAULT_RETRIES, 0, -1):
+        backoff = sum(cfnresponse.DEFAULT_BACKOFF * 2 ** attempt for attempt in range(retries))
+        # the timeout applies to the connect and to the read
+        timeout = (seconds - backoff) / (2 * (retries + 1))
+        if timeout >= RESPONSE_MIN_ATTEMPT_TIMEOUT:
+            return {'timeout': min(cfnresponse.DEFAULT_TIMEOUT, timeout), 'retries': retries}
+    return {'timeout': min(cfnresponse.DEFAULT_TIMEOUT, max(0.1, seconds / 2)), 'retries': 0}
+
+
 @contextmanager
 def handle_custom_resource_status_message(event: dict, context: dict):
     custom_resource_request_type = event.get('RequestType')
+    responder = None
+    if custom_resource_request_type:
+        responder = CustomResourceResponder(event, context, RESPONSE_DEADLINE_MARGIN_MS)
+        responder.start_watchdog()
     try:
         yield custom_resource_request_type
 
         # when custom_resource_request_type is None, this lambda is being
         # triggered by Amazon's SNS topic because IP prefixes have updated
-        if custom_resource_request_type:
-            cfnresponse.send(event, context, cfnresponse.SUCCESS, {'Data': ''})
+        if responder:
+            responder.cancel_watchdog()
+            responder.respond(cfnresponse.SUCCESS, **responder.send_budget())
         else:
             log.debug("was not a custom resource. No messages sent")
     except Exception as e:
         log.exception(e)
-        if custom_resource_request_type:
-            cfnresponse.send(event, context, cfnresponse.FAILED, {'Data': ''})
+        if responder:
+            responder.cancel_watchdog()
+            responder.respond(cfnresponse.FAILED, **responder.send_budget())
         else:
             log.debug("was not a custom resource. No messages sent")
         raise
+
+
+def warm_up():
+    """
+    Runs during the Lambda init phase when PREFETCH_IP_RANGES is set: imports boto3,
+    creates the S3 client and prefetches this region's prefixes into the cache, leaving
+    the first invocation only a conditional GET to revalidate them
+    """
+    try:
+        get_client('s3')
+        get_ip_prefixes_for_region()
+    except Exception:
+        log.exception("warm up failed, the first invocation will fetch ip-ranges.json itself")
+
+
+def reset_connections():
+    """
+    Connections captured in a SnapStart snapshot are dead after it is restored
+    """
+    http.clear()
+    with _clients_lock:
+        _clients.clear()
+
+
+if PREFETCH_IP_RANGES:
+    warm_up()
+    try:
+        from snapshot_restore_py import register_after_restore
+    except ImportError:
+        # not running with SnapStart
+        pass
+    else:
+        register_after_restore(reset_connections)
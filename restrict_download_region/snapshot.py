@@ -0,0 +1,139 @@
+"""
+Compact binary snapshot of a prefix set.
+
+    header    magic "RDRS", format version, flags, IPv4 count, IPv6 count (little-endian),
+              syncToken (32 bytes, NUL padded), sha256 of the payload, prefix fingerprint
+    payload   IPv4 network addresses   uint32 per network
+              IPv4 prefix lengths      uint8 per network, padded to 8 bytes
+              IPv6 network addresses   two uint64 per network, high then low half
+              IPv6 prefix lengths      uint8 per network
+
+Loading maps the file and views the arrays in place, nothing is allocated per network
+until the prefixes are converted back to the CIDR strings they were built from.
+"""
+import hashlib
+import ipaddress
+import mmap
+import struct
+import sys
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+from restrict_download_region.cidr import fingerprint_prefixes
+
+MAGIC = b'RDRS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII32s32s32s')
+SYNC_TOKEN_SIZE = 32
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot held in a buffer, such as bytes or a memory map
+    """
+
+    def __init__(self, buffer, verify: bool = True):
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise ValueError("snapshot is truncated")
+        magic, version, _, ipv4_count, ipv6_count, sync_token, checksum, fingerprint = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("not a prefix snapshot")
+        if version != FORMAT_VERSION:
+            raise ValueError("unsupported snapshot format version %d" % version)
+
+        ipv4_end = HEADER.size + 4 * ipv4_count
+        ipv4_lengths_end = ipv4_end + ipv4_count
+        ipv6_start = _aligned(ipv4_lengths_end)
+        ipv6_end = ipv6_start + 16 * ipv6_count
+        if len(view) != ipv6_end + ipv6_count:
+            raise ValueError("snapshot size does not match its header")
+        if verify and hashlib.sha256(view[HEADER.size:]).digest() != checksum:
+            raise ValueError("snapshot checksum mismatch")
+
+        self.sync_token = sync_token.rstrip(b'\0').decode('ascii') or None
+        self.checksum = checksum.hex()
+        self.fingerprint = fingerprint.hex() if any(fingerprint) else None
+        self.size = len(view)
+        self._ipv4_networks = _uints(view[HEADER.size:ipv4_end], 'I')
+        self._ipv4_lengths = view[ipv4_end:ipv4_lengths_end]
+        self._ipv6_halves = _uints(view[ipv6_start:ipv6_end], 'Q')
+        self._ipv6_lengths = view[ipv6_end:]
+
+    def __len__(self) -> int:
+        return len(self._ipv4_lengths) + len(self._ipv6_lengths)
+
+    def ipv4_networks(self) -> Iterable[Tuple[int, int]]:
+        return zip(self._ipv4_networks, self._ipv4_lengths)
+
+    def ipv6_networks(self) -> Iterable[Tuple[int, int]]:
+        halves = self._ipv6_halves
+        return (((halves[2 * index] << 64) | halves[2 * index + 1], length)
+                for index, length in enumerate(self._ipv6_lengths))
+
+    def prefixes(self) -> List[str]:
+        """
+        The CIDR strings the snapshot was packed from, IPv4 before IPv6
+        """
+        return ['%d.%d.%d.%d/%d' % (network >> 24, network >> 16 & 255, network >> 8 & 255, network & 255, length)
+                for network, length in self.ipv4_networks()] + \
+            [str(ipaddress.IPv6Network((network, length))) for network, length in self.ipv6_networks()]
+
+
+def pack_snapshot(prefixes: Iterable[str], sync_token: Optional[str] = None, fingerprint: bool = True) -> bytes:
+    """
+    Packs CIDR strings, which must not have host bits set, keeping the order of each ip version
+    """
+    prefixes = list(prefixes)
+    ipv4_networks, ipv4_lengths = array('I'), bytearray()
+    ipv6_halves, ipv6_lengths = array('Q'), bytearray()
+    for prefix in prefixes:
+        network = ipaddress.ip_network(prefix)
+        address = int(network.network_address)
+        if network.version == 4:
+            ipv4_networks.append(address)
+            ipv4_lengths.append(network.prefixlen)
+        else:
+            ipv6_halves.extend((address >> 64, address & 0xffffffffffffffff))
+            ipv6_lengths.append(network.prefixlen)
+    if sys.byteorder != 'little':
+        ipv4_networks.byteswap()
+        ipv6_halves.byteswap()
+
+    encoded_sync_token = (sync_token or '').encode('ascii')
+    if len(encoded_sync_token) > SYNC_TOKEN_SIZE:
+        raise ValueError("syncToken %s is longer than %d bytes" % (sync_token, SYNC_TOKEN_SIZE))
+
+    ipv4_part = ipv4_networks.tobytes() + bytes(ipv4_lengths)
+    payload = ipv4_part + bytes(_aligned(HEADER.size + len(ipv4_part)) - HEADER.size - len(ipv4_part)) + \
+        ipv6_halves.tobytes() + bytes(ipv6_lengths)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ipv4_lengths), len(ipv6_lengths), encoded_sync_token,
+                         hashlib.sha256(payload).digest(),
+                         bytes.fromhex(fingerprint_prefixes(prefixes)) if fingerprint else bytes(32))
+    return header + payload
+
+
+def write_snapshot(path: str, prefixes: Iterable[str], sync_token: Optional[str] = None):
+    with open(path, 'wb') as f:
+        f.write(pack_snapshot(prefixes, sync_token))
+
+
+def load_snapshot(path: str, verify: bool = True) -> Snapshot:
+    """
+    Maps the snapshot file into memory, the mapping lives as long as the snapshot
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(mapped, verify)
+
+
+def _aligned(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _uints(view: memoryview, typecode: str):
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    swapped = array(typecode, view.tobytes())
+    swapped.byteswap()
+    return swapped
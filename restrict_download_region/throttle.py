@@ -0,0 +1,184 @@
+"""
+Throttling control for the S3 control-plane calls.
+
+Every function subscribed to AmazonIpSpaceChanged calls PutBucketPolicy at about the
+same moment. Throttled calls are retried with exponential backoff and full jitter,
+a token bucket limits the rate of the calls made by this function, and the number
+of calls in flight is halved whenever S3 throttles and grows back as calls succeed.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+THROTTLING_ERROR_CODES = frozenset((
+    'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'TooManyRequestsException', 'RequestLimitExceeded', 'ServiceUnavailable'))
+THROTTLING_STATUS_CODES = frozenset((429, 503))
+# retried as well, without lowering the concurrency
+TRANSIENT_ERROR_CODES = frozenset(('InternalError', 'RequestTimeout'))
+TRANSIENT_STATUS_CODES = frozenset((500, 502, 504))
+
+
+def is_throttling_error(error: Exception) -> bool:
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES or \
+        response.get('ResponseMetadata', {}).get('HTTPStatusCode') in THROTTLING_STATUS_CODES
+
+
+def call_directly(operation: Callable, **kwargs):
+    """
+    Makes a call without pacing or retries, for code that can be handed a ThrottleController's call
+    """
+    return operation(**kwargs)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Server errors, and the connection errors and timeouts botocore raises without a response
+    """
+    from botocore.exceptions import ConnectionError, HTTPClientError
+
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES or \
+        response.get('ResponseMetadata', {}).get('HTTPStatusCode') in TRANSIENT_STATUS_CODES
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second on average and bursts of up to burst calls, a rate of 0 allows any rate
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes a token, waiting for one if there are none left. Returns the seconds waited.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # the token is taken right away, callers arriving later queue up behind it
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the calls in flight, halving the limit when a call is throttled and raising it by one
+    after limit calls in a row succeeded. Only a call started after the last decrease lowers
+    the limit again, so a burst of throttled calls counts once.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.limit = self.maximum
+        self._in_flight = 0
+        self._successes = 0
+        self._generation = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[int]:
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            generation = self._generation
+        try:
+            yield generation
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def succeeded(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def throttled(self, generation: int):
+        with self._condition:
+            self._successes = 0
+            if generation == self._generation:
+                self.limit = max(self.minimum, self.limit // 2)
+                self._generation += 1
+
+
+class ThrottleController:
+    """
+    Runs S3 calls through the token bucket and the concurrency limit, retrying throttled and
+    transient failures. botocore's own retries are turned off for the client, so this is the
+    only retry layer.
+    """
+
+    def __init__(self, token_bucket: TokenBucket, concurrency: AdaptiveConcurrency,
+                 max_attempts: int = 5,
+                 base_delay: float = 0.1,
+                 max_delay: float = 5.0,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.token_bucket = token_bucket
+        self.concurrency = concurrency
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+
+    def call(self, phase, operation: Callable, **kwargs):
+        """
+        Records the retries and the milliseconds spent waiting for tokens and backing off
+        as Retries and ThrottleWait of the metrics phase, if there is one
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            waited = self.token_bucket.acquire()
+            if waited and phase:
+                phase.add('ThrottleWait', waited * 1000)
+            with self.concurrency.slot() as generation:
+                try:
+                    result = operation(**kwargs)
+                except Exception as e:
+                    throttled = is_throttling_error(e)
+                    if not throttled and not is_transient_error(e):
+                        raise
+                    if throttled:
+                        self.concurrency.throttled(generation)
+                    if attempt == self.max_attempts:
+                        raise
+                else:
+                    self.concurrency.succeeded()
+                    if phase:
+                        phase.set('Concurrency', self.concurrency.limit)
+                    return result
+
+            # full jitter, waiting outside of the concurrency slot
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+            if phase:
+                phase.add('Retries', 1)
+                phase.add('ThrottleWait', delay * 1000)
+            self._sleep(delay)
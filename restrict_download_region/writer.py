@@ -0,0 +1,77 @@
+"""
+Optimistic read-merge-write of a bucket policy that other automation edits as well.
+
+S3 has no conditional PutBucketPolicy, so concurrent edits are detected by re-reading:
+right before writing, to skip the write when the policy changed since it was merged,
+and after writing, to check that the written statements were not overwritten. Either
+conflict starts over with a merge into the policy that was just read, after a
+jittered backoff so the competing writers spread out.
+"""
+import copy
+import logging
+import random
+import time
+from typing import Callable, Optional
+
+from restrict_download_region.policy import BucketPolicy, diff_policies
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class PolicyConflictError(Exception):
+    """
+    Raised when the policy was changed concurrently during every attempt
+    """
+
+
+def write_policy(read: Callable[[], dict], merge: Callable[[dict], bool], write: Callable[[dict], None],
+                 bucket_policy: Optional[dict] = None,
+                 attempts: int = 5,
+                 backoff: float = 0.2,
+                 max_backoff: float = 5.0,
+                 settle: float = 0.0,
+                 sleep: Callable[[float], None] = time.sleep) -> bool:
+    """
+    merge modifies the policy passed to it and returns whether it changed it, like process_ip_restrict_policy.
+    bucket_policy is the policy as already read, it is read first otherwise.
+    With settle the written policy is verified once more after that many seconds, catching
+    writers that read the policy before this one wrote it and wrote theirs right after.
+    Returns whether the policy was changed.
+    """
+    written = False
+    for attempt in range(1, attempts + 1):
+        if bucket_policy is None:
+            bucket_policy = read()
+        merged = copy.deepcopy(bucket_policy)
+        if not merge(merged):
+            # on a retry, the statements may be in place thanks to an earlier attempt
+            return written
+
+        current = read()
+        if not _same_statements(bucket_policy, current):
+            log.warning("policy changed while it was merged, attempt %d of %d", attempt, attempts)
+            bucket_policy = current
+        else:
+            write(merged)
+            written = True
+            if _same_statements(merged, read()) and _settled(read, merged, settle, sleep):
+                return True
+            log.warning("written policy was overwritten, attempt %d of %d", attempt, attempts)
+            bucket_policy = None
+
+        if attempt < attempts:
+            # full jitter
+            sleep(random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1))))
+    raise PolicyConflictError("policy kept changing concurrently for %d attempts" % attempts)
+
+
+def _same_statements(expected: dict, actual: dict) -> bool:
+    return diff_policies(BucketPolicy.from_dict(expected), BucketPolicy.from_dict(actual)).empty
+
+
+def _settled(read: Callable[[], dict], merged: dict, settle: float, sleep: Callable[[float], None]) -> bool:
+    if not settle:
+        return True
+    sleep(settle)
+    return _same_statements(merged, read())
@@ -0,0 +1,28 @@
+import restrict_download_region.restrict_region as restrict_region
+from restrict_download_region.notification import AppliedSyncTokens
+import json
+import os
+import pkg_resources
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture(autouse=True)
+def isolate_persisted_state(mocker: MockerFixture):
+    # keep tests independent of anything cached under /tmp by other tests or local runs
+    mocker.patch.object(restrict_region, 'ip_ranges_cache', None)
+    mocker.patch.object(restrict_region, 'applied_sync_tokens', AppliedSyncTokens(None))
+    # boto3 clients are created once per container, tests patch boto3.client
+    mocker.patch.dict(restrict_region._clients, clear=True)
+
+
+@pytest.fixture
+def sample_ip_ranges_bytes():
+    with open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def ip_space_changed_event():
+    with open(os.path.join(os.path.dirname(__file__), '..', '..', 'events', 'sns.json')) as f:
+        return json.load(f)
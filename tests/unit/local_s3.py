@@ -0,0 +1,36 @@
+from botocore.exceptions import ClientError
+import json
+import random
+import threading
+import time
+
+
+class LocalS3:
+    """
+    Stands in for the bucket policy calls of S3, every call takes a little while so writers interleave
+    """
+
+    def __init__(self, latency: float = 0.002):
+        self.latency = latency
+        self.policies = {}
+        self.puts = 0
+        self._lock = threading.Lock()
+
+    def get_bucket_policy(self, Bucket):
+        time.sleep(random.uniform(0, self.latency))
+        with self._lock:
+            if Bucket not in self.policies:
+                raise ClientError({'Error': {'Code': 'NoSuchBucketPolicy', 'Message': ''}}, 'GetBucketPolicy')
+            return {'Policy': self.policies[Bucket]}
+
+    def put_bucket_policy(self, Bucket, Policy):
+        json.loads(Policy)
+        time.sleep(random.uniform(0, self.latency))
+        with self._lock:
+            self.policies[Bucket] = Policy
+            self.puts += 1
+
+    def delete_bucket_policy(self, Bucket):
+        time.sleep(random.uniform(0, self.latency))
+        with self._lock:
+            self.policies.pop(Bucket, None)
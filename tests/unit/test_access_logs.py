@@ -0,0 +1,85 @@
+from restrict_download_region import access_logs
+from restrict_download_region.access_logs import AccessLogClassifier, Request, parse_log_line
+from restrict_download_region.lookup import IpRangeLookup, Owner
+import json
+import pkg_resources
+import pytest
+
+LINE = '79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be awsexamplebucket1 ' \
+       '[06/Feb/2019:00:00:38 +0000] %s arn:aws:iam::123456789012:user/alice 3E57427F3EXAMPLE %s ' \
+       'photos/2019/08/puppy.jpg "GET /awsexamplebucket1/photos/2019/08/puppy.jpg?x-foo=\\"bar\\" HTTP/1.1" ' \
+       '%s - 2662992 3462992 70 10 "-" "aws-cli/1.16.30" - Ke1bUcazaN1jWuUlPJaxF64cQVpUEhoZKEG/hmy/gijN/I1DeWqDf' \
+       'QvnUjzJ7GoNMQE= SigV4 ECDHE-RSA-AES128-GCM-SHA256 AuthHeader awsexamplebucket1.s3.us-west-1.amazonaws.com ' \
+       'TLSV1.2 arn:aws:s3:us-west-1:123456789012:accesspoint/example-AP Yes'
+
+
+def line(remote_ip, status='200', operation='REST.GET.OBJECT'):
+    return LINE % (remote_ip, operation, status)
+
+
+@pytest.fixture
+def classifier():
+    feed_lookup = IpRangeLookup.from_owners([
+        Owner('3.5.140.0/22', 'us-east-1', 'AMAZON'),
+        Owner('3.5.140.0/23', 'us-east-1', 'S3'),
+        Owner('52.94.6.0/24', 'eu-west-2', 'AMAZON'),
+        Owner('2600:1f19:8000::/36', 'us-east-1', 'AMAZON')
+    ])
+    return AccessLogClassifier.for_region(feed_lookup, ['3.5.140.0/22', '2600:1f19:8000::/36'], 'us-east-1')
+
+
+def test_parse_log_line():
+    assert parse_log_line(line('8.8.8.8')) == Request('awsexamplebucket1', '8.8.8.8', 'REST.GET.OBJECT', 200)
+    assert parse_log_line(line('8.8.8.8', status='-')).status is None
+    assert parse_log_line('not an access log line') is None
+
+
+@pytest.mark.parametrize("remote_ip, status, classification, violation", [
+    ('3.5.140.7', '200', 'in-region', None),
+    ('2600:1f19:8000::7', '200', 'in-region', None),
+    ('3.5.140.7', '403', 'in-region', 'denied-in-region'),
+    ('52.94.6.7', '403', 'other-region', None),
+    ('52.94.6.7', '200', 'other-region', 'allowed-out-of-region'),
+    ('8.8.8.8', '206', 'external', 'allowed-out-of-region'),
+    ('10.1.2.3', '200', 'private', None),
+    ('-', '200', 'invalid', None),
+])
+def test_access_log_classifier__downloads(classifier, remote_ip, status, classification, violation):
+    result = classifier.add(line(remote_ip, status))
+
+    assert classifier.classifications == {classification: 1}
+    assert (result or {}).get('decision') == violation
+    if violation:
+        assert result['remote_ip'] == remote_ip
+        assert result['bucket'] == 'awsexamplebucket1'
+
+
+def test_access_log_classifier__other_operations_are_only_classified(classifier):
+    assert classifier.add(line('8.8.8.8', operation='REST.PUT.OBJECT')) is None
+    classifier.add('garbage')
+
+    assert classifier.summary() == {
+        'region': 'us-east-1',
+        'lines': 2,
+        'unparsable': 1,
+        'classifications': {'external': 1},
+        'other_regions': {},
+        'downloads': {}
+    }
+
+
+def test_main(tmp_path, capsys):
+    logs = tmp_path / 'access.log'
+    logs.write_text('\n'.join([line('15.230.56.104'), line('52.93.153.170'), line('15.230.56.105', '403')]) + '\n')
+
+    access_logs.main(['--ip-ranges', pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'),
+                      '--region', 'us-east-1', '--violations', str(logs)])
+
+    out, err = capsys.readouterr()
+    summary = json.loads(out)
+    assert summary['lines'] == 3
+    assert summary['classifications'] == {'in-region': 2, 'other-region': 1}
+    assert summary['other_regions'] == {'eu-west-2': 1}
+    assert summary['downloads'] == {'as-intended': 1, 'allowed-out-of-region': 1, 'denied-in-region': 1}
+    assert [json.loads(violation)['decision'] for violation in err.splitlines()] == \
+        ['allowed-out-of-region', 'denied-in-region']
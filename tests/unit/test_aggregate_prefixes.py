@@ -0,0 +1,91 @@
+from restrict_download_region.cidr import aggregate_prefixes, fingerprint_prefixes, serialized_size
+import ipaddress
+import json
+import logging
+import random
+import pkg_resources
+import pytest
+
+
+def address_space(prefixes):
+    """
+    Reduces a prefix list to sorted, non-overlapping (version, first, last) integer intervals
+    so two lists can be compared by the exact set of addresses they cover
+    """
+    intervals = sorted((network.version, int(network.network_address), int(network.broadcast_address))
+                       for network in (ipaddress.ip_network(prefix) for prefix in prefixes))
+    merged = []
+    for version, first, last in intervals:
+        if merged and merged[-1][0] == version and first <= merged[-1][2] + 1:
+            merged[-1][2] = max(merged[-1][2], last)
+        else:
+            merged.append([version, first, last])
+    return merged
+
+
+@pytest.mark.parametrize("prefixes, expected", [
+    # adjacent networks
+    (['10.0.0.0/25', '10.0.0.128/25'], ['10.0.0.0/24']),
+    # overlapping networks
+    (['10.0.0.0/16', '10.0.5.0/24', '10.0.0.0/16'], ['10.0.0.0/16']),
+    # adjacent but not on a common boundary
+    (['10.0.1.0/24', '10.0.2.0/24'], ['10.0.1.0/24', '10.0.2.0/24']),
+    # ipv4 and ipv6 are collapsed separately, ipv4 first
+    (['2600:1f19:8000::/37', '52.93.153.170/32', '2600:1f19:8800::/37'],
+     ['52.93.153.170/32', '2600:1f19:8000::/36']),
+    ([], [])])
+def test_aggregate_prefixes(prefixes, expected):
+    assert aggregate_prefixes(prefixes) == expected
+
+
+def test_aggregate_prefixes__covers_same_address_space__random_networks():
+    rand = random.Random(1613483053)
+    prefixes = []
+    for _ in range(2000):
+        prefix_length = rand.randint(20, 32)
+        prefixes.append(str(ipaddress.ip_network((0x0A000000 | rand.getrandbits(20), prefix_length),
+                                                 strict=False)))
+        prefix_length = rand.randint(40, 64)
+        prefixes.append(str(ipaddress.ip_network(((0x2600 << 112) | rand.getrandbits(24) << 80, prefix_length),
+                                                 strict=False)))
+
+    aggregated = aggregate_prefixes(prefixes)
+
+    assert len(aggregated) < len(prefixes)
+    assert address_space(aggregated) == address_space(prefixes)
+    # minimal: no two aggregated networks can be collapsed any further
+    assert aggregate_prefixes(aggregated) == aggregated
+    assert len(address_space(aggregated)) <= len(aggregated)
+
+
+def test_aggregate_prefixes__covers_same_address_space__sample_feed():
+    all_ip_prefixes = json.load(open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json')))
+    prefixes = [item['ip_prefix'] for item in all_ip_prefixes['prefixes']] + \
+        [item['ipv6_prefix'] for item in all_ip_prefixes['ipv6_prefixes']]
+
+    assert address_space(aggregate_prefixes(prefixes)) == address_space(prefixes)
+
+
+def test_aggregate_prefixes__reports_counts_and_sizes(caplog):
+    prefixes = ['10.0.0.0/25', '10.0.0.128/25']
+
+    with caplog.at_level(logging.INFO, logger='restrict_download_region.cidr'):
+        aggregate_prefixes(prefixes)
+
+    assert "aggregated 2 prefixes (%d bytes) into 1 prefixes (%d bytes)" % (
+        serialized_size(prefixes), serialized_size(['10.0.0.0/24'])) in caplog.text
+
+
+def test_aggregate_prefixes__invalid_prefix():
+    with pytest.raises(ValueError):
+        aggregate_prefixes(['not-a-prefix'])
+
+
+def test_fingerprint_prefixes__same_address_space():
+    assert fingerprint_prefixes(['10.0.0.0/24', '2600:1f19:8000::/36']) == \
+        fingerprint_prefixes(['2600:1f19:8000::/36', '10.0.0.128/25', '10.0.0.0/25', '10.0.0.0/24'])
+
+
+def test_fingerprint_prefixes__different_address_space():
+    assert fingerprint_prefixes(['10.0.0.0/24']) != fingerprint_prefixes(['10.0.0.0/25'])
+    assert fingerprint_prefixes(['10.0.0.0/24']) != fingerprint_prefixes(['10.0.0.0/24', '2600:1f19:8000::/36'])
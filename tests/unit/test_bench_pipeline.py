@@ -0,0 +1,51 @@
+from benchmarks.bench_pipeline import RESULTS_FORMAT_VERSION, Regression, compare, pipeline_stages, run_suite
+from benchmarks.synthetic import synthetic_feed
+from restrict_download_region import restrict_region
+import json
+import pytest
+
+
+def test_run_suite__measures_every_stage_at_every_scale():
+    results = run_suite([0.01, 0.02], repeat=1)
+
+    # must survive a round trip through the results file
+    results = json.loads(json.dumps(results))
+    assert results['version'] == RESULTS_FORMAT_VERSION
+    stages = {result['stage'] for result in results['results']}
+    assert {'parse_full', 'parse_streaming', 'ip_prefixes_for_region', 'generate_ip_address_policy',
+            'merge_changed_policy', 'serialize_policy'} <= stages
+    assert len(results['results']) == 2 * len(stages)
+    for result in results['results']:
+        assert result['seconds_median'] >= 0
+        assert result['peak_bytes'] >= 0
+
+
+def test_pipeline_stages__run_on_feeds_whose_policies_exceed_the_size_limit():
+    # the default scales of the benchmark produce policies larger than S3 accepts
+    for scale in (1, 10):
+        for stage, setup in pipeline_stages(synthetic_feed(scale), 'us-east-1'):
+            setup()()
+
+    assert restrict_region.POLICY_BUDGET_STRATEGY == 'supernet'
+
+
+def result(stage, scale, seconds, peak_bytes):
+    return {'stage': stage, 'scale': scale, 'seconds_median': seconds, 'peak_bytes': peak_bytes}
+
+
+def test_compare__reports_growth_beyond_threshold():
+    baseline = {'version': RESULTS_FORMAT_VERSION, 'results': [
+        result('parse_full', 1, 1.0, 1000), result('parse_full', 10, 10.0, 10000),
+        result('serialize_policy', 1, 1.0, 1000)]}
+    current = {'version': RESULTS_FORMAT_VERSION, 'results': [
+        result('parse_full', 1, 1.1, 1300), result('serialize_policy', 1, 1.5, 1000),
+        result('parse_streaming', 1, 9.0, 9000)]}
+
+    assert compare(current, baseline, 0.2) == [
+        Regression('parse_full', 1, 'peak_bytes', 1000, 1300),
+        Regression('serialize_policy', 1, 'seconds_median', 1.0, 1.5)]
+
+
+def test_compare__rejects_other_results_format():
+    with pytest.raises(ValueError):
+        compare({'version': RESULTS_FORMAT_VERSION, 'results': []}, {'version': 0, 'results': []}, 0.2)
@@ -0,0 +1,66 @@
+from restrict_download_region import cfnresponse
+from pytest_mock import MockerFixture
+import json
+import pytest
+
+
+@pytest.fixture
+def event():
+    return {
+        'ResponseURL': 'https://cloudformation-custom-resource-response.s3.amazonaws.com/pre-signed',
+        'StackId': 'stack-id',
+        'RequestId': 'request-id',
+        'LogicalResourceId': 'RestrictBucketDownloadRegion'
+    }
+
+
+@pytest.fixture
+def context(mocker: MockerFixture):
+    return mocker.Mock(log_stream_name='log-stream')
+
+
+@pytest.fixture
+def mock_sleep(mocker: MockerFixture):
+    return mocker.patch.object(cfnresponse.time, 'sleep', autospec=True)
+
+
+def test_send__delivered(mocker: MockerFixture, event, context, mock_sleep):
+    mock_http = mocker.patch.object(cfnresponse, 'http', autospec=True)
+    mock_http.request.return_value.status = 200
+
+    assert cfnresponse.send(event, context, cfnresponse.FAILED, {'Data': ''}, reason='Timed out', timeout=2.5)
+
+    (method, url), kwargs = mock_http.request.call_args
+    assert (method, url) == ('PUT', event['ResponseURL'])
+    assert kwargs['timeout'] == 2.5
+    assert kwargs['retries'] is False
+    assert json.loads(kwargs['body'])['Reason'] == 'Timed out'
+    assert not mock_sleep.called
+
+
+def test_send__retries_server_errors_with_backoff(mocker: MockerFixture, event, context, mock_sleep):
+    mock_http = mocker.patch.object(cfnresponse, 'http', autospec=True)
+    mock_http.request.side_effect = [OSError("connection reset"), mocker.Mock(status=503), mocker.Mock(status=200)]
+
+    assert cfnresponse.send(event, context, cfnresponse.SUCCESS, {'Data': ''}, backoff=0.5)
+
+    assert mock_http.request.call_count == 3
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.5, 1.0]
+
+
+def test_send__gives_up_after_retries(mocker: MockerFixture, event, context, mock_sleep):
+    mock_http = mocker.patch.object(cfnresponse, 'http', autospec=True)
+    mock_http.request.side_effect = OSError("timed out")
+
+    assert cfnresponse.send(event, context, cfnresponse.SUCCESS, {'Data': ''}, retries=2) is False
+
+    assert mock_http.request.call_count == 3
+
+
+def test_send__rejected_url_is_not_retried(mocker: MockerFixture, event, context, mock_sleep):
+    mock_http = mocker.patch.object(cfnresponse, 'http', autospec=True)
+    mock_http.request.return_value.status = 403
+
+    assert cfnresponse.send(event, context, cfnresponse.SUCCESS, {'Data': ''}) is False
+
+    assert mock_http.request.call_count == 1
@@ -0,0 +1,73 @@
+import restrict_download_region.restrict_region as restrict_region
+import boto3
+import os
+import subprocess
+import sys
+from pytest_mock import MockerFixture
+
+
+def test_get_client__created_once_per_container(mocker: MockerFixture):
+    mock_boto3_client = mocker.patch.object(boto3, "client", autospec=True)
+
+    assert restrict_region.get_client('s3') is restrict_region.get_client('s3')
+    mock_boto3_client.assert_called_once_with('s3', config=mocker.ANY)
+
+
+def test_get_client__s3_is_only_retried_by_the_throttle_controller(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    s3_client = restrict_region.get_client('s3')
+
+    assert s3_client.meta.config.retries == {'mode': 'standard', 'total_max_attempts': 1}
+
+
+def test_import__does_not_import_boto3():
+    project_root = os.path.join(os.path.dirname(__file__), '..', '..')
+    output = subprocess.run(
+        [sys.executable, '-c', "import sys, restrict_download_region.restrict_region; print('boto3' in sys.modules)"],
+        cwd=project_root, check=True, capture_output=True, text=True,
+        env=dict(os.environ, IP_RANGES_CACHE_DIR='', PREFETCH_IP_RANGES='false')).stdout
+
+    assert output.strip() == 'False'
+
+
+def test_import__does_not_import_the_modules_of_other_modes():
+    project_root = os.path.join(os.path.dirname(__file__), '..', '..')
+    output = subprocess.run(
+        [sys.executable, '-c', "import sys, restrict_download_region.restrict_region; "
+                               "print(sorted(m for m in sys.modules if m.startswith('restrict_download_region.')))"],
+        cwd=project_root, check=True, capture_output=True, text=True,
+        env=dict(os.environ, IP_RANGES_CACHE_DIR='', PREFETCH_IP_RANGES='false')).stdout
+
+    for module in ('drift', 'reconcile', 'publisher', 'snapshot', 'render', 'access_logs'):
+        assert 'restrict_download_region.%s' % module not in output
+
+
+def test_warm_up__prefetches_client_and_ip_prefixes(mocker: MockerFixture):
+    mock_boto3_client = mocker.patch.object(boto3, "client", autospec=True)
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", autospec=True)
+
+    restrict_region.warm_up()
+
+    mock_boto3_client.assert_called_once_with('s3', config=mocker.ANY)
+    mock_get_ip_prefixes_for_region.assert_called_once_with()
+
+
+def test_warm_up__failure_does_not_break_init(mocker: MockerFixture):
+    mocker.patch.object(boto3, "client", autospec=True)
+    mocker.patch.object(restrict_region, "get_ip_prefixes_for_region", side_effect=ValueError("no region"),
+                        autospec=True)
+
+    restrict_region.warm_up()
+
+
+def test_reset_connections(mocker: MockerFixture):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_boto3_client = mocker.patch.object(boto3, "client", autospec=True)
+    restrict_region.get_client('s3')
+
+    restrict_region.reset_connections()
+    restrict_region.get_client('s3')
+
+    mock_http.clear.assert_called_once_with()
+    assert mock_boto3_client.call_count == 2
@@ -0,0 +1,204 @@
+from restrict_download_region.drift import (CURRENT, DRIFTED, ERROR, MISSING, SKIPPED, STALE, DriftResult,
+                                            ExpectedStatement, classify_policy, scan_buckets)
+import restrict_download_region.restrict_region as restrict_region
+from tests.unit.local_s3 import LocalS3
+from botocore.exceptions import ClientError
+from pytest_mock import MockerFixture
+import json
+import threading
+import time
+import pytest
+
+REGION_IP_PREFIXES = ['15.230.56.104/31', '2600:1f19:8000::/36']
+EARLIER_IP_PREFIXES = ['15.230.56.104/32', '2600:1f19:8000::/36']
+
+OTHER_STATEMENT = {'Sid': 'AllowReplication', 'Effect': 'Allow', 'Principal': {'AWS': '111122223333'},
+                   'Action': 's3:ReplicateObject', 'Resource': 'arn:aws:s3:::my-bucket/*'}
+
+
+@pytest.fixture
+def expected():
+    return ExpectedStatement(lambda bucket_name: restrict_region.generate_ip_address_policy(
+        bucket_name, REGION_IP_PREFIXES), REGION_IP_PREFIXES)
+
+
+def policy_with(*statements):
+    return {'Version': '2012-10-17', 'Statement': list(statements)}
+
+
+def ip_statement(prefixes=REGION_IP_PREFIXES, bucket_name='my-bucket'):
+    return restrict_region.generate_ip_address_policy(bucket_name, prefixes)
+
+
+def test_classify_policy__current(expected):
+    assert classify_policy('my-bucket', policy_with(OTHER_STATEMENT, ip_statement()), expected) == (CURRENT, None)
+
+
+def test_classify_policy__current_in_any_aggregation(expected):
+    statement = ip_statement(['2600:1f19:8000::/37', '15.230.56.105/32', '2600:1f19:8800::/37', '15.230.56.104/32'])
+
+    assert classify_policy('my-bucket', policy_with(statement), expected) == (CURRENT, None)
+
+
+def test_classify_policy__missing(expected):
+    assert classify_policy('my-bucket', policy_with(OTHER_STATEMENT), expected)[0] == MISSING
+    assert classify_policy('my-bucket', policy_with(), expected)[0] == MISSING
+
+
+def test_classify_policy__stale(expected):
+    assert classify_policy('my-bucket', policy_with(ip_statement(EARLIER_IP_PREFIXES)), expected)[0] == STALE
+
+
+@pytest.mark.parametrize("edit", [
+    lambda statement: statement.update(Effect='Allow'),
+    lambda statement: statement.update(Action=['s3:GetObject', 's3:GetObjectVersion']),
+    lambda statement: statement['Condition'].pop('Null'),
+    lambda statement: statement['Condition']['NotIpAddress'].update({'aws:SourceIp': ['not-a-prefix']}),
+    lambda statement: statement['Condition'].update(IpAddress=statement['Condition'].pop('NotIpAddress'))])
+def test_classify_policy__drifted(expected, edit):
+    statement = ip_statement()
+    edit(statement)
+
+    assert classify_policy('my-bucket', policy_with(statement), expected)[0] == DRIFTED
+
+
+def test_classify_policy__statement_of_another_bucket_is_drifted(expected):
+    assert classify_policy('my-bucket', policy_with(ip_statement(bucket_name='other')), expected)[0] == DRIFTED
+
+
+def test_classify_policy__duplicated_statement_is_drifted(expected):
+    assert classify_policy('my-bucket', policy_with(ip_statement(), ip_statement()), expected) == \
+        (DRIFTED, "2 DenyGetObjectForNonMatchingIp statements")
+
+
+def test_scan_buckets__bounded_parallelism_and_isolated_failures():
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def scan(bucket_name):
+        with lock:
+            in_flight.append(bucket_name)
+            peak.append(len(in_flight))
+        time.sleep(0.002)
+        with lock:
+            in_flight.remove(bucket_name)
+        if bucket_name == 'bucket-007':
+            raise ValueError("access denied")
+        return DriftResult(bucket_name, CURRENT)
+
+    bucket_names = ['bucket-%03d' % i for i in range(100)]
+    report = scan_buckets(bucket_names, scan, max_workers=4)
+
+    assert max(peak) == 4
+    assert list(report.results) == bucket_names
+    assert report.results['bucket-007'] == DriftResult('bucket-007', ERROR, 'access denied')
+    assert report.counts()[CURRENT] == 99
+
+
+def test_scan_buckets__stops_starting_buckets_at_the_deadline():
+    deadline = time.monotonic() + 0.05
+
+    def scan(bucket_name):
+        time.sleep(0.01)
+        return DriftResult(bucket_name, CURRENT)
+
+    report = scan_buckets(['bucket-%03d' % i for i in range(100)], scan, max_workers=2,
+                          time_left=lambda: deadline - time.monotonic(), margin=0.0)
+
+    counts = report.counts()
+    assert 0 < counts[CURRENT] < 100
+    assert counts[CURRENT] + counts[SKIPPED] == 100
+    # buckets are scanned in order, the skipped ones are the last ones
+    assert report.by_status(SKIPPED)[-1].bucket_name == 'bucket-099'
+    assert 'bucket-099' in report.to_dict()['buckets'][SKIPPED]
+
+
+class Context:
+    def __init__(self, seconds: float):
+        self.deadline = time.monotonic() + seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class DeniedS3(LocalS3):
+    def get_bucket_policy(self, Bucket):
+        if Bucket == 'denied':
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'GetBucketPolicy')
+        return super().get_bucket_policy(Bucket)
+
+
+@pytest.fixture
+def fleet(mocker: MockerFixture):
+    """
+    1000 buckets, mostly current, with a missing, a stale, a drifted and an unreadable one
+    """
+    s3 = DeniedS3(latency=0.001)
+    bucket_names = ['bucket-%04d' % i for i in range(996)]
+    for bucket_name in bucket_names:
+        s3.policies[bucket_name] = json.dumps(policy_with(ip_statement(bucket_name=bucket_name)))
+    s3.policies['missing'] = json.dumps(policy_with(OTHER_STATEMENT))
+    s3.policies['stale'] = json.dumps(policy_with(ip_statement(EARLIER_IP_PREFIXES, 'stale')))
+    edited = ip_statement(bucket_name='drifted')
+    edited['Principal'] = {'AWS': '111122223333'}
+    s3.policies['drifted'] = json.dumps(policy_with(OTHER_STATEMENT, edited))
+
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'BUCKET_NAME', '')
+    mocker.patch.object(restrict_region, 'BUCKET_NAMES', ','.join(bucket_names + ['missing', 'stale', 'drifted',
+                                                                                  'denied']))
+    mocker.patch.object(restrict_region, 'get_ip_prefixes_for_region', return_value=REGION_IP_PREFIXES,
+                        autospec=True)
+    mocker.patch.dict(restrict_region._clients, {'s3': s3})
+    return s3
+
+
+def test_scan_handler__reports_missing_stale_drifted_and_errors(fleet):
+    report = restrict_region.scan_handler({}, Context(60))
+
+    assert report['counts'] == {CURRENT: 996, MISSING: 1, STALE: 1, DRIFTED: 1, ERROR: 1, SKIPPED: 0}
+    assert set(report['buckets']) == {MISSING, STALE, DRIFTED, ERROR}
+    assert list(report['buckets'][DRIFTED]) == ['drifted']
+    assert 'AccessDenied' in report['buckets'][ERROR]['denied']
+    assert report['repaired'] == []
+    assert fleet.puts == 0
+
+
+def test_scan_handler__repair(fleet):
+    report = restrict_region.scan_handler({'repair': True}, Context(60))
+
+    assert sorted(report['repaired']) == ['drifted', 'missing', 'stale']
+    assert fleet.puts == 3
+    # the other statements are kept
+    assert OTHER_STATEMENT in json.loads(fleet.policies['drifted'])['Statement']
+
+    report = restrict_region.scan_handler({}, Context(60))
+    assert report['counts'][CURRENT] == 999
+    assert report['repaired'] == []
+
+
+def test_scan_handler__near_the_timeout_skips_the_remaining_buckets(mocker: MockerFixture, fleet):
+    mocker.patch.object(restrict_region, 'DRIFT_SCAN_DEADLINE_MARGIN_MS', 59900)
+
+    report = restrict_region.scan_handler({}, Context(60))
+
+    assert 0 < report['counts'][SKIPPED] < 1000
+    assert sum(report['counts'].values()) == 1000
+
+
+def test_scan_handler__policy_fitted_to_the_size_limit_is_current(mocker: MockerFixture):
+    prefixes = ['10.%d.%d.0/24' % (i // 128, 2 * (i % 128)) for i in range(600)]
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'BUCKET_NAME', 'my-bucket')
+    mocker.patch.object(restrict_region, 'POLICY_SIZE_LIMIT', 6000)
+    mocker.patch.object(restrict_region, 'POLICY_BUDGET_MAX_RATIO', 1.0)
+    mocker.patch.object(restrict_region, 'get_ip_prefixes_for_region', return_value=prefixes, autospec=True)
+    s3 = mocker.patch.dict(restrict_region._clients, {'s3': LocalS3(latency=0)})['s3']
+    restrict_region.handler({}, {})
+
+    report = restrict_region.scan_handler({}, {})
+
+    assert report['counts'][CURRENT] == 1
+    fitted = json.loads(s3.policies['my-bucket'])['Statement'][0]['Condition']['NotIpAddress']['aws:SourceIp']
+    assert len(fitted) < len(prefixes) == 600
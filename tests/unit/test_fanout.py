@@ -0,0 +1,230 @@
+from restrict_download_region import fanout
+import restrict_download_region.restrict_region as restrict_region
+import boto3
+import botocore
+import threading
+import pytest
+from pytest_mock import MockerFixture
+
+
+def test_apply_to_buckets__failure_is_isolated_per_bucket():
+    def apply(bucket_name):
+        if bucket_name == 'broken':
+            raise ValueError("access denied")
+        return bucket_name == 'changed'
+
+    results = fanout.apply_to_buckets(['changed', 'broken', 'unchanged'], apply, max_workers=2)
+
+    assert results == {
+        'changed': fanout.BucketResult('changed', fanout.UPDATED),
+        'broken': fanout.BucketResult('broken', fanout.FAILED, 'access denied'),
+        'unchanged': fanout.BucketResult('unchanged', fanout.UNCHANGED)
+    }
+
+
+def test_apply_to_buckets__bounded_concurrency():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def apply(bucket_name):
+        with lock:
+            running.append(bucket_name)
+            peak.append(len(running))
+        threading.Event().wait(0.01)
+        with lock:
+            running.remove(bucket_name)
+        return True
+
+    results = fanout.apply_to_buckets(['bucket-%d' % i for i in range(20)], apply, max_workers=3)
+
+    assert len(results) == 20
+    assert max(peak) <= 3
+
+
+def test_bucket_update_error__lists_failed_buckets():
+    error = fanout.BucketUpdateError({
+        'a': fanout.BucketResult('a', fanout.UPDATED),
+        'b': fanout.BucketResult('b', fanout.FAILED, 'access denied')
+    })
+
+    assert str(error) == "failed to update 1 of 2 buckets: b (access denied)"
+
+
+def test_discover_bucket_names__list_and_ssm_parameter(mocker: MockerFixture):
+    mock_ssm = mocker.MagicMock(spec=boto3.client('ssm', region_name='us-east-1'))
+    mock_ssm.get_parameter.return_value = {'Parameter': {'Value': 'bucket-b, bucket-c'}}
+
+    assert fanout.discover_bucket_names(None, lambda: mock_ssm, ' bucket-a,bucket-b,, ', '/restricted/buckets') \
+        == ['bucket-a', 'bucket-b', 'bucket-c']
+    mock_ssm.get_parameter.assert_called_once_with(Name='/restricted/buckets')
+
+
+def test_discover_bucket_names__tag(mocker: MockerFixture):
+    mock_s3 = mocker.MagicMock(spec=boto3.client('s3'))
+    mock_s3.list_buckets.return_value = {'Buckets': [{'Name': name} for name in (
+        'tagged', 'tagged-other-region', 'other-tag', 'untagged', 'tagged-us-east-1')]}
+    mock_s3.get_bucket_location.side_effect = lambda Bucket: {
+        'LocationConstraint': 'eu-west-2' if Bucket == 'tagged-other-region' else
+        None if Bucket == 'tagged-us-east-1' else 'us-west-2'}
+    tag_sets = {
+        'tagged': [{'Key': 'restrict-region', 'Value': 'true'}],
+        'tagged-other-region': [{'Key': 'restrict-region', 'Value': 'true'}],
+        'other-tag': [{'Key': 'restrict-region', 'Value': 'false'}],
+        'tagged-us-east-1': [{'Key': 'restrict-region', 'Value': 'true'}]
+    }
+
+    def get_bucket_tagging(Bucket):
+        if Bucket not in tag_sets:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchTagSet'}}, 'GetBucketTagging')
+        return {'TagSet': tag_sets[Bucket]}
+    mock_s3.get_bucket_tagging.side_effect = get_bucket_tagging
+
+    assert fanout.discover_bucket_names(mock_s3, None, tag='restrict-region=true', region='us-west-2',
+                                        max_workers=4) == ['tagged']
+    assert fanout.discover_bucket_names(mock_s3, None, tag='restrict-region=true', region='us-east-1') \
+        == ['tagged-us-east-1']
+
+
+def test_discover_bucket_names__tag_skips_buckets_that_deny_access(mocker: MockerFixture):
+    mock_s3 = mocker.MagicMock(spec=boto3.client('s3'))
+    mock_s3.list_buckets.return_value = {'Buckets': [{'Name': name} for name in (
+        'tagged', 'denies-location', 'denies-tagging', 'tagged-too')]}
+
+    def get_bucket_location(Bucket):
+        if Bucket == 'denies-location':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetBucketLocation')
+        return {'LocationConstraint': 'us-west-2'}
+
+    def get_bucket_tagging(Bucket):
+        if Bucket == 'denies-tagging':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetBucketTagging')
+        return {'TagSet': [{'Key': 'restrict-region', 'Value': 'true'}]}
+    mock_s3.get_bucket_location.side_effect = get_bucket_location
+    mock_s3.get_bucket_tagging.side_effect = get_bucket_tagging
+
+    assert fanout.discover_bucket_names(mock_s3, None, tag='restrict-region=true', region='us-west-2',
+                                        max_workers=2) == ['tagged', 'tagged-too']
+
+
+def test_discover_bucket_names__tag_reports_buckets_that_could_not_be_checked(mocker: MockerFixture):
+    mock_s3 = mocker.MagicMock(spec=boto3.client('s3'))
+    mock_s3.list_buckets.return_value = {'Buckets': [{'Name': name} for name in ('tagged', 'unreachable')]}
+    mock_s3.get_bucket_location.return_value = {'LocationConstraint': 'us-west-2'}
+
+    def get_bucket_tagging(Bucket):
+        if Bucket == 'unreachable':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'SlowDown'}}, 'GetBucketTagging')
+        return {'TagSet': [{'Key': 'restrict-region', 'Value': 'true'}]}
+    mock_s3.get_bucket_tagging.side_effect = get_bucket_tagging
+
+    with pytest.raises(fanout.DiscoveryError) as e:
+        fanout.discover_bucket_names(mock_s3, None, tag='restrict-region=true', region='us-west-2')
+
+    # an error that outlasted the retries is not mistaken for an untagged bucket
+    assert e.value.bucket_names == ['tagged']
+    assert list(e.value.errors) == ['unreachable']
+    assert 'SlowDown' in e.value.errors['unreachable']
+
+
+def test_discover_bucket_names__invalid_tag():
+    with pytest.raises(ValueError):
+        fanout.discover_bucket_names(None, None, tag='restrict-region')
+
+
+@pytest.fixture
+def fan_out(mocker: MockerFixture):
+    mocker.patch.object(restrict_region, "AWS_REGION", "us-east-1")
+    mocker.patch.object(restrict_region, "BUCKET_NAME", "")
+    mocker.patch.object(restrict_region, "BUCKET_NAMES", "bucket-a,broken,bucket-c")
+    mock_s3 = mocker.MagicMock(boto3.client('s3'))
+    mocker.patch.object(boto3, "client", autospec=True).return_value = mock_s3
+    return mock_s3
+
+
+def test_handler__multi_bucket(mocker: MockerFixture, fan_out):
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", return_value=['15.230.56.104/31'], autospec=True)
+
+    def get_bucket_policy(s3_client, bucket_name):
+        if bucket_name == 'broken':
+            raise ValueError("access denied")
+        return {"Version": "2012-10-17", "Statement": []}
+    mocker.patch.object(restrict_region, "get_bucket_policy", side_effect=get_bucket_policy, autospec=True)
+    mock_update_bucket_policy = mocker.patch.object(restrict_region, "update_bucket_policy", autospec=True)
+
+    # function under test
+    with pytest.raises(fanout.BucketUpdateError) as e:
+        restrict_region.handler({}, {})
+
+    # the prefixes are fetched once and shared, and one broken bucket doesn't block the others
+    mock_get_ip_prefixes_for_region.assert_called_once_with(None)
+    assert sorted(call.args[1] for call in mock_update_bucket_policy.call_args_list) == ['bucket-a', 'bucket-c']
+    assert {name: result.status for name, result in e.value.results.items()} == {
+        'bucket-a': fanout.UPDATED, 'broken': fanout.FAILED, 'bucket-c': fanout.UPDATED}
+
+
+def test_restrict_buckets__delete(mocker: MockerFixture, fan_out):
+    mocker.patch.object(restrict_region, "BUCKET_NAMES", "bucket-a,bucket-c")
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", autospec=True)
+    mock_restrict_bucket = mocker.patch.object(restrict_region, "restrict_bucket", return_value=False, autospec=True)
+
+    results = restrict_region.restrict_buckets('Delete', None)
+
+    assert not mock_get_ip_prefixes_for_region.called
+    assert sorted(call.args[1:] for call in mock_restrict_bucket.call_args_list) == [
+        ('bucket-a', 'Delete', None), ('bucket-c', 'Delete', None)]
+    assert {name: result.status for name, result in results.items()} == {
+        'bucket-a': fanout.UNCHANGED, 'bucket-c': fanout.UNCHANGED}
+
+
+def test_restrict_buckets__notification_only_updates_buckets_that_have_not_applied_it(mocker: MockerFixture,
+                                                                                      fan_out):
+    notification = restrict_region.IpSpaceChanged('1613483053', 'md5', restrict_region.IP_RANGES_URL)
+    restrict_region.applied_sync_tokens.put('bucket-a', '1613483053')
+    mocker.patch.object(restrict_region, "get_ip_prefixes_for_region", return_value=['15.230.56.104/31'],
+                        autospec=True)
+    mock_restrict_bucket = mocker.patch.object(restrict_region, "restrict_bucket", return_value=True, autospec=True)
+    mocker.patch.object(restrict_region, "BUCKET_NAMES", "bucket-a,bucket-c")
+
+    restrict_region.restrict_buckets(None, notification)
+
+    mock_restrict_bucket.assert_called_once_with(fan_out, 'bucket-c', None, ['15.230.56.104/31'])
+    assert restrict_region.applied_sync_tokens.is_applied('bucket-c', '1613483053')
+
+
+def test_restrict_buckets__fetches_ip_prefixes_while_discovering_buckets(mocker: MockerFixture, fan_out):
+    both_started = threading.Barrier(2, timeout=5)
+
+    def discover_bucket_names(*args):
+        both_started.wait()
+        return ['bucket-a']
+
+    def get_ip_prefixes_for_region(notification):
+        both_started.wait()
+        return ['15.230.56.104/31']
+
+    mocker.patch.object(restrict_region, "discover_bucket_names", side_effect=discover_bucket_names)
+    mocker.patch.object(restrict_region, "get_ip_prefixes_for_region", side_effect=get_ip_prefixes_for_region,
+                        autospec=True)
+    mock_restrict_bucket = mocker.patch.object(restrict_region, "restrict_bucket", return_value=True, autospec=True)
+
+    restrict_region.restrict_buckets('Create', None)
+
+    mock_restrict_bucket.assert_called_once_with(fan_out, 'bucket-a', 'Create', ['15.230.56.104/31'])
+
+
+def test_restrict_buckets__fails_buckets_that_could_not_be_discovered(mocker: MockerFixture, fan_out):
+    mocker.patch.object(restrict_region, "discover_bucket_names",
+                        side_effect=fanout.DiscoveryError(['bucket-a'], {'unreachable': 'SlowDown'}))
+    mocker.patch.object(restrict_region, "get_ip_prefixes_for_region", return_value=['15.230.56.104/31'],
+                        autospec=True)
+    mock_restrict_bucket = mocker.patch.object(restrict_region, "restrict_bucket", return_value=True, autospec=True)
+
+    with pytest.raises(fanout.BucketUpdateError) as e:
+        restrict_region.restrict_buckets('Create', None)
+
+    mock_restrict_bucket.assert_called_once_with(fan_out, 'bucket-a', 'Create', ['15.230.56.104/31'])
+    assert e.value.results['unreachable'] == fanout.BucketResult('unreachable', fanout.FAILED, 'SlowDown')
+    assert e.value.results['bucket-a'].status == fanout.UPDATED
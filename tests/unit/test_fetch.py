@@ -0,0 +1,317 @@
+from restrict_download_region.fetch import FetchError, HedgedRequests, create_pool, request_before
+from restrict_download_region.notification import IpSpaceChanged
+import restrict_download_region.restrict_region as restrict_region
+from benchmarks.synthetic import synthetic_feed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pytest_mock import MockerFixture
+import gzip
+import hashlib
+import socket
+import struct
+import threading
+import time
+import pytest
+import urllib3
+
+
+class LocalFeed:
+    """
+    Serves a document on localhost, delaying, resetting (optionally after a delay), failing or trickling (pausing
+    between writes) requests as scripted. Each action is used by one request in arrival order, requests beyond
+    the script are answered right away. The document is sent gzip compressed to requests that accept it, in
+    writes of write_size bytes.
+    """
+
+    def __init__(self, body: bytes, write_size: int = 0):
+        self.body = body
+        self.compressed_body = gzip.compress(body)
+        self.write_size = write_size
+        self.actions = []
+        self.requests = 0
+        self.encodings = []
+        self._lock = threading.Lock()
+        feed = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with feed._lock:
+                    action = feed.actions[feed.requests] if feed.requests < len(feed.actions) else ('ok',)
+                    feed.requests += 1
+                if action[0] in ('delay', 'reset_after'):
+                    time.sleep(action[1])
+                if action[0] in ('reset', 'reset_after'):
+                    # abortive close, the client sees a connection reset
+                    self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                    self.close_connection = True
+                    self.connection.close()
+                    return
+                elif action[0] == 'status':
+                    self.send_response(action[1])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                encoding = 'gzip' if 'gzip' in self.headers.get('Accept-Encoding', '') else 'identity'
+                body = feed.compressed_body if encoding == 'gzip' else feed.body
+                feed.encodings.append(encoding)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if encoding == 'gzip':
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    write_size = feed.write_size or len(body)
+                    for offset in range(0, len(body), write_size):
+                        if action[0] == 'trickle' and offset:
+                            time.sleep(action[1])
+                        self.wfile.write(body[offset:offset + write_size])
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the losing hedged request was closed by the client
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/ip-ranges.json' % self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def __enter__(self) -> 'LocalFeed':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def feed(sample_ip_ranges_bytes):
+    with LocalFeed(sample_ip_ranges_bytes) as feed:
+        yield feed
+
+
+def test_read_timeout(feed):
+    feed.actions = [('delay', 2)]
+    pool = create_pool(connect_timeout=1, read_timeout=0.2, retries=0)
+
+    started = time.perf_counter()
+    with pytest.raises(urllib3.exceptions.MaxRetryError):
+        pool.request('GET', feed.url)
+
+    assert time.perf_counter() - started < 1
+
+
+def test_retries_reset_and_server_errors(feed, sample_ip_ranges_bytes):
+    feed.actions = [('reset',), ('status', 503)]
+    pool = create_pool(connect_timeout=1, read_timeout=1, retries=2)
+
+    resp = pool.request('GET', feed.url)
+
+    assert resp.status == 200
+    assert resp.data == sample_ip_ranges_bytes
+    assert feed.requests == 3
+
+
+def test_request_before__gives_up_on_a_trickling_body(feed):
+    feed.write_size = 16
+    feed.actions = [('trickle', 0.05)]
+
+    started = time.perf_counter()
+    with pytest.raises(FetchError, match="did not respond in time"):
+        request_before(create_pool(connect_timeout=1, read_timeout=1, retries=2), feed.url, time.monotonic() + 0.5)
+
+    # every read was answered well within the read timeout
+    assert time.perf_counter() - started < 1
+
+
+def test_request_before__retries_end_at_deadline(feed):
+    feed.actions = [('status', 503)] * 20
+
+    started = time.perf_counter()
+    resp = request_before(create_pool(connect_timeout=1, read_timeout=1, retries=20), feed.url,
+                          time.monotonic() + 0.5)
+
+    # no backoff is slept that ends past the deadline
+    assert resp.status == 503
+    assert time.perf_counter() - started < 0.5
+    assert feed.requests < 21
+
+
+def test_retries_are_bounded(feed):
+    feed.actions = [('reset',)] * 5
+    pool = create_pool(connect_timeout=1, read_timeout=1, retries=2)
+
+    with pytest.raises(urllib3.exceptions.MaxRetryError):
+        pool.request('GET', feed.url)
+
+    assert feed.requests == 3
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_get_ip_prefixes_for_region__server_errors_after_retries(mocker: MockerFixture, feed, stream):
+    feed.actions = [('status', 503)] * 2
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', stream)
+    mocker.patch.object(restrict_region, 'IP_RANGES_URL', feed.url)
+    mocker.patch.object(restrict_region, 'http', create_pool(1, 1, 1))
+
+    # the error page is not parsed
+    with pytest.raises(FetchError, match="ip-ranges.json returned 503"):
+        restrict_region.get_ip_prefixes_for_region()
+    assert feed.requests == 2
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_get_ip_prefixes_for_region__total_timeout(mocker: MockerFixture, feed, stream):
+    feed.write_size = 16
+    feed.actions = [('trickle', 0.05)]
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', stream)
+    mocker.patch.object(restrict_region, 'IP_RANGES_URL', feed.url)
+    mocker.patch.object(restrict_region, 'IP_RANGES_TOTAL_TIMEOUT', 0.5)
+    mocker.patch.object(restrict_region, 'http', create_pool(1, 1, 2))
+
+    started = time.perf_counter()
+    with pytest.raises(FetchError, match="in time"):
+        restrict_region.get_ip_prefixes_for_region()
+
+    # the body takes seconds to arrive, although no read exceeds the read timeout
+    assert time.perf_counter() - started < 1
+
+
+def test_publish_prefixes__server_errors_after_retries(mocker: MockerFixture, tmp_path, feed):
+    feed.actions = [('status', 502)] * 2
+    mocker.patch.object(restrict_region, 'PREFIX_STORE_DIR', str(tmp_path))
+    mocker.patch.object(restrict_region, 'IP_RANGES_URL', feed.url)
+    mocker.patch.object(restrict_region, 'http', create_pool(1, 1, 1))
+
+    with pytest.raises(FetchError, match="ip-ranges.json returned 502"):
+        restrict_region.publish_prefixes()
+    assert not list(tmp_path.iterdir())
+
+
+def test_get_ip_prefixes_for_region__not_modified_without_cache_entry(mocker: MockerFixture, feed):
+    feed.actions = [('status', 304)]
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'IP_RANGES_URL', feed.url)
+    mocker.patch.object(restrict_region, 'http', create_pool(1, 1, 0))
+
+    with pytest.raises(FetchError, match="returned 304"):
+        restrict_region.get_ip_prefixes_for_region()
+
+
+def test_hedged_request__second_request_wins(feed, sample_ip_ranges_bytes):
+    feed.actions = [('delay', 2)]
+    hedged = HedgedRequests(percentile=95, initial_delay=0.05)
+
+    started = time.perf_counter()
+    resp = hedged.request(create_pool(1, 5, 0), feed.url)
+
+    assert time.perf_counter() - started < 1
+    assert resp.data == sample_ip_ranges_bytes
+    assert feed.requests == 2
+
+
+def test_hedged_request__fast_response_is_not_hedged(feed, sample_ip_ranges_bytes):
+    hedged = HedgedRequests(percentile=95, initial_delay=1)
+
+    resp = hedged.request(create_pool(1, 5, 0), feed.url)
+
+    assert resp.data == sample_ip_ranges_bytes
+    time.sleep(0.05)
+    assert feed.requests == 1
+
+
+def test_hedged_request__first_failure_waits_for_hedge(feed, sample_ip_ranges_bytes):
+    # the first request is reset after the hedged one was sent, which is answered later
+    feed.actions = [('reset_after', 0.1), ('delay', 0.3)]
+    hedged = HedgedRequests(percentile=95, initial_delay=0.05)
+
+    resp = hedged.request(create_pool(1, 5, 0), feed.url)
+
+    assert resp.data == sample_ip_ranges_bytes
+
+
+def test_hedged_request__both_fail(feed):
+    feed.actions = [('reset',)]
+    hedged = HedgedRequests(percentile=95, initial_delay=1)
+
+    with pytest.raises(urllib3.exceptions.MaxRetryError):
+        hedged.request(create_pool(1, 1, 0), feed.url)
+
+
+def test_hedged_request__gives_up_at_deadline(feed):
+    feed.actions = [('delay', 2), ('delay', 2)]
+    hedged = HedgedRequests(percentile=95, initial_delay=0.05)
+
+    started = time.perf_counter()
+    with pytest.raises(FetchError, match="did not respond in time"):
+        hedged.request(create_pool(1, 5, 0), feed.url, time.monotonic() + 0.3)
+
+    assert time.perf_counter() - started < 1
+    assert feed.requests == 2
+
+
+def test_hedge_after_follows_latency_percentile():
+    hedged = HedgedRequests(percentile=90, initial_delay=2, window=10, min_samples=5)
+
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        hedged.record(latency)
+    assert hedged.hedge_after() == 2
+
+    for latency in (0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 5.0):
+        hedged.record(latency)
+    # the window keeps the last 10: 0.2 .. 1.0 and 5.0
+    assert hedged.hedge_after() == 1.0
+
+
+def test_get_ip_prefixes_for_region__hedged(mocker: MockerFixture, feed):
+    feed.actions = [('delay', 2)]
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'IP_RANGES_URL', feed.url)
+    mocker.patch.object(restrict_region, 'http', create_pool(1, 5, 0))
+    mocker.patch.object(restrict_region, 'hedged_requests', HedgedRequests(percentile=95, initial_delay=0.05))
+
+    started = time.perf_counter()
+    assert restrict_region.get_ip_prefixes_for_region() == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert time.perf_counter() - started < 1
+    assert feed.requests == 2
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("compression", [True, False])
+def test_get_ip_prefixes_for_region__compressed_and_identity(mocker: MockerFixture, feed, sample_ip_ranges_bytes,
+                                                            stream, compression):
+    notification = IpSpaceChanged('1613483053', hashlib.md5(sample_ip_ranges_bytes).hexdigest(), feed.url)
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', stream)
+    mocker.patch.object(restrict_region, 'IP_RANGES_COMPRESSION', compression)
+    mocker.patch.object(restrict_region, 'http', create_pool(1, 5, 0))
+
+    # the md5 is taken over the decompressed feed
+    assert restrict_region.get_ip_prefixes_for_region(notification) == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert feed.encodings == ['gzip' if compression else 'identity']
+
+
+def test_compressed_stream_is_decompressed_as_it_arrives():
+    body = synthetic_feed(scale=0.2)
+    with LocalFeed(body, write_size=1024) as feed:
+        resp = create_pool(1, 5, 0).request('GET', feed.url, headers={'Accept-Encoding': 'gzip'},
+                                            preload_content=False)
+
+        received = []
+        chunks = []
+        for chunk in resp.stream(4096):
+            received.append(resp.tell())
+            chunks.append(len(chunk))
+        resp.release_conn()
+
+    assert feed.encodings == ['gzip']
+    assert sum(chunks) == len(body)
+    # decompressed one chunk at a time, not after the whole compressed body was read
+    assert len(chunks) > 1
+    assert received[0] < received[-1] == len(feed.compressed_body)
+    assert len(feed.compressed_body) < len(body) / 4
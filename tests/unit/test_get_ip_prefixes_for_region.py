@@ -2,8 +2,10 @@ from pytest_mock import MockerFixture
 import restrict_download_region.restrict_region as restrict_region
 import pytest
 import urllib3
-import json
+import hashlib
 import pkg_resources
+from restrict_download_region.cache import CacheEntry, IpRangesCache
+from restrict_download_region.notification import IpSpaceChanged
 
 
 @pytest.mark.parametrize("region, expected", [
@@ -11,9 +13,10 @@ import pkg_resources
     ('eu-west-2', ['52.93.153.170/32', '2a05:d07a:c000::/40'])])
 def test_get_ip_prefixes_for_region(mocker: MockerFixture, region, expected):
     mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
 
-    mock_http.request.return_value.data.decode.return_value = json.dumps(json.load(
-        open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'))))
+    with open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'), 'rb') as f:
+        mock_http.request.return_value.data = f.read()
 
     mocker.patch.object(restrict_region, 'AWS_REGION', region)
 
@@ -25,3 +28,135 @@ def test_get_ip_prefixes_for_region__REGION_not_set(mocker: MockerFixture):
 
     with pytest.raises(ValueError):
         restrict_region.get_ip_prefixes_for_region()
+
+
+@pytest.mark.parametrize("region, expected", [
+    ('us-east-1', ['15.230.56.104/31', '2600:1f19:8000::/36']),
+    ('eu-west-2', ['52.93.153.170/32', '2a05:d07a:c000::/40'])])
+def test_get_ip_prefixes_for_region__streaming(mocker: MockerFixture, region, expected):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+
+    with open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'), 'rb') as f:
+        sample_ip_ranges = f.read()
+    mock_http.request.return_value.stream.return_value = iter([sample_ip_ranges[:100], sample_ip_ranges[100:]])
+
+    mocker.patch.object(restrict_region, 'AWS_REGION', region)
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', True)
+
+    assert restrict_region.get_ip_prefixes_for_region() == expected
+    mock_http.request.assert_called_once_with('GET', restrict_region.IP_RANGES_URL, headers={'Accept-Encoding': 'gzip'},
+                                              preload_content=False, retries=mocker.ANY)
+    mock_http.request.return_value.release_conn.assert_called_once_with()
+
+
+@pytest.fixture
+def ip_ranges_cache(mocker: MockerFixture, tmp_path):
+    cache = IpRangesCache(str(tmp_path), ttl=60, max_entries=4, max_bytes=1024 * 1024)
+    mocker.patch.object(restrict_region, 'ip_ranges_cache', cache)
+    return cache
+
+
+def test_get_ip_prefixes_for_region__stores_parsed_region_slice_in_cache(mocker: MockerFixture, ip_ranges_cache):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    with open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'), 'rb') as f:
+        mock_http.request.return_value.data = f.read()
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.headers = {'ETag': '"abc"', 'Last-Modified': 'Tue, 16 Feb 2021 13:44:13 GMT'}
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+
+    assert restrict_region.get_ip_prefixes_for_region() == ['15.230.56.104/31', '2600:1f19:8000::/36']
+
+    mock_http.request.assert_called_once_with('GET', restrict_region.IP_RANGES_URL, headers={'Accept-Encoding': 'gzip'},
+                                              preload_content=True, retries=mocker.ANY)
+    assert ip_ranges_cache.get('us-east-1')._replace(stored_at=0) == CacheEntry(
+        'us-east-1', '1613483053', ['15.230.56.104/31', '2600:1f19:8000::/36'],
+        '"abc"', 'Tue, 16 Feb 2021 13:44:13 GMT')
+
+
+def test_get_ip_prefixes_for_region__not_modified_uses_cache(mocker: MockerFixture, ip_ranges_cache):
+    ip_ranges_cache.put(CacheEntry('us-east-1', '1613483053', ['15.230.56.104/31'],
+                                   '"abc"', 'Tue, 16 Feb 2021 13:44:13 GMT'))
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 304
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    loads = mocker.spy(restrict_region.jsoncodec, 'loads')
+
+    assert restrict_region.get_ip_prefixes_for_region() == ['15.230.56.104/31']
+
+    mock_http.request.assert_called_once_with(
+        'GET', restrict_region.IP_RANGES_URL,
+        headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"abc"', 'If-Modified-Since': 'Tue, 16 Feb 2021 13:44:13 GMT'},
+        preload_content=True, retries=mocker.ANY)
+    assert not loads.called
+
+
+def notification_for(data: bytes, sync_token='1613483053'):
+    return IpSpaceChanged(sync_token, hashlib.md5(data).hexdigest(), 'https://ip-ranges.amazonaws.com/ip-ranges.json')
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_get_ip_prefixes_for_region__notification_md5_matches(mocker: MockerFixture, sample_ip_ranges_bytes, stream):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mock_http.request.return_value.stream.return_value = iter([sample_ip_ranges_bytes])
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', stream)
+
+    assert restrict_region.get_ip_prefixes_for_region(notification_for(sample_ip_ranges_bytes)) \
+        == ['15.230.56.104/31', '2600:1f19:8000::/36']
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_get_ip_prefixes_for_region__notification_md5_mismatch(mocker: MockerFixture, sample_ip_ranges_bytes, stream):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mock_http.request.return_value.stream.return_value = iter([sample_ip_ranges_bytes])
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', stream)
+
+    with pytest.raises(ValueError, match="does not match the advertised md5"):
+        restrict_region.get_ip_prefixes_for_region(notification_for(b'another feed'))
+
+
+def test_get_ip_prefixes_for_region__notification_older_than_downloaded_feed(mocker: MockerFixture,
+                                                                             sample_ip_ranges_bytes):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+
+    # the feed was republished between the notification and the download
+    assert restrict_region.get_ip_prefixes_for_region(notification_for(b'older feed', sync_token='1613400000')) \
+        == ['15.230.56.104/31', '2600:1f19:8000::/36']
+
+
+def test_get_ip_prefixes_for_region__notification_not_newer_than_cache(mocker: MockerFixture, ip_ranges_cache):
+    ip_ranges_cache.put(CacheEntry('us-east-1', '1613483053', ['15.230.56.104/31'], '"abc"'))
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+
+    assert restrict_region.get_ip_prefixes_for_region(notification_for(b'', sync_token='1613483053')) \
+        == ['15.230.56.104/31']
+    assert not mock_http.request.called
+
+
+def test_get_ip_prefixes_for_region__notification_newer_than_cache(mocker: MockerFixture, ip_ranges_cache,
+                                                                   sample_ip_ranges_bytes):
+    ip_ranges_cache.put(CacheEntry('us-east-1', '1613400000', ['15.230.56.104/31'], '"abc"'))
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.headers = {}
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+
+    assert restrict_region.get_ip_prefixes_for_region(notification_for(sample_ip_ranges_bytes)) \
+        == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    # no conditional headers, the cached copy is known to be stale
+    mock_http.request.assert_called_once_with('GET', 'https://ip-ranges.amazonaws.com/ip-ranges.json',
+                                              headers={'Accept-Encoding': 'gzip'}, preload_content=True,
+                                              retries=mocker.ANY)
+    assert ip_ranges_cache.get('us-east-1').sync_token == '1613483053'
@@ -1,6 +1,9 @@
 from restrict_download_region import cfnresponse, restrict_region
 from pytest_mock import MockerFixture
+import contextlib
 import pytest
+import threading
+import time
 
 
 def test_handle_custom_resource_status_message__successful_execution__not_custom_resource(mocker: MockerFixture):
@@ -62,3 +65,91 @@ def test_handle_custom_resource_status_message__failed_execution__is_custom_reso
             assert custom_resource_request_type == 'Create'
             stub_function()
     mock_cfn_send.assert_called_once_with(event, context, cfnresponse.FAILED, {"Data": ""})
+
+
+def lambda_context(mocker: MockerFixture, remaining_time_in_millis: int):
+    return mocker.Mock(log_stream_name='log-stream', get_remaining_time_in_millis=lambda: remaining_time_in_millis)
+
+
+def test_handle_custom_resource_status_message__watchdog_sends_failed_before_timeout(mocker: MockerFixture):
+    mocker.patch.object(restrict_region, "RESPONSE_DEADLINE_MARGIN_MS", 200)
+    sent = threading.Event()
+    mock_cfn_send = mocker.patch.object(cfnresponse, "send", autospec=True, side_effect=lambda *args, **kwargs: sent.set())
+
+    event = {"RequestType": "Update"}
+    context = lambda_context(mocker, 500)
+
+    with restrict_region.handle_custom_resource_status_message(event, context):
+        # stalls until the watchdog answered
+        assert sent.wait(5)
+
+    # the late SUCCESS is not sent after the FAILED response
+    mock_cfn_send.assert_called_once()
+    (_, _, status, data), kwargs = mock_cfn_send.call_args
+    assert status == cfnresponse.FAILED
+    assert kwargs['reason'].startswith("Timed out")
+    assert 'log-stream' in kwargs['reason']
+    assert kwargs['retries'] == 0
+    assert kwargs['timeout'] == 0.1
+
+
+def test_handle_custom_resource_status_message__watchdog_cancelled_when_done_in_time(mocker: MockerFixture):
+    mocker.patch.object(restrict_region, "RESPONSE_DEADLINE_MARGIN_MS", 1000)
+    mock_cfn_send = mocker.patch.object(cfnresponse, "send", autospec=True)
+
+    event = {"RequestType": "Create"}
+    context = lambda_context(mocker, 1200)
+
+    with restrict_region.handle_custom_resource_status_message(event, context):
+        pass
+    # past the watchdog's deadline
+    time.sleep(0.4)
+
+    mock_cfn_send.assert_called_once_with(event, context, cfnresponse.SUCCESS, {"Data": ""}, timeout=0.475, retries=0)
+
+
+@pytest.mark.parametrize("status, stub_function", [(cfnresponse.SUCCESS, lambda: None),
+                                                   (cfnresponse.FAILED, lambda: 1 / 0)])
+def test_handle_custom_resource_status_message__response_fits_remaining_time(mocker: MockerFixture, status,
+                                                                             stub_function):
+    mock_cfn_send = mocker.patch.object(cfnresponse, "send", autospec=True)
+    context = lambda_context(mocker, 12000)
+
+    with pytest.raises(ZeroDivisionError) if status == cfnresponse.FAILED else contextlib.nullcontext():
+        with restrict_region.handle_custom_resource_status_message({"RequestType": "Create"}, context):
+            stub_function()
+
+    (_, _, sent_status, _), kwargs = mock_cfn_send.call_args
+    assert sent_status == status
+    assert kwargs == restrict_region.response_send_budget(12000)
+
+
+def worst_case_seconds(timeout: float, retries: int) -> float:
+    return 2 * timeout * (retries + 1) + sum(cfnresponse.DEFAULT_BACKOFF * 2 ** attempt for attempt in range(retries))
+
+
+@pytest.mark.parametrize("remaining_ms", [100, 1000, 3000, 6000, 12000, 25000, 29000])
+def test_response_send_budget__fits_remaining_time(remaining_ms):
+    budget = restrict_region.response_send_budget(remaining_ms)
+
+    assert 0 <= budget['retries'] <= cfnresponse.DEFAULT_RETRIES
+    assert 0 < budget['timeout'] <= cfnresponse.DEFAULT_TIMEOUT
+    if remaining_ms >= 1000:
+        assert worst_case_seconds(**budget) <= remaining_ms / 1000
+
+
+def test_response_send_budget__defaults_with_plenty_of_time():
+    assert restrict_region.response_send_budget(900000) == {'timeout': cfnresponse.DEFAULT_TIMEOUT,
+                                                            'retries': cfnresponse.DEFAULT_RETRIES}
+    # cfnresponse's defaults alone could take 83.5 s
+    assert restrict_region.response_send_budget(30000)['timeout'] < cfnresponse.DEFAULT_TIMEOUT
+
+
+def test_custom_resource_responder__short_timeout_keeps_half_for_work(mocker: MockerFixture):
+    mock_timer = mocker.patch.object(restrict_region.threading, "Timer", autospec=True)
+
+    responder = restrict_region.CustomResourceResponder({}, lambda_context(mocker, 3000), 5000)
+    responder.start_watchdog()
+
+    mock_timer.assert_called_once_with(1.5, responder._on_deadline, (1500,))
+    mock_timer.return_value.start.assert_called_once_with()
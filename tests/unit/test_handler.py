@@ -1,9 +1,10 @@
 import restrict_download_region.restrict_region as restrict_region
-import json
+import threading
 import pytest
 import boto3
 from pytest_mock import MockerFixture
 from botocore.stub import Stubber
+from restrict_download_region.notification import IpSpaceChanged
 
 
 @pytest.fixture
@@ -18,6 +19,11 @@ def bucket_policy():
     }
 
 
+@pytest.fixture
+def region_ip_prefixes():
+    return ["3.5.140.0/22", "52.94.6.0/24"]
+
+
 @pytest.fixture
 def context():
     # we don't care what's in this object
@@ -28,7 +34,8 @@ def context():
 def test_handler__cfn_create_and_update_events(mocker: MockerFixture,
                                                cfn_request_type,
                                                context,
-                                               bucket_policy):
+                                               bucket_policy,
+                                               region_ip_prefixes):
 
     cfn_event = {
         "RequestType": cfn_request_type,
@@ -50,6 +57,8 @@ def test_handler__cfn_create_and_update_events(mocker: MockerFixture,
 
     mock_get_bucket_policy = mocker.patch.object(
         restrict_region, "get_bucket_policy", return_value=bucket_policy, autospec=True)
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", return_value=region_ip_prefixes, autospec=True)
     mock_process_ip_restrict_policy = mocker.patch.object(
         restrict_region, "process_ip_restrict_policy", autospec=True)
     mock_update_bucket_policy = mocker.patch.object(
@@ -60,8 +69,9 @@ def test_handler__cfn_create_and_update_events(mocker: MockerFixture,
 
     mock_handle_custom_resource_message.assert_called_once_with(cfn_event, context)
     mock_get_bucket_policy.assert_called_once_with(mock_s3, bucket_name)
+    mock_get_ip_prefixes_for_region.assert_called_once_with(None)
     mock_process_ip_restrict_policy.assert_called_once_with(
-        bucket_name, cfn_request_type, bucket_policy)
+        bucket_name, cfn_request_type, bucket_policy, region_ip_prefixes)
     mock_update_bucket_policy.assert_called_once_with(mock_s3, bucket_name, bucket_policy)
 
 
@@ -95,6 +105,8 @@ def test_handler__cfn_delete_event(mocker: MockerFixture, context, bucket_policy
 
     mock_get_bucket_policy = mocker.patch.object(
         restrict_region, "get_bucket_policy", return_value=bucket_policy, autospec=True)
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", autospec=True)
     mock_process_ip_restrict_policy = mocker.patch.object(
         restrict_region, "process_ip_restrict_policy", autospec=True)
     mock_update_bucket_policy = mocker.patch.object(
@@ -105,12 +117,13 @@ def test_handler__cfn_delete_event(mocker: MockerFixture, context, bucket_policy
 
     mock_handle_custom_resource_message.assert_called_once_with(delete_event, context)
     mock_get_bucket_policy.assert_called_once_with(mock_s3, bucket_name)
+    assert not mock_get_ip_prefixes_for_region.called
     mock_process_ip_restrict_policy.assert_called_once_with(
-        bucket_name, "Delete", bucket_policy)
+        bucket_name, "Delete", bucket_policy, None)
     mock_update_bucket_policy.assert_called_once_with(mock_s3, bucket_name, bucket_policy)
 
 
-def test_handler__sns_event(mocker: MockerFixture, context, bucket_policy):
+def test_handler__sns_event(mocker: MockerFixture, context, bucket_policy, region_ip_prefixes):
 
     sns_event = {
         "Records": [
@@ -139,6 +152,8 @@ def test_handler__sns_event(mocker: MockerFixture, context, bucket_policy):
 
     mock_get_bucket_policy = mocker.patch.object(
         restrict_region, "get_bucket_policy", return_value=bucket_policy, autospec=True)
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", return_value=region_ip_prefixes, autospec=True)
     mock_process_ip_restrict_policy = mocker.patch.object(
         restrict_region, "process_ip_restrict_policy", autospec=True)
     mock_update_bucket_policy = mocker.patch.object(
@@ -151,6 +166,127 @@ def test_handler__sns_event(mocker: MockerFixture, context, bucket_policy):
 
     # there should be 2 calls for each function since we found 2 buckets
     mock_get_bucket_policy.assert_called_once_with(mock_s3, bucket_name)
+    mock_get_ip_prefixes_for_region.assert_called_once_with(None)
+    mock_process_ip_restrict_policy.assert_called_once_with(
+        bucket_name, None, bucket_policy, region_ip_prefixes)
+    mock_update_bucket_policy.assert_called_once_with(mock_s3, bucket_name, bucket_policy)
+
+
+def test_handler__ip_space_changed_event(mocker: MockerFixture, context, bucket_policy, region_ip_prefixes,
+                                         ip_space_changed_event):
+    bucket_name = "my-bucket-name"
+    mocker.patch.object(restrict_region, "AWS_REGION", "us-east-1")
+    mocker.patch.object(restrict_region, "BUCKET_NAME", bucket_name)
+
+    mock_s3 = mocker.MagicMock(boto3.client('s3'))
+    mocker.patch.object(boto3, "client", autospec=True).return_value = mock_s3
+    mocker.patch.object(restrict_region, "get_bucket_policy", return_value=bucket_policy, autospec=True)
+    mock_get_ip_prefixes_for_region = mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", return_value=region_ip_prefixes, autospec=True)
+    mock_process_ip_restrict_policy = mocker.patch.object(
+        restrict_region, "process_ip_restrict_policy", autospec=True)
+    mock_update_bucket_policy = mocker.patch.object(
+        restrict_region, "update_bucket_policy", autospec=True)
+
+    # function under test
+    restrict_region.handler(ip_space_changed_event, context)
+
+    notification = IpSpaceChanged('1613483053', '627bf6e5a9b356adc35ec5acc6befbd1',
+                                  'https://ip-ranges.amazonaws.com/ip-ranges.json', '2021-02-16T13:44:13+00:00')
+    mock_get_ip_prefixes_for_region.assert_called_once_with(notification)
     mock_process_ip_restrict_policy.assert_called_once_with(
-        bucket_name, None, bucket_policy)
+        bucket_name, None, bucket_policy, region_ip_prefixes)
     mock_update_bucket_policy.assert_called_once_with(mock_s3, bucket_name, bucket_policy)
+    assert restrict_region.applied_sync_tokens.get(bucket_name) == '1613483053'
+
+
+@pytest.mark.parametrize("applied_sync_token", ['1613483053', '1613483054'])
+def test_handler__ip_space_changed_event__already_applied(mocker: MockerFixture, context, ip_space_changed_event,
+                                                          applied_sync_token):
+    bucket_name = "my-bucket-name"
+    mocker.patch.object(restrict_region, "AWS_REGION", "us-east-1")
+    mocker.patch.object(restrict_region, "BUCKET_NAME", bucket_name)
+    restrict_region.applied_sync_tokens.put(bucket_name, applied_sync_token)
+
+    mock_boto3_client = mocker.patch.object(boto3, "client", autospec=True)
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_get_bucket_policy = mocker.patch.object(restrict_region, "get_bucket_policy", autospec=True)
+    mock_update_bucket_policy = mocker.patch.object(restrict_region, "update_bucket_policy", autospec=True)
+
+    # function under test
+    restrict_region.handler(ip_space_changed_event, context)
+
+    assert not mock_boto3_client.called
+    assert not mock_http.request.called
+    assert not mock_get_bucket_policy.called
+    assert not mock_update_bucket_policy.called
+
+
+def test_handler__region_prefixes_unchanged(mocker: MockerFixture, context, bucket_policy, region_ip_prefixes,
+                                            ip_space_changed_event):
+    bucket_name = "my-bucket-name"
+    mocker.patch.object(restrict_region, "AWS_REGION", "us-east-1")
+    mocker.patch.object(restrict_region, "BUCKET_NAME", bucket_name)
+
+    mocker.patch.object(boto3, "client", autospec=True).return_value = mocker.MagicMock(boto3.client('s3'))
+    mocker.patch.object(restrict_region, "get_bucket_policy", return_value=bucket_policy, autospec=True)
+    mocker.patch.object(
+        restrict_region, "get_ip_prefixes_for_region", return_value=region_ip_prefixes, autospec=True)
+    mocker.patch.object(restrict_region, "process_ip_restrict_policy", return_value=False, autospec=True)
+    mock_update_bucket_policy = mocker.patch.object(
+        restrict_region, "update_bucket_policy", autospec=True)
+
+    # function under test
+    restrict_region.handler(ip_space_changed_event, context)
+
+    assert not mock_update_bucket_policy.called
+    assert restrict_region.applied_sync_tokens.get(bucket_name) == '1613483053'
+
+
+def test_handler__fetches_ip_prefixes_while_reading_bucket_policy(mocker: MockerFixture, context, bucket_policy,
+                                                                  region_ip_prefixes):
+    bucket_name = "my-bucket-name"
+    mocker.patch.object(restrict_region, "AWS_REGION", "us-east-1")
+    mocker.patch.object(restrict_region, "BUCKET_NAME", bucket_name)
+    mocker.patch.object(boto3, "client", autospec=True).return_value = mocker.MagicMock(boto3.client('s3'))
+
+    # both calls only return once the other one has started, so they must run concurrently
+    both_started = threading.Barrier(2, timeout=5)
+
+    def get_bucket_policy(s3_client, bucket_name):
+        both_started.wait()
+        return bucket_policy
+
+    def get_ip_prefixes_for_region(notification):
+        both_started.wait()
+        return region_ip_prefixes
+
+    mocker.patch.object(restrict_region, "get_bucket_policy", side_effect=get_bucket_policy, autospec=True)
+    mocker.patch.object(restrict_region, "get_ip_prefixes_for_region", side_effect=get_ip_prefixes_for_region,
+                        autospec=True)
+    mock_process_ip_restrict_policy = mocker.patch.object(
+        restrict_region, "process_ip_restrict_policy", autospec=True)
+    mocker.patch.object(restrict_region, "update_bucket_policy", autospec=True)
+    mock_cfn_send = mocker.patch.object(restrict_region.cfnresponse, "send", autospec=True)
+
+    # function under test
+    event = {"RequestType": "Update", "ResponseURL": "url"}
+    restrict_region.handler(event, context)
+
+    mock_process_ip_restrict_policy.assert_called_once_with(
+        bucket_name, "Update", bucket_policy, region_ip_prefixes)
+    mock_cfn_send.assert_called_once_with(event, context, restrict_region.cfnresponse.SUCCESS, {'Data': ''})
+
+
+def test_handler__fetch_failure_is_raised(mocker: MockerFixture, context, bucket_policy):
+    mocker.patch.object(restrict_region, "AWS_REGION", "us-east-1")
+    mocker.patch.object(restrict_region, "BUCKET_NAME", "my-bucket-name")
+    mocker.patch.object(boto3, "client", autospec=True).return_value = mocker.MagicMock(boto3.client('s3'))
+    mocker.patch.object(restrict_region, "get_bucket_policy", return_value=bucket_policy, autospec=True)
+    mocker.patch.object(restrict_region, "get_ip_prefixes_for_region", side_effect=ValueError("md5 mismatch"),
+                        autospec=True)
+    mock_update_bucket_policy = mocker.patch.object(restrict_region, "update_bucket_policy", autospec=True)
+
+    with pytest.raises(ValueError, match="md5 mismatch"):
+        restrict_region.handler({}, context)
+    assert not mock_update_bucket_policy.called
@@ -0,0 +1,134 @@
+from restrict_download_region.ip_ranges import RegionIndex, iter_ip_ranges, stream_ip_prefixes_for_region
+import restrict_download_region.restrict_region as restrict_region
+from benchmarks.synthetic import synthetic_feed_chunks
+import json
+import tracemalloc
+import pytest
+
+
+def split(data: bytes, chunk_size: int):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def full_parse_prefixes(data: bytes, region: str):
+    all_ip_prefixes = json.loads(data.decode('utf-8'))
+    return restrict_region.ip_prefixes_for_region(all_ip_prefixes['prefixes'], 'ip_prefix', region) + \
+        restrict_region.ip_prefixes_for_region(all_ip_prefixes['ipv6_prefixes'], 'ipv6_prefix', region)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1024 * 1024])
+@pytest.mark.parametrize("region", ['us-east-1', 'eu-west-2', 'GLOBAL', 'nowhere-1'])
+def test_stream_ip_prefixes_for_region__matches_full_parse(sample_ip_ranges_bytes, chunk_size, region):
+    assert list(stream_ip_prefixes_for_region(split(sample_ip_ranges_bytes, chunk_size), region)) \
+        == full_parse_prefixes(sample_ip_ranges_bytes, region)
+
+
+def test_iter_ip_ranges__yields_top_level_values_and_entries(sample_ip_ranges_bytes):
+    parsed = json.loads(sample_ip_ranges_bytes)
+    items = list(iter_ip_ranges(split(sample_ip_ranges_bytes, 5)))
+
+    assert ('syncToken', parsed['syncToken']) in items
+    assert ('createDate', parsed['createDate']) in items
+    assert [entry for key, entry in items if key == 'prefixes'] == parsed['prefixes']
+    assert [entry for key, entry in items if key == 'ipv6_prefixes'] == parsed['ipv6_prefixes']
+
+
+def test_iter_ip_ranges__multibyte_characters_and_numbers_split_across_chunks():
+    data = '{"syncToken": 1613483053, "note": "café", "prefixes": [], "ipv6_prefixes": [ ]}'.encode('utf-8')
+
+    assert list(iter_ip_ranges(split(data, 1))) == [('syncToken', 1613483053), ('note', 'café')]
+
+
+@pytest.mark.parametrize("data", [b'', b'{"prefixes": [{"ip_prefix": "1.2.3.4/32"}', b'["prefixes"]',
+                                  b'{"prefixes": [{}] "ipv6_prefixes": []}'])
+def test_iter_ip_ranges__malformed_document(data):
+    with pytest.raises(ValueError):
+        list(iter_ip_ranges(split(data, 3)))
+
+
+def test_stream_ip_prefixes_for_region__lower_peak_memory_than_full_parse():
+    chunks = list(synthetic_feed_chunks(scale=1, chunk_size=restrict_region.IP_RANGES_CHUNK_SIZE))
+
+    tracemalloc.start()
+    expected = full_parse_prefixes(b''.join(chunks), 'us-east-1')
+    _, full_parse_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    streamed = list(stream_ip_prefixes_for_region(chunks, 'us-east-1'))
+    _, streaming_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert streamed == expected
+    assert streaming_peak * 10 < full_parse_peak
+
+
+def test_region_index__matches_linear_scan(sample_ip_ranges_bytes):
+    document = json.loads(sample_ip_ranges_bytes)
+    index = RegionIndex.from_ip_ranges(iter_ip_ranges(split(sample_ip_ranges_bytes, 100)))
+
+    assert index.sync_token == document['syncToken']
+    assert index.create_date == document['createDate']
+    for region in {entry['region'] for entry in document['prefixes'] + document['ipv6_prefixes']}:
+        assert list(index.prefixes(region)) == full_parse_prefixes(sample_ip_ranges_bytes, region)
+    assert index.prefixes('nowhere-1') == ()
+
+
+def test_region_index__queries_by_region_service_and_network_border_group():
+    index = RegionIndex.from_document({
+        'syncToken': '1613483053',
+        'prefixes': [
+            {'ip_prefix': '3.5.140.0/22', 'region': 'us-east-1', 'service': 'AMAZON',
+             'network_border_group': 'us-east-1'},
+            {'ip_prefix': '15.181.232.0/21', 'region': 'us-east-1', 'service': 'AMAZON',
+             'network_border_group': 'us-east-1-iah-1'},
+            {'ip_prefix': '3.5.140.0/23', 'region': 'us-east-1', 'service': 'S3',
+             'network_border_group': 'us-east-1'},
+            {'ip_prefix': '52.94.6.0/24', 'region': 'eu-west-2', 'service': 'S3',
+             'network_border_group': 'eu-west-2'}
+        ],
+        'ipv6_prefixes': [
+            {'ipv6_prefix': '2600:1f19:8000::/36', 'region': 'us-east-1', 'service': 'AMAZON',
+             'network_border_group': 'us-east-1'}
+        ]
+    })
+
+    assert index.prefixes('us-east-1') == ('3.5.140.0/22', '15.181.232.0/21', '2600:1f19:8000::/36')
+    assert index.prefixes('us-east-1', 'AMAZON', 'us-east-1-iah-1') == ('15.181.232.0/21',)
+    assert index.prefixes('us-east-1', 'S3') == ('3.5.140.0/23',)
+    assert index.prefixes('us-east-1', None) == ('3.5.140.0/22', '15.181.232.0/21', '3.5.140.0/23',
+                                                 '2600:1f19:8000::/36')
+    assert index.prefixes(None, 'S3') == ('3.5.140.0/23', '52.94.6.0/24')
+    assert len(index.prefixes(None, None)) == 5
+    assert index.regions() == ['eu-west-2', 'us-east-1']
+    assert index.services() == ['AMAZON', 'S3']
+
+    # answers are built once and can't be changed by the callers sharing them
+    assert index.prefixes('us-east-1') is index.prefixes('us-east-1')
+    with pytest.raises(AttributeError):
+        index.prefixes('us-east-1').append('0.0.0.0/0')
+
+
+def test_region_index__serialization_round_trip(sample_ip_ranges_bytes):
+    index = RegionIndex.from_document(json.loads(sample_ip_ranges_bytes))
+
+    restored = RegionIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+
+    assert restored.sync_token == index.sync_token
+    assert restored.create_date == index.create_date
+    for region in index.regions():
+        for service in index.services() + [None]:
+            assert restored.prefixes(region, service) == index.prefixes(region, service)
+
+
+def test_region_index__synthetic_feed_matches_linear_scan():
+    data = b''.join(synthetic_feed_chunks(scale=0.2))
+    index = RegionIndex.from_ip_ranges(iter_ip_ranges([data]))
+    document = json.loads(data)
+
+    for service in ('AMAZON', 'EC2'):
+        linear = [item['ip_prefix'] for item in document['prefixes']
+                  if item['service'] == service and item['region'] == 'us-west-2'] + \
+            [item['ipv6_prefix'] for item in document['ipv6_prefixes']
+             if item['service'] == service and item['region'] == 'us-west-2']
+        assert list(index.prefixes('us-west-2', service)) == linear
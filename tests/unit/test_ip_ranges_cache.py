@@ -0,0 +1,151 @@
+from restrict_download_region.cache import CacheEntry, IpRangesCache
+import gzip
+import json
+import os
+import time
+import pytest
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / 'ip-ranges-cache')
+
+
+def new_cache(cache_dir, ttl=60, max_entries=4, max_bytes=1024 * 1024):
+    return IpRangesCache(cache_dir, ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
+
+
+def entry(region='us-east-1', sync_token='1613483053'):
+    return CacheEntry(region, sync_token, ['15.230.56.104/31', '2600:1f19:8000::/36'], '"etag"', None)
+
+
+def test_ip_ranges_cache__miss(cache_dir):
+    assert new_cache(cache_dir).get('us-east-1') is None
+
+
+def test_ip_ranges_cache__memory_hit(cache_dir):
+    cache = new_cache(cache_dir)
+    stored = cache.put(entry())
+
+    assert cache.get('us-east-1') == stored
+    assert cache.get('eu-west-2') is None
+
+
+def test_ip_ranges_cache__file_hit_in_new_process(cache_dir):
+    stored = new_cache(cache_dir).put(entry())
+
+    # a fresh cache object has an empty memory tier, like a new python process
+    assert new_cache(cache_dir).get('us-east-1') == stored
+
+
+def test_ip_ranges_cache__newest_sync_token_wins(cache_dir):
+    cache = new_cache(cache_dir)
+    cache.put(entry(sync_token='1'))
+    time.sleep(0.01)
+    newest = cache.put(entry(sync_token='2'))
+
+    assert cache.get('us-east-1') == newest
+    assert new_cache(cache_dir).get('us-east-1') == newest
+
+
+def test_ip_ranges_cache__ttl_expiry(cache_dir):
+    cache = new_cache(cache_dir, ttl=0.05)
+    cache.put(entry())
+    time.sleep(0.1)
+
+    assert cache.get('us-east-1') is None
+    assert new_cache(cache_dir, ttl=0.05).get('us-east-1') is None
+    assert os.listdir(cache_dir) == []
+
+
+def test_ip_ranges_cache__evicts_oldest_beyond_max_entries(cache_dir):
+    cache = new_cache(cache_dir, max_entries=2)
+    for region in ('us-east-1', 'us-west-2', 'eu-west-2'):
+        cache.put(entry(region=region))
+        time.sleep(0.01)
+
+    assert sorted(os.listdir(cache_dir)) == ['eu-west-2.1613483053.json.gz', 'us-west-2.1613483053.json.gz']
+    assert new_cache(cache_dir).get('us-east-1') is None
+    assert cache.get('us-east-1') is None
+
+
+def test_ip_ranges_cache__evicts_oldest_beyond_max_bytes(cache_dir):
+    cache = new_cache(cache_dir)
+    cache.put(entry(region='us-east-1'))
+    file_size = os.path.getsize(os.path.join(cache_dir, 'us-east-1.1613483053.json.gz'))
+    cache.max_bytes = file_size + file_size // 2
+    time.sleep(0.01)
+    cache.put(entry(region='us-west-2'))
+
+    assert os.listdir(cache_dir) == ['us-west-2.1613483053.json.gz']
+
+
+@pytest.mark.parametrize("contents", ['', '{"region": "us-east-1", "sync_token": "1613', 'null',
+                                      json.dumps({'region': 'us-east-1', 'unexpected': 1}),
+                                      json.dumps({'region': 'eu-west-2', 'sync_token': '1', 'prefixes': []})])
+def test_ip_ranges_cache__corrupt_or_half_written_file_is_discarded(cache_dir, contents):
+    os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, 'us-east-1.1613483053.json.gz')
+    with gzip.open(path, 'wt') as f:
+        f.write(contents)
+
+    assert new_cache(cache_dir).get('us-east-1') is None
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("truncate", [0, 5, 30])
+def test_ip_ranges_cache__truncated_or_uncompressed_file_is_discarded(cache_dir, truncate):
+    new_cache(cache_dir).put(entry())
+    path = os.path.join(cache_dir, 'us-east-1.1613483053.json.gz')
+    with open(path, 'rb') as f:
+        compressed = f.read()
+    with open(path, 'wb') as f:
+        f.write(compressed[:truncate] if truncate else json.dumps(entry()._asdict()).encode('utf-8'))
+
+    assert new_cache(cache_dir).get('us-east-1') is None
+    assert not os.path.exists(path)
+
+
+def test_ip_ranges_cache__files_are_compressed(cache_dir):
+    prefixes = ['10.%d.%d.0/24' % (i // 256, i % 256) for i in range(2000)]
+    new_cache(cache_dir).put(CacheEntry('us-east-1', '1613483053', prefixes))
+    path = os.path.join(cache_dir, 'us-east-1.1613483053.json.gz')
+
+    with gzip.open(path, 'rt') as f:
+        assert json.load(f)['prefixes'] == prefixes
+    assert os.path.getsize(path) < len(json.dumps(prefixes)) / 3
+
+
+def test_ip_ranges_cache__uncompressed_files_of_earlier_versions_are_removed(cache_dir):
+    os.makedirs(cache_dir)
+    uncompressed = os.path.join(cache_dir, 'us-east-1.1613400000.json')
+    with open(uncompressed, 'w') as f:
+        json.dump(entry(sync_token='1613400000')._asdict(), f)
+
+    cache = new_cache(cache_dir)
+    assert cache.get('us-east-1') is None
+    cache.put(entry())
+
+    assert os.listdir(cache_dir) == ['us-east-1.1613483053.json.gz']
+
+
+def test_ip_ranges_cache__abandoned_temporary_files_are_removed(cache_dir):
+    os.makedirs(cache_dir)
+    abandoned = os.path.join(cache_dir, 'abandoned.tmp')
+    with open(abandoned, 'w') as f:
+        f.write('{"region": "us-')
+    os.utime(abandoned, (0, 0))
+
+    new_cache(cache_dir).put(entry())
+
+    assert os.listdir(cache_dir) == ['us-east-1.1613483053.json.gz']
+
+
+def test_ip_ranges_cache__unwritable_directory_still_caches_in_memory(tmp_path):
+    not_a_directory = tmp_path / 'file'
+    not_a_directory.write_text('')
+    cache = new_cache(str(not_a_directory))
+
+    stored = cache.put(entry())
+
+    assert cache.get('us-east-1') == stored
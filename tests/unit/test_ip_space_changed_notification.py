@@ -0,0 +1,69 @@
+from restrict_download_region.notification import (AppliedSyncTokens, IpSpaceChanged, is_sync_token_newer,
+                                                   parse_ip_space_changed)
+import copy
+import json
+import pytest
+
+
+def with_message(event, message):
+    event = copy.deepcopy(event)
+    event['Records'][0]['Sns']['Message'] = message
+    return event
+
+
+def test_parse_ip_space_changed(ip_space_changed_event):
+    assert parse_ip_space_changed(ip_space_changed_event) == IpSpaceChanged(
+        '1613483053', '627bf6e5a9b356adc35ec5acc6befbd1', 'https://ip-ranges.amazonaws.com/ip-ranges.json',
+        '2021-02-16T13:44:13+00:00')
+
+
+@pytest.mark.parametrize("event", [
+    {},
+    {"RequestType": "Create"},
+    {"Records": []},
+    {"Records": [{"Sns": {}}]}])
+def test_parse_ip_space_changed__not_a_notification(event):
+    assert parse_ip_space_changed(event) is None
+
+
+@pytest.mark.parametrize("message", [
+    "Hello from SNS!",
+    json.dumps({"synctoken": "1613483053", "url": "https://ip-ranges.amazonaws.com/ip-ranges.json"}),
+    # never download the feed from anywhere but Amazon
+    json.dumps({"synctoken": "1613483053", "md5": "627bf6e5a9b356adc35ec5acc6befbd1",
+                "url": "https://example.com/ip-ranges.json"})])
+def test_parse_ip_space_changed__unexpected_message(ip_space_changed_event, message):
+    assert parse_ip_space_changed(with_message(ip_space_changed_event, message)) is None
+
+
+def test_parse_ip_space_changed__other_topic(ip_space_changed_event):
+    ip_space_changed_event['Records'][0]['Sns']['TopicArn'] = 'arn:aws:sns:us-east-2:123456789012:sns-lambda'
+
+    assert parse_ip_space_changed(ip_space_changed_event) is None
+
+
+@pytest.mark.parametrize("sync_token, than, expected", [
+    ('1613483054', '1613483053', True),
+    ('1613483053', '1613483053', False),
+    ('1613483052', '1613483053', False),
+    ('1613483053', None, True),
+    (None, '1613483053', False)])
+def test_is_sync_token_newer(sync_token, than, expected):
+    assert is_sync_token_newer(sync_token, than) == expected
+
+
+def test_applied_sync_tokens__persisted_across_processes(tmp_path):
+    AppliedSyncTokens(str(tmp_path)).put('my-bucket', '1613483053')
+
+    applied_sync_tokens = AppliedSyncTokens(str(tmp_path))
+    assert applied_sync_tokens.get('my-bucket') == '1613483053'
+    assert applied_sync_tokens.is_applied('my-bucket', '1613483053')
+    assert applied_sync_tokens.is_applied('my-bucket', '1613483000')
+    assert not applied_sync_tokens.is_applied('my-bucket', '1613483054')
+    assert not applied_sync_tokens.is_applied('other-bucket', '1613483053')
+
+
+def test_applied_sync_tokens__corrupt_file_is_ignored(tmp_path):
+    (tmp_path / 'my-bucket.applied').write_text('{"sync_tok')
+
+    assert AppliedSyncTokens(str(tmp_path)).get('my-bucket') is None
@@ -0,0 +1,83 @@
+from restrict_download_region import cfnresponse, jsoncodec
+from restrict_download_region.policy import serialize_bucket_policy
+import restrict_download_region.restrict_region as restrict_region
+from pytest_mock import MockerFixture
+import json
+import pytest
+
+
+@pytest.fixture(params=['json', 'orjson'])
+def backend(request, mocker: MockerFixture):
+    # orjson is a dependency, a missing backend fails instead of silently testing one
+    return mocker.patch.object(jsoncodec, 'backend', jsoncodec.select_backend(request.param))
+
+
+@pytest.fixture
+def policy():
+    statement = restrict_region.generate_ip_address_policy(
+        'my-bucket', ['3.%d.%d.0/24' % (i // 256, i % 256) for i in range(2000)] + ['2600:1f18::/33'])
+    return {'Version': '2012-10-17', 'Id': 'Zürich',
+            'Statement': [statement, {'Sid': 'Other', 'Effect': 'Allow', 'Principal': {'AWS': '111122223333'},
+                                      'Action': ['s3:GetObject'], 'Resource': 'arn:aws:s3:::my-bucket/*',
+                                      'Condition': {'NumericLessThan': {'s3:max-keys': 10}, 'Bool': {
+                                          'aws:SecureTransport': True}}}]}
+
+
+def test_loads(backend, sample_ip_ranges_bytes):
+    expected = json.loads(sample_ip_ranges_bytes)
+
+    assert jsoncodec.loads(sample_ip_ranges_bytes) == expected
+    assert jsoncodec.loads(sample_ip_ranges_bytes.decode('utf-8')) == expected
+
+
+def test_loads__malformed(backend):
+    with pytest.raises(ValueError):
+        jsoncodec.loads(b'{"syncToken": ')
+
+
+@pytest.mark.parametrize("sort_keys", [False, True])
+def test_dumps__same_bytes_as_json_module(backend, policy, sort_keys):
+    assert jsoncodec.dumps(policy, sort_keys) == \
+        json.dumps(policy, separators=(',', ':'), sort_keys=sort_keys, ensure_ascii=False)
+
+
+def test_dumps__falls_back_for_what_the_backend_rejects(backend):
+    assert jsoncodec.dumps({'count': 2 ** 70}) == '{"count":1180591620717411303424}'
+
+
+def test_serialize_bucket_policy__identical_across_backends(mocker: MockerFixture, policy):
+    serialized = set()
+    for backend in jsoncodec.BACKENDS.values():
+        mocker.patch.object(jsoncodec, 'backend', backend)
+        serialized.add(serialize_bucket_policy(policy))
+
+    assert len(serialized) == 1
+
+
+def test_select_backend():
+    assert jsoncodec.select_backend('json').name == 'json'
+    assert jsoncodec.select_backend().name == 'orjson'
+    with pytest.raises(ValueError):
+        jsoncodec.select_backend('simdjson')
+
+
+def test_get_ip_prefixes_for_region__parses_the_response_bytes(mocker: MockerFixture, backend,
+                                                               sample_ip_ranges_bytes):
+    mock_http = mocker.patch.object(restrict_region, 'http', autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'eu-west-2')
+
+    assert restrict_region.get_ip_prefixes_for_region() == ['52.93.153.170/32', '2a05:d07a:c000::/40']
+
+
+def test_cfnresponse_content_length_counts_bytes(mocker: MockerFixture, backend):
+    mock_http = mocker.patch.object(cfnresponse, 'http', autospec=True)
+    mock_http.request.return_value.status = 200
+    event = {'ResponseURL': 'url', 'StackId': 'stack-id', 'RequestId': 'request-id', 'LogicalResourceId': 'Id'}
+
+    assert cfnresponse.send(event, mocker.Mock(log_stream_name='stream'), cfnresponse.FAILED, {}, reason='Zürich')
+
+    kwargs = mock_http.request.call_args.kwargs
+    assert int(kwargs['headers']['content-length']) == len(kwargs['body'].encode('utf-8'))
+    assert json.loads(kwargs['body'])['Reason'] == 'Zürich'
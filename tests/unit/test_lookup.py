@@ -0,0 +1,89 @@
+from restrict_download_region.ip_ranges import iter_ip_ranges
+from restrict_download_region.lookup import IpRangeLookup, Owner
+from benchmarks.synthetic import synthetic_feed
+import ipaddress
+import json
+import random
+import time
+import pytest
+
+
+def brute_force(document):
+    entries = [(ipaddress.ip_network(entry.get('ip_prefix') or entry.get('ipv6_prefix')), entry)
+               for entry in document['prefixes'] + document['ipv6_prefixes']]
+
+    def owners(ip):
+        address = ipaddress.ip_address(ip)
+        matches = [(network.num_addresses, Owner(str(network), entry['region'], entry['service'],
+                                                 entry['network_border_group']))
+                   for network, entry in entries if network.version == address.version and address in network]
+        return tuple(owner for _, owner in sorted(matches))
+    return owners
+
+
+def random_addresses(document, rand, count):
+    for _ in range(count):
+        entry = rand.choice(document['prefixes'] + document['ipv6_prefixes'])
+        network = ipaddress.ip_network(entry.get('ip_prefix') or entry.get('ipv6_prefix'))
+        # inside, at the edges of and right next to the feed's networks
+        offset = rand.choice([0, network.num_addresses - 1, network.num_addresses, -1,
+                              rand.randrange(network.num_addresses)])
+        address = int(network.network_address) + offset
+        if 0 <= address < 2 ** network.max_prefixlen:
+            yield str(ipaddress.ip_address(address) if network.version == 4 else ipaddress.IPv6Address(address))
+
+
+def test_ip_range_lookup__matches_brute_force_on_sample_feed(sample_ip_ranges_bytes):
+    document = json.loads(sample_ip_ranges_bytes)
+    lookup = IpRangeLookup.from_ip_ranges(iter_ip_ranges([sample_ip_ranges_bytes]))
+
+    assert lookup.sync_token == document['syncToken']
+    owners = brute_force(document)
+    for ip in random_addresses(document, random.Random(0), 2000):
+        assert lookup.owners(ip) == owners(ip), ip
+
+
+def test_ip_range_lookup__matches_brute_force_on_synthetic_feed():
+    document = json.loads(synthetic_feed(scale=0.05))
+    lookup = IpRangeLookup.from_ip_ranges(iter_ip_ranges([json.dumps(document).encode('utf-8')]))
+
+    owners = brute_force(document)
+    for ip in random_addresses(document, random.Random(1), 500):
+        assert lookup.owners(ip) == owners(ip), ip
+
+
+def test_ip_range_lookup__nested_networks_most_specific_first():
+    lookup = IpRangeLookup.from_owners([
+        Owner('52.0.0.0/8', 'us-east-1', 'AMAZON'),
+        Owner('52.94.0.0/16', 'eu-west-2', 'AMAZON'),
+        Owner('52.94.6.0/24', 'eu-west-2', 'S3'),
+        Owner('2600:1f00::/24', 'us-east-1', 'AMAZON')
+    ])
+
+    assert [owner.prefix for owner in lookup.owners('52.94.6.1')] == ['52.94.6.0/24', '52.94.0.0/16', '52.0.0.0/8']
+    assert lookup.region('52.94.6.1') == 'eu-west-2'
+    assert lookup.region('52.94.6.1', 'S3') == 'eu-west-2'
+    assert lookup.region('52.95.0.1') == 'us-east-1'
+    assert lookup.region('52.95.0.1', 'S3') is None
+    assert lookup.region('2600:1f00::1') == 'us-east-1'
+    assert '53.0.0.0' not in lookup
+    assert lookup.owners('2600:1e00::1') == ()
+
+
+@pytest.mark.parametrize("ip", ['', '-', 'not-an-ip', '256.0.0.1', '1.2.3.4/32', '2600::1::1'])
+def test_ip_range_lookup__invalid_addresses(ip):
+    lookup = IpRangeLookup.from_prefixes(['10.0.0.0/8'])
+
+    with pytest.raises(ValueError):
+        lookup.owners(ip)
+
+
+def test_ip_range_lookup__answers_in_microseconds():
+    document = json.loads(synthetic_feed(scale=0.5))
+    lookup = IpRangeLookup.from_ip_ranges(iter_ip_ranges([json.dumps(document).encode('utf-8')]))
+    addresses = list(random_addresses(document, random.Random(2), 10000))
+
+    started = time.perf_counter()
+    for ip in addresses:
+        lookup.region(ip)
+    assert (time.perf_counter() - started) / len(addresses) < 20e-6
@@ -0,0 +1,97 @@
+from restrict_download_region import cfnresponse, restrict_region
+from restrict_download_region.metrics import MemorySink, Metrics
+from botocore.stub import Stubber
+from pytest_mock import MockerFixture
+import boto3
+import json
+import pkg_resources
+import pytest
+
+
+@pytest.fixture
+def sink(mocker: MockerFixture):
+    sink = MemorySink()
+    mocker.patch.object(restrict_region, 'metrics', Metrics('Test', sink))
+    return sink
+
+
+def test_phase__emits_embedded_metric_format():
+    sink = MemorySink()
+
+    with Metrics('Test', sink).phase('serialize', BucketName='my-bucket') as phase:
+        phase.set('PolicySize', 120)
+        phase.add('Bytes', 10)
+        phase.add('Bytes', 5)
+
+    document, = sink.documents
+    assert document['Phase'] == 'serialize'
+    assert document['BucketName'] == 'my-bucket'
+    assert document['PolicySize'] == 120
+    assert document['Bytes'] == 15
+    assert document['Duration'] >= 0
+    metric_directive, = document['_aws']['CloudWatchMetrics']
+    assert metric_directive['Namespace'] == 'Test'
+    assert metric_directive['Dimensions'] == [['Phase']]
+    assert {metric['Name']: metric['Unit'] for metric in metric_directive['Metrics']} == {
+        'PolicySize': 'Bytes', 'Bytes': 'Bytes', 'Duration': 'Milliseconds'}
+    assert isinstance(document['_aws']['Timestamp'], int)
+
+
+def test_phase__failed_phase_is_emitted_with_error():
+    sink = MemorySink()
+
+    with pytest.raises(TimeoutError):
+        with Metrics('Test', sink).phase('fetch'):
+            raise TimeoutError()
+
+    assert sink.phases('fetch')[0]['Error'] == 'TimeoutError'
+
+
+def test_phase__sink_errors_are_ignored():
+    def broken_sink(document):
+        raise OSError("stdout closed")
+
+    with Metrics('Test', broken_sink).phase('fetch'):
+        pass
+
+
+def test_phase__disabled_is_shared_no_op():
+    metrics = Metrics('Test')
+
+    with metrics.phase('fetch', BucketName='my-bucket') as phase:
+        phase.set('Bytes', 1)
+    assert metrics.phase('parse') is phase
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_handler__emits_every_phase(mocker: MockerFixture, sink, stream):
+    with open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'), 'rb') as f:
+        sample_ip_ranges = f.read()
+    mock_http = mocker.patch.object(restrict_region, 'http', autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges
+    mock_http.request.return_value.stream.return_value = iter([sample_ip_ranges[:100], sample_ip_ranges[100:]])
+    mocker.patch.object(restrict_region, 'STREAM_IP_RANGES', stream)
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'BUCKET_NAME', 'my-bucket')
+    mocker.patch.object(cfnresponse, 'send', autospec=True)
+
+    existing_policy = json.dumps({'Version': '2012-10-17', 'Statement': []})
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_response('get_bucket_policy', {'Policy': existing_policy})
+    stubber.add_response('put_bucket_policy', {})
+    stubber.activate()
+    mocker.patch.object(boto3, 'client', return_value=s3_client)
+
+    restrict_region.handler({'RequestType': 'Create'}, {})
+
+    phases = [document['Phase'] for document in sink.documents]
+    expected = ['fetch', 'parse', 'aggregate'] if stream else ['fetch', 'parse', 'filter', 'aggregate']
+    assert [phase for phase in phases if phase in expected] == expected
+    assert {'get_bucket_policy', 'merge', 'serialize', 'put_bucket_policy', 'cfnresponse_send'} <= set(phases)
+    assert sum(document.get('Bytes', 0) for document in sink.documents) == len(sample_ip_ranges)
+    assert sink.phases('aggregate')[0]['PrefixCount'] == 2
+    assert sink.phases('get_bucket_policy')[0]['PolicySize'] == len(existing_policy)
+    assert sink.phases('serialize')[0]['PolicySize'] > len(existing_policy)
+    assert sink.phases('put_bucket_policy')[0]['BucketName'] == 'my-bucket'
@@ -0,0 +1,129 @@
+from restrict_download_region.policy import (BucketPolicy, PolicyStatement, diff_policies,
+                                             serialize_bucket_policy)
+import restrict_download_region.restrict_region as restrict_region
+import json
+import pytest
+
+
+@pytest.fixture
+def other_statement():
+    return {
+        "Sid": "AddCannedAcl",
+        "Effect": "Allow",
+        "Principal": {"AWS": ["arn:aws:iam::444455556666:root", "arn:aws:iam::111122223333:root"]},
+        "Action": ["s3:PutObject", "s3:PutObjectAcl"],
+        "Resource": "arn:aws:s3:::foobar/*",
+        "Condition": {"StringEquals": {"s3:x-amz-acl": ["public-read", "bucket-owner-full-control"]}}
+    }
+
+
+@pytest.fixture
+def ip_statement():
+    return restrict_region.generate_ip_address_policy('foobar', ['15.230.56.104/31', '2600:1f19:8000::/36'])
+
+
+def policy_of(*statements):
+    return BucketPolicy.from_dict({"Version": "2012-10-17", "Statement": list(statements)})
+
+
+def test_serialize_bucket_policy__is_compact_and_deterministic(other_statement, ip_statement):
+    policy = {"Version": "2012-10-17", "Statement": [other_statement, ip_statement]}
+    reordered = {"Statement": [dict(reversed(list(other_statement.items()))), ip_statement], "Version": "2012-10-17"}
+    reordered['Statement'][0]['Condition'] = {
+        "StringEquals": {"s3:x-amz-acl": ["bucket-owner-full-control", "public-read"]}}
+
+    serialized = serialize_bucket_policy(policy)
+
+    assert serialized == serialize_bucket_policy(reordered)
+    assert len(serialized) < len(json.dumps(policy))
+    assert ' ' not in serialized
+    assert '"s3:x-amz-acl":["bucket-owner-full-control","public-read"]' in serialized
+    # the input is left as it is
+    assert other_statement['Condition']['StringEquals']['s3:x-amz-acl'] == ["public-read", "bucket-owner-full-control"]
+
+
+def test_serialize_bucket_policy__single_statement_without_list(other_statement):
+    policy = {"Version": "2012-10-17", "Statement": other_statement}
+
+    assert json.loads(serialize_bucket_policy(policy))['Statement']['Sid'] == "AddCannedAcl"
+
+
+def test_statement_digest__ignores_key_order_and_condition_value_order(other_statement):
+    reordered = dict(reversed(list(other_statement.items())),
+                     Condition={"StringEquals": {"s3:x-amz-acl": ["bucket-owner-full-control", "public-read"]}})
+
+    assert PolicyStatement(other_statement).digest == PolicyStatement(reordered).digest
+    assert PolicyStatement(other_statement).digest != PolicyStatement(dict(other_statement, Effect='Deny')).digest
+
+
+@pytest.mark.parametrize("source_ips", [
+    ['2600:1f19:8000::/36', '15.230.56.104/31'],
+    ['15.230.56.105/32', '2600:1f19:8000::/37', '15.230.56.104/32', '2600:1f19:8800::/37']])
+def test_statement_digest__compares_ip_conditions_by_address_space(ip_statement, source_ips):
+    equivalent = restrict_region.generate_ip_address_policy('foobar', source_ips)
+
+    assert PolicyStatement(ip_statement).digest == PolicyStatement(equivalent).digest
+
+
+def test_statement_digest__unparsable_ip_condition(ip_statement):
+    unparsable = restrict_region.generate_ip_address_policy('foobar', ['not-a-prefix'])
+
+    assert PolicyStatement(unparsable).digest != PolicyStatement(ip_statement).digest
+
+
+def test_model_is_slotted(ip_statement):
+    policy = policy_of(ip_statement)
+
+    with pytest.raises(AttributeError):
+        policy.extra = 1
+    with pytest.raises(AttributeError):
+        policy.statements[0].extra = 1
+
+
+def test_diff_policies__unchanged_in_any_order(other_statement, ip_statement):
+    diff = diff_policies(policy_of(other_statement, ip_statement), policy_of(ip_statement, other_statement))
+
+    assert diff.empty
+    assert diff.summary() == 'no changes'
+
+
+def test_diff_policies__added_removed_changed(other_statement, ip_statement):
+    unnamed = {"Effect": "Deny", "Principal": "*", "Action": "s3:DeleteBucket", "Resource": "arn:aws:s3:::foobar"}
+    changed_ip_statement = restrict_region.generate_ip_address_policy('foobar', ['15.230.56.104/31'])
+
+    diff = diff_policies(policy_of(other_statement, ip_statement), policy_of(changed_ip_statement, unnamed))
+
+    assert [statement.document for statement in diff.added] == [unnamed]
+    assert [statement.document for statement in diff.removed] == [other_statement]
+    assert [(current.document, desired.document) for current, desired in diff.changed] == \
+        [(ip_statement, changed_ip_statement)]
+    assert diff.summary().startswith('added ')
+    assert 'removed AddCannedAcl' in diff.summary()
+    assert 'changed DenyGetObjectForNonMatchingIp' in diff.summary()
+
+
+def test_diff_policies__duplicate_sids(ip_statement):
+    diff = diff_policies(policy_of(ip_statement, ip_statement), policy_of(ip_statement))
+
+    assert [statement.document for statement in diff.removed] == [ip_statement]
+    assert not diff.added
+    assert not diff.changed
+
+
+def test_without_leaves_policy_untouched(other_statement, ip_statement):
+    policy = policy_of(other_statement, ip_statement)
+
+    without = policy.without(ip_statement['Sid'])
+
+    assert without.to_dict() == {"Version": "2012-10-17", "Statement": [other_statement]}
+    assert policy.to_dict() == {"Version": "2012-10-17", "Statement": [other_statement, ip_statement]}
+    assert policy.statement(ip_statement['Sid']).document is ip_statement
+    assert without.statement(ip_statement['Sid']) is None
+
+
+def test_from_json_single_statement(other_statement):
+    policy = BucketPolicy.from_json(json.dumps({"Version": "2012-10-17", "Statement": other_statement}))
+
+    assert len(policy) == 1
+    assert policy.to_dict() == {"Version": "2012-10-17", "Statement": [other_statement]}
+    assert json.loads(policy.serialize())['Statement'][0]['Sid'] == "AddCannedAcl"
@@ -0,0 +1,162 @@
+from restrict_download_region.budget import (DROP, NONE, SUPERNET, PolicyBudgetError, fit_prefixes,
+                                             fit_statement_to_policy, policy_size)
+from restrict_download_region.policy import serialize_bucket_policy
+import restrict_download_region.restrict_region as restrict_region
+from benchmarks.synthetic import synthetic_feed
+from restrict_download_region.cache import CacheEntry, IpRangesCache
+from restrict_download_region.cidr import aggregate_prefixes
+from pytest_mock import MockerFixture
+import ipaddress
+import json
+import time
+import pytest
+
+
+def policy_with(prefixes):
+    statement = restrict_region.generate_ip_address_policy('my-bucket', prefixes)
+    return {
+        'Version': '2012-10-17',
+        'Statement': [{'Sid': 'AllowOtherAccount', 'Effect': 'Allow', 'Principal': {'AWS': '111122223333'},
+                       'Action': 's3:GetObject', 'Resource': 'arn:aws:s3:::my-bucket/*'}, statement]
+    }, statement['Condition']['NotIpAddress']['aws:SourceIp']
+
+
+def addresses(prefixes, version):
+    return sum(network.num_addresses for network in map(ipaddress.ip_network, prefixes) if network.version == version)
+
+
+def covered(prefixes, by):
+    supernets = [ipaddress.ip_network(prefix) for prefix in by]
+    return all(any(network.version == supernet.version and network.subnet_of(supernet) for supernet in supernets)
+               for network in map(ipaddress.ip_network, prefixes))
+
+
+@pytest.fixture
+def scattered_prefixes():
+    # every other /32 of a /24 and a few IPv6 networks, none of which can be aggregated
+    return ['10.0.%d.%d/32' % (third, fourth) for third in range(4) for fourth in range(0, 256, 2)] + \
+        ['2600:1f%02x::/32' % index for index in range(0, 64, 2)]
+
+
+def test_fit_statement_to_policy__within_limit_is_untouched(scattered_prefixes):
+    bucket_policy, source_ips = policy_with(list(scattered_prefixes))
+
+    report = fit_statement_to_policy(bucket_policy, source_ips, limit=policy_size(bucket_policy))
+
+    assert source_ips == scattered_prefixes
+    assert not report.changed
+    assert report.size == len(serialize_bucket_policy(bucket_policy))
+
+
+def test_fit_statement_to_policy__supernet(scattered_prefixes):
+    bucket_policy, source_ips = policy_with(list(scattered_prefixes))
+    limit = policy_size(bucket_policy) // 2
+
+    report = fit_statement_to_policy(bucket_policy, source_ips, limit, SUPERNET, max_ratio=1.0)
+
+    assert report.size == len(serialize_bucket_policy(bucket_policy)) <= limit
+    assert report.changed
+    assert report.prefix_count == len(source_ips) < len(scattered_prefixes)
+    # only ever allows more, never denies an address that was allowed
+    assert covered(scattered_prefixes, source_ips)
+    for version in (4, 6):
+        assert report.widened_addresses[version] == \
+            addresses(source_ips, version) - addresses(scattered_prefixes, version)
+        assert report.widened_addresses[version] <= addresses(scattered_prefixes, version)
+        assert report.dropped_addresses[version] == 0
+
+
+def test_fit_statement_to_policy__supernet_prefers_least_widening():
+    prefixes = ['10.0.0.0/32', '10.0.0.2/32', '192.168.0.0/24', '192.168.2.0/24']
+
+    budget = len(json.dumps(prefixes, separators=(',', ':'))) - 1
+
+    fitted, widened, _ = fit_prefixes(prefixes, budget, SUPERNET, max_ratio=1.0)
+
+    assert fitted == ['10.0.0.0/30', '192.168.0.0/24', '192.168.2.0/24']
+    assert widened == {4: 2, 6: 0}
+
+
+def test_fit_statement_to_policy__drop_smallest_networks_first(scattered_prefixes):
+    prefixes = scattered_prefixes + ['172.16.0.0/12']
+    bucket_policy, source_ips = policy_with(list(prefixes))
+    limit = policy_size(bucket_policy) // 2
+
+    report = fit_statement_to_policy(bucket_policy, source_ips, limit, DROP, max_ratio=1.0)
+
+    assert report.size == len(serialize_bucket_policy(bucket_policy)) <= limit
+    assert set(source_ips) < set(prefixes)
+    assert '172.16.0.0/12' in source_ips
+    for version in (4, 6):
+        assert report.dropped_addresses[version] == addresses(prefixes, version) - addresses(source_ips, version)
+        assert report.widened_addresses[version] == 0
+
+
+@pytest.mark.parametrize("strategy", [SUPERNET, DROP])
+def test_fit_statement_to_policy__bounded(scattered_prefixes, strategy):
+    bucket_policy, source_ips = policy_with(list(scattered_prefixes))
+
+    with pytest.raises(PolicyBudgetError):
+        fit_statement_to_policy(bucket_policy, source_ips, policy_size(bucket_policy) // 2, strategy, max_ratio=0.1)
+
+
+def test_fit_statement_to_policy__none_leaves_policy_oversized(scattered_prefixes):
+    bucket_policy, source_ips = policy_with(list(scattered_prefixes))
+
+    report = fit_statement_to_policy(bucket_policy, source_ips, 100, NONE)
+
+    assert source_ips == scattered_prefixes
+    assert report.size > report.limit
+
+
+def test_fit_statement_to_policy__unknown_strategy(scattered_prefixes):
+    with pytest.raises(ValueError):
+        fit_statement_to_policy(*policy_with(scattered_prefixes), strategy='coarsen')
+
+
+@pytest.mark.parametrize("strategy", [SUPERNET, DROP])
+def test_fit_statement_to_policy__fast_on_oversized_region(strategy):
+    document = json.loads(synthetic_feed(scale=5))
+    # every service, to get a region well over the limit
+    prefixes = aggregate_prefixes([entry['ip_prefix'] for entry in document['prefixes']
+                                   if entry['region'] == 'us-east-1'] +
+                                  [entry['ipv6_prefix'] for entry in document['ipv6_prefixes']
+                                   if entry['region'] == 'us-east-1'])
+    bucket_policy, source_ips = policy_with(prefixes)
+    assert policy_size(bucket_policy) > 2 * 20 * 1024
+
+    started = time.perf_counter()
+    report = fit_statement_to_policy(bucket_policy, source_ips, strategy=strategy, max_ratio=float('inf'))
+
+    assert time.perf_counter() - started < 2
+    assert report.size <= 20 * 1024
+
+
+def test_process_ip_restrict_policy__fits_budget_and_is_stable(mocker: MockerFixture, scattered_prefixes):
+    bucket_policy = {'Version': '2012-10-17', 'Statement': []}
+    limit = policy_size(policy_with(scattered_prefixes)[0]) // 2
+    mocker.patch.object(restrict_region, 'POLICY_SIZE_LIMIT', limit)
+    mocker.patch.object(restrict_region, 'POLICY_BUDGET_MAX_RATIO', 1.0)
+
+    assert restrict_region.process_ip_restrict_policy('my-bucket', 'Update', bucket_policy, scattered_prefixes)
+    assert len(serialize_bucket_policy(bucket_policy)) <= limit
+
+    # the fitted statement is recognized as up to date by the next run
+    assert not restrict_region.process_ip_restrict_policy('my-bucket', 'Update', bucket_policy, scattered_prefixes)
+
+
+def test_process_ip_restrict_policy__fitting_leaves_shared_prefixes_untouched(mocker: MockerFixture, tmp_path,
+                                                                              scattered_prefixes):
+    cache = IpRangesCache(str(tmp_path), ttl=60, max_entries=4, max_bytes=1024 * 1024)
+    cached = cache.put(CacheEntry('us-east-1', '1613483053', list(scattered_prefixes)))
+    mocker.patch.object(restrict_region, 'POLICY_SIZE_LIMIT', policy_size(policy_with(scattered_prefixes)[0]) // 2)
+    mocker.patch.object(restrict_region, 'POLICY_BUDGET_MAX_RATIO', 1.0)
+
+    # the buckets of a multi-bucket run share the cached prefixes
+    policies = [{'Version': '2012-10-17', 'Statement': []} for _ in range(2)]
+    for bucket_policy in policies:
+        assert restrict_region.process_ip_restrict_policy('my-bucket', 'Update', bucket_policy, cached.prefixes)
+
+    assert cached.prefixes == scattered_prefixes
+    assert cache.get('us-east-1').prefixes == scattered_prefixes
+    assert policies[0] == policies[1]
@@ -1,4 +1,5 @@
 import restrict_download_region.restrict_region as restrict_region
+import copy
 import json
 import pytest
 import boto3
@@ -329,3 +330,63 @@ def test_process_ip_restrict_policy__does_not_have_any_statements__event_is_dele
 
     assert not mock_get_ip_prefixes_for_region.called
     assert not mock_generate_ip_address_policy.called
+
+
+@pytest.mark.parametrize("previous_prefixes", [
+    ['15.230.56.104/31', '2600:1f19:8000::/36'],
+    # same address space, different order and aggregation
+    ['2600:1f19:8000::/37', '2600:1f19:8800::/37', '15.230.56.105/32', '15.230.56.104/32']])
+def test_process_ip_restrict_policy__region_prefixes_unchanged(
+    bucket_name,
+    other_policy,
+    previous_prefixes
+):
+    previous_ip_policy = restrict_region.generate_ip_address_policy(bucket_name, previous_prefixes)
+    bucket_policy = {
+        "Version": "2012-10-17",
+        "Statement": [previous_ip_policy, other_policy]
+    }
+    expected = copy.deepcopy(bucket_policy)
+
+    # function under test
+    assert not restrict_region.process_ip_restrict_policy(
+        bucket_name, None, bucket_policy, ['15.230.56.104/31', '2600:1f19:8000::/36'])
+
+    # veify that nothing was touched
+    assert bucket_policy == expected
+
+
+@pytest.mark.parametrize("previous_ip_policy", [
+    # this region's prefixes changed
+    restrict_region.generate_ip_address_policy("foobar", ['15.230.56.104/31']),
+    # someone edited the statement
+    dict(restrict_region.generate_ip_address_policy("foobar", ['15.230.56.104/31', '2600:1f19:8000::/36']),
+         Effect='Allow'),
+    # the statement can't be parsed
+    restrict_region.generate_ip_address_policy("foobar", ['not-a-prefix'])])
+def test_process_ip_restrict_policy__region_prefixes_changed(
+    bucket_name,
+    other_policy,
+    previous_ip_policy
+):
+    bucket_policy = {
+        "Version": "2012-10-17",
+        "Statement": [previous_ip_policy, other_policy]
+    }
+
+    # function under test
+    assert restrict_region.process_ip_restrict_policy(
+        bucket_name, None, bucket_policy, ['15.230.56.104/31', '2600:1f19:8000::/36'])
+
+    assert bucket_policy['Statement'] == [
+        other_policy,
+        restrict_region.generate_ip_address_policy(bucket_name, ['15.230.56.104/31', '2600:1f19:8000::/36'])]
+
+
+def test_process_ip_restrict_policy__event_is_delete__returns_whether_changed(
+    bucket_name,
+    only_other_policy,
+    old_ip_policy_with_other_policy
+):
+    assert not restrict_region.process_ip_restrict_policy(bucket_name, 'Delete', only_other_policy)
+    assert restrict_region.process_ip_restrict_policy(bucket_name, 'Delete', old_ip_policy_with_other_policy)
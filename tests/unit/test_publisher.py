@@ -0,0 +1,159 @@
+from restrict_download_region.publisher import (MANIFEST_KEY, LocalPrefixStore, PrefixStore, RegionArtifact,
+                                                S3PrefixStore, artifact_key, publish_region_artifacts,
+                                                read_region_artifact)
+from restrict_download_region.cidr import fingerprint_prefixes
+from restrict_download_region.ip_ranges import RegionIndex
+from restrict_download_region.notification import IpSpaceChanged
+import restrict_download_region.restrict_region as restrict_region
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from pytest_mock import MockerFixture
+import boto3
+import hashlib
+import io
+import json
+import pytest
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalPrefixStore(str(tmp_path / 'store'))
+
+
+def test_publish_region_artifacts(store, sample_ip_ranges_bytes):
+    index = RegionIndex.from_document(json.loads(sample_ip_ranges_bytes))
+
+    fingerprints = publish_region_artifacts(index, store)
+
+    assert {'us-east-1', 'eu-west-2', 'GLOBAL'} <= set(fingerprints)
+    artifact = read_region_artifact(store, 'us-east-1')
+    assert artifact.prefixes == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert artifact.sync_token == index.sync_token
+    assert artifact.fingerprint == fingerprints['us-east-1']
+    manifest = json.loads(store.get(MANIFEST_KEY))
+    assert manifest['syncToken'] == index.sync_token
+    assert manifest['fingerprints'] == fingerprints
+    assert read_region_artifact(store, 'nowhere-1') is None
+
+
+def test_region_artifact__rejects_tampered_prefixes():
+    artifact = json.loads(RegionArtifact('us-east-1', 'AMAZON', '1', 'fingerprint', ['3.5.140.0/22']).to_json())
+
+    with pytest.raises(ValueError, match="fingerprint"):
+        RegionArtifact.from_json(json.dumps(artifact).encode('utf-8'))
+    with pytest.raises(ValueError):
+        RegionArtifact.from_json(b'{"region": "us-east-1"}')
+
+
+def test_s3_prefix_store():
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_response('put_object', {}, {'Bucket': 'prefixes', 'Key': 'ip-prefixes/AMAZON/us-east-1.json',
+                                            'Body': b'{}', 'ContentType': 'application/json'})
+    stubber.add_response('get_object', {'Body': io.BytesIO(b'{}')},
+                         {'Bucket': 'prefixes', 'Key': 'ip-prefixes/AMAZON/us-east-1.json'})
+    stubber.add_client_error('get_object', 'NoSuchKey')
+    stubber.activate()
+    store = S3PrefixStore(s3_client, 'prefixes', 'ip-prefixes/')
+
+    store.put(artifact_key('us-east-1'), b'{}')
+    assert store.get(artifact_key('us-east-1')) == b'{}'
+    assert store.get(artifact_key('ap-south-1')) is None
+    stubber.assert_no_pending_responses()
+
+
+@pytest.mark.parametrize("code", ['AccessDenied', '403', '404'])
+def test_s3_prefix_store__missing_key_without_list_bucket(code):
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_client_error('get_object', code, http_status_code=int(code) if code.isdigit() else 403)
+    stubber.add_response('get_object', {'Body': io.BytesIO(b'{}')},
+                         {'Bucket': 'prefixes', 'Key': 'ip-prefixes/AMAZON/us-east-1.json'})
+    stubber.activate()
+    store = S3PrefixStore(s3_client, 'prefixes', 'ip-prefixes/')
+
+    # a publisher that doesn't write snapshots, the reader falls back to the JSON artifact
+    assert store.get(artifact_key('us-east-1', extension='snapshot')) is None
+    assert store.get(artifact_key('us-east-1')) == b'{}'
+    stubber.assert_no_pending_responses()
+
+
+def test_s3_prefix_store__other_errors_are_raised():
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_client_error('get_object', 'SlowDown', http_status_code=503)
+    stubber.activate()
+
+    with pytest.raises(ClientError):
+        S3PrefixStore(s3_client, 'prefixes', 'ip-prefixes/').get(artifact_key('us-east-1'))
+
+
+def test_handler__publisher_mode(mocker: MockerFixture, tmp_path, ip_space_changed_event, sample_ip_ranges_bytes):
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mocker.patch.object(restrict_region, 'PUBLISH_PREFIXES', True)
+    mocker.patch.object(restrict_region, 'PREFIX_STORE_DIR', str(tmp_path))
+    mocker.patch.object(restrict_region, 'BUCKET_NAME', None)
+
+    restrict_region.handler(ip_space_changed_event, {})
+
+    mock_http.request.assert_called_once_with('GET', 'https://ip-ranges.amazonaws.com/ip-ranges.json',
+                                              headers={'Accept-Encoding': 'gzip'}, retries=mocker.ANY)
+    assert read_region_artifact(LocalPrefixStore(str(tmp_path)), 'eu-west-2').prefixes == \
+        ['52.93.153.170/32', '2a05:d07a:c000::/40']
+
+
+def test_publish_prefixes__requires_a_store(mocker: MockerFixture):
+    with pytest.raises(ValueError, match="PREFIX_STORE"):
+        restrict_region.publish_prefixes()
+
+
+def test_get_ip_prefixes_for_region__reads_published_artifact(mocker: MockerFixture, tmp_path,
+                                                               sample_ip_ranges_bytes):
+    publish_region_artifacts(RegionIndex.from_document(json.loads(sample_ip_ranges_bytes)),
+                             LocalPrefixStore(str(tmp_path)))
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mocker.patch.object(restrict_region, 'PREFIX_STORE_DIR', str(tmp_path))
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+
+    assert restrict_region.get_ip_prefixes_for_region() == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert not mock_http.request.called
+
+
+def stale_artifact():
+    prefixes = ['15.230.56.104/32']
+    return RegionArtifact('us-east-1', 'AMAZON', '1613400000', fingerprint_prefixes(prefixes), prefixes).to_json()
+
+
+@pytest.mark.parametrize("artifact", [None, b'{"region": "us-east-1", "truncated', stale_artifact()],
+                         ids=['missing', 'corrupt', 'older than notification'])
+def test_get_ip_prefixes_for_region__falls_back_to_feed(mocker: MockerFixture, tmp_path, sample_ip_ranges_bytes,
+                                                        artifact):
+    if artifact is not None:
+        LocalPrefixStore(str(tmp_path)).put(artifact_key('us-east-1'), artifact)
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mocker.patch.object(restrict_region, 'PREFIX_STORE_DIR', str(tmp_path))
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    notification = IpSpaceChanged('1613483053', hashlib.md5(sample_ip_ranges_bytes).hexdigest(),
+                                  'https://ip-ranges.amazonaws.com/ip-ranges.json')
+
+    assert restrict_region.get_ip_prefixes_for_region(notification) == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert mock_http.request.called
+
+
+def test_get_ip_prefixes_for_region__store_error_falls_back_to_feed(mocker: MockerFixture, sample_ip_ranges_bytes):
+    store = mocker.MagicMock(spec=PrefixStore)
+    store.get.side_effect = ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'}},
+                                        'GetObject')
+    mocker.patch.object(restrict_region, 'get_prefix_store', return_value=store)
+    mock_http = mocker.patch.object(restrict_region, "http", autospec=True)
+    mock_http.request.return_value.status = 200
+    mock_http.request.return_value.data = sample_ip_ranges_bytes
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+
+    assert restrict_region.get_ip_prefixes_for_region() == ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert mock_http.request.called
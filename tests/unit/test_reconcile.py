@@ -0,0 +1,299 @@
+from restrict_download_region.reconcile import (EnqueueError, bucket_update_body, enqueue_bucket_updates,
+                                                parse_bucket_update)
+from restrict_download_region.notification import IpSpaceChanged
+import restrict_download_region.restrict_region as restrict_region
+from tests.unit.local_s3 import LocalS3
+from botocore.exceptions import ClientError
+from collections import deque
+from pytest_mock import MockerFixture
+import json
+import threading
+import uuid
+import pytest
+
+REGION_IP_PREFIXES = ['15.230.56.104/31', '2600:1f19:8000::/36']
+
+
+class LocalQueue:
+    """
+    Stands in for an SQS queue and the Lambda event source mapping reading it. Messages are received
+    in batches, the ones reported in batchItemFailures become visible again and are moved to the
+    dead-letter queue once they were received max_receive_count times.
+    """
+
+    def __init__(self, max_receive_count: int = 3):
+        self.url = 'https://sqs.us-east-1.amazonaws.com/123456789012/bucket-updates'
+        self.max_receive_count = max_receive_count
+        self.messages = deque()
+        self.dead_letters = []
+        self.rejected_buckets = set()
+        self._receive_counts = {}
+        self._lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert QueueUrl == self.url
+        assert len(Entries) <= 10
+        successful, failed = [], []
+        with self._lock:
+            for entry in Entries:
+                if json.loads(entry['MessageBody']).get('BucketName') in self.rejected_buckets:
+                    failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError',
+                                   'Message': 'rejected'})
+                    continue
+                message_id = str(uuid.uuid4())
+                self.messages.append((message_id, entry['MessageBody']))
+                successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': failed}
+
+    def send(self, body: str) -> str:
+        return self.send_message_batch(self.url, [{'Id': '0', 'MessageBody': body}])['Successful'][0]['MessageId']
+
+    def receive(self, batch_size: int = 10) -> dict:
+        records = []
+        while self.messages and len(records) < batch_size:
+            message_id, body = self.messages.popleft()
+            self._receive_counts[message_id] = self._receive_counts.get(message_id, 0) + 1
+            records.append({'messageId': message_id, 'receiptHandle': message_id, 'body': body,
+                            'attributes': {'ApproximateReceiveCount': str(self._receive_counts[message_id])},
+                            'eventSource': 'aws:sqs', 'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:q'})
+        return {'Records': records}
+
+    def settle(self, event: dict, response: dict):
+        """
+        Deletes the messages of the batch that succeeded, like the event source mapping does
+        """
+        failed = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+        for record in event['Records']:
+            if record['messageId'] not in failed:
+                continue
+            if self._receive_counts[record['messageId']] >= self.max_receive_count:
+                self.dead_letters.append(record)
+            else:
+                self.messages.append((record['messageId'], record['body']))
+
+    def drain(self, handler, batch_size: int = 10) -> list:
+        responses = []
+        while self.messages:
+            event = self.receive(batch_size)
+            response = handler(event, {})
+            self.settle(event, response)
+            responses.append(response)
+        return responses
+
+
+class FlakyS3(LocalS3):
+    """
+    Fails the policy writes of the given buckets as many times as given
+    """
+
+    def __init__(self, failures: dict):
+        super().__init__(latency=0)
+        self.failures = dict(failures)
+        self.put_buckets = []
+
+    def put_bucket_policy(self, Bucket, Policy):
+        with self._lock:
+            self.put_buckets.append(Bucket)
+            if self.failures.get(Bucket, 0):
+                self.failures[Bucket] -= 1
+                raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': ''}}, 'PutBucketPolicy')
+        super().put_bucket_policy(Bucket, Policy)
+
+
+@pytest.fixture
+def notification():
+    return IpSpaceChanged('1613483053', '627bf6e5a9b356adc35ec5acc6befbd1', restrict_region.IP_RANGES_URL,
+                          '2021-02-16T13:44:13+00:00')
+
+
+@pytest.fixture
+def queue(mocker: MockerFixture):
+    queue = LocalQueue()
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'BUCKET_NAME', '')
+    mocker.patch.object(restrict_region, 'BUCKET_UPDATE_QUEUE_URL', queue.url)
+    mocker.patch.dict(restrict_region._clients, {'sqs': queue})
+    return queue
+
+
+@pytest.fixture
+def get_ip_prefixes_for_region(mocker: MockerFixture):
+    return mocker.patch.object(restrict_region, 'get_ip_prefixes_for_region', return_value=REGION_IP_PREFIXES,
+                               autospec=True)
+
+
+def use_s3(mocker: MockerFixture, s3) -> LocalS3:
+    mocker.patch.dict(restrict_region._clients, {'s3': s3})
+    return s3
+
+
+def restricted(s3: LocalS3, bucket_name: str) -> bool:
+    policy = json.loads(s3.policies.get(bucket_name, '{"Statement": []}'))
+    return any(statement.get('Sid') == restrict_region.POLICY_STATEMENT_ID for statement in policy['Statement'])
+
+
+def test_bucket_update_round_trip(notification):
+    record = {'messageId': 'm-1', 'body': bucket_update_body('my-bucket', 'Delete', notification)}
+
+    update = parse_bucket_update(record)
+
+    assert update == ('m-1', 'my-bucket', 'Delete', notification)
+
+
+@pytest.mark.parametrize("body", ['', 'not json', '[]', '{}', '{"BucketName": ""}', '{"BucketName": 1}',
+                                  '{"BucketName": "b", "IpSpaceChanged": {"synctoken": "1"}}',
+                                  '{"BucketName": "b", "IpSpaceChanged": '
+                                  '{"synctoken": "1", "md5": "x", "url": "https://example.com/ip-ranges.json"}}'])
+def test_parse_bucket_update__malformed(body):
+    with pytest.raises(ValueError):
+        parse_bucket_update({'messageId': 'm-1', 'body': body})
+
+
+def test_enqueue_bucket_updates__batches_of_ten(mocker: MockerFixture, notification):
+    queue = LocalQueue()
+    send_message_batch = mocker.spy(queue, 'send_message_batch')
+    bucket_names = ['bucket-%02d' % i for i in range(23)]
+
+    enqueue_bucket_updates(queue, queue.url, bucket_names, notification=notification)
+
+    assert [len(call.kwargs['Entries']) for call in send_message_batch.call_args_list] == [10, 10, 3]
+    assert [json.loads(body)['BucketName'] for _, body in queue.messages] == bucket_names
+
+
+def test_enqueue_bucket_updates__rejected_messages_are_raised():
+    queue = LocalQueue()
+    queue.rejected_buckets = {'bucket-03', 'bucket-12'}
+
+    with pytest.raises(EnqueueError) as e:
+        enqueue_bucket_updates(queue, queue.url, ['bucket-%02d' % i for i in range(15)])
+
+    assert e.value.bucket_names == ['bucket-03', 'bucket-12']
+    # the other messages were still sent
+    assert len(queue.messages) == 13
+
+
+def test_queue_mode__notification_is_queued_and_applied_in_batches(mocker: MockerFixture, queue,
+                                                                   ip_space_changed_event,
+                                                                   get_ip_prefixes_for_region):
+    bucket_names = ['bucket-%02d' % i for i in range(25)]
+    mocker.patch.object(restrict_region, 'BUCKET_NAMES', ','.join(bucket_names))
+    restrict_region.applied_sync_tokens.put('bucket-00', '1613483053')
+    s3 = use_s3(mocker, LocalS3(latency=0))
+
+    restrict_region.handler(ip_space_changed_event, {})
+
+    # the subscribed function only queues the buckets that haven't applied the notification
+    assert len(queue.messages) == 24
+    assert not s3.policies
+
+    responses = queue.drain(restrict_region.queue_handler)
+
+    assert responses == [{'batchItemFailures': []}] * 3
+    # one feed fetch per batch
+    assert get_ip_prefixes_for_region.call_count == 3
+    assert get_ip_prefixes_for_region.call_args.args[0].sync_token == '1613483053'
+    assert all(restricted(s3, bucket_name) for bucket_name in bucket_names[1:])
+    assert all(restrict_region.applied_sync_tokens.is_applied(bucket_name, '1613483053')
+               for bucket_name in bucket_names)
+
+
+def test_queue_mode__custom_resource_is_not_queued(mocker: MockerFixture, queue, get_ip_prefixes_for_region):
+    mocker.patch.object(restrict_region, 'BUCKET_NAMES', 'bucket-a,bucket-b')
+    mocker.patch.object(restrict_region, 'handle_custom_resource_status_message', autospec=True) \
+        .return_value.__enter__.return_value = 'Create'
+    s3 = use_s3(mocker, LocalS3(latency=0))
+
+    restrict_region.handler({'RequestType': 'Create'}, {})
+
+    assert not queue.messages
+    assert restricted(s3, 'bucket-a') and restricted(s3, 'bucket-b')
+
+
+def test_queue_handler__only_failed_buckets_are_retried(mocker: MockerFixture, queue, notification,
+                                                        get_ip_prefixes_for_region):
+    s3 = use_s3(mocker, FlakyS3({'bucket-b': 1}))
+    message_ids = {bucket_name: queue.send(bucket_update_body(bucket_name, notification=notification))
+                   for bucket_name in ('bucket-a', 'bucket-b', 'bucket-c')}
+
+    responses = queue.drain(restrict_region.queue_handler)
+
+    assert responses == [{'batchItemFailures': [{'itemIdentifier': message_ids['bucket-b']}]},
+                         {'batchItemFailures': []}]
+    assert sorted(s3.put_buckets) == ['bucket-a', 'bucket-b', 'bucket-b', 'bucket-c']
+    assert all(restricted(s3, bucket_name) for bucket_name in message_ids)
+
+
+def test_queue_handler__persistent_failure_ends_in_dead_letter_queue(mocker: MockerFixture, queue, notification,
+                                                                     get_ip_prefixes_for_region):
+    s3 = use_s3(mocker, FlakyS3({'bucket-b': 10}))
+    queue.send(bucket_update_body('bucket-a', notification=notification))
+    queue.send(bucket_update_body('bucket-b', notification=notification))
+
+    queue.drain(restrict_region.queue_handler)
+
+    assert [json.loads(record['body'])['BucketName'] for record in queue.dead_letters] == ['bucket-b']
+    assert s3.put_buckets.count('bucket-b') == queue.max_receive_count
+    assert restricted(s3, 'bucket-a')
+    assert not restrict_region.applied_sync_tokens.is_applied('bucket-b', notification.sync_token)
+
+
+def test_queue_handler__malformed_message_is_reported(mocker: MockerFixture, queue, get_ip_prefixes_for_region):
+    s3 = use_s3(mocker, LocalS3(latency=0))
+    malformed = queue.send('{"Bucket": "bucket-a"}')
+    queue.send(bucket_update_body('bucket-b'))
+    event = queue.receive()
+
+    assert restrict_region.queue_handler(event, {}) == {'batchItemFailures': [{'itemIdentifier': malformed}]}
+    assert restricted(s3, 'bucket-b')
+
+
+def test_queue_handler__fetch_failure_fails_only_buckets_that_need_the_feed(mocker: MockerFixture, queue,
+                                                                            get_ip_prefixes_for_region):
+    s3 = use_s3(mocker, LocalS3(latency=0))
+    s3.policies['bucket-b'] = json.dumps({'Version': '2012-10-17', 'Statement': [
+        restrict_region.generate_ip_address_policy('bucket-b', REGION_IP_PREFIXES)]})
+    get_ip_prefixes_for_region.side_effect = ValueError("md5 mismatch")
+    restricting = queue.send(bucket_update_body('bucket-a'))
+    queue.send(bucket_update_body('bucket-b', 'Delete'))
+
+    response = restrict_region.queue_handler(queue.receive(), {})
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': restricting}]}
+    assert 'bucket-b' not in s3.policies
+
+
+def test_queue_handler__duplicates_update_the_bucket_once(mocker: MockerFixture, queue, notification,
+                                                          get_ip_prefixes_for_region):
+    s3 = use_s3(mocker, FlakyS3({'bucket-a': 1}))
+    first = queue.send(bucket_update_body('bucket-a', notification=notification))
+    second = queue.send(bucket_update_body('bucket-a', notification=notification))
+
+    response = restrict_region.queue_handler(queue.receive(), {})
+
+    # the bucket is written once, and both of its messages are redelivered
+    assert s3.put_buckets == ['bucket-a']
+    assert response == {'batchItemFailures': [{'itemIdentifier': first}, {'itemIdentifier': second}]}
+
+
+def test_queue_handler__already_applied_needs_neither_feed_nor_s3(mocker: MockerFixture, queue, notification,
+                                                                  get_ip_prefixes_for_region):
+    s3 = use_s3(mocker, FlakyS3({}))
+    restrict_region.applied_sync_tokens.put('bucket-a', notification.sync_token)
+    queue.send(bucket_update_body('bucket-a', notification=notification))
+
+    assert restrict_region.queue_handler(queue.receive(), {}) == {'batchItemFailures': []}
+    assert not get_ip_prefixes_for_region.called
+    assert not s3.put_buckets
+
+
+def test_queue_handler__fetches_the_newest_notification_of_the_batch(mocker: MockerFixture, queue, notification,
+                                                                    get_ip_prefixes_for_region):
+    use_s3(mocker, LocalS3(latency=0))
+    newer = notification._replace(sync_token='1613490000', md5='0' * 32)
+    queue.send(bucket_update_body('bucket-a', notification=notification))
+    queue.send(bucket_update_body('bucket-b', notification=newer))
+    queue.send(bucket_update_body('bucket-c', notification=notification))
+
+    restrict_region.queue_handler(queue.receive(), {})
+
+    get_ip_prefixes_for_region.assert_called_once_with(newer)
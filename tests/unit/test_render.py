@@ -0,0 +1,136 @@
+from restrict_download_region.render import PolicyRenderer, load_index, main, parse_manifest_line
+import restrict_download_region.restrict_region as restrict_region
+from pytest_mock import MockerFixture
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import pkg_resources
+import pytest
+
+OTHER_STATEMENT = {'Sid': 'AllowReplication', 'Effect': 'Allow', 'Principal': {'AWS': '111122223333'},
+                   'Action': 's3:ReplicateObject', 'Resource': 'arn:aws:s3:::bucket-a/*'}
+
+
+@pytest.fixture
+def ip_ranges_path():
+    return pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json')
+
+
+@pytest.fixture
+def renderer(ip_ranges_path):
+    return PolicyRenderer(load_index(ip_ranges_path))
+
+
+def render(renderer, lines, diff=False):
+    return list(renderer.render_lines(lines, diff))
+
+
+def test_parse_manifest_line():
+    assert parse_manifest_line(1, 'bucket-a, us-east-1\n') == (1, 'bucket-a', 'us-east-1', None)
+    assert parse_manifest_line(2, '  \n') is None
+    assert parse_manifest_line(3, '# bucket,region\n') is None
+    policy = {'Version': '2012-10-17', 'Statement': [OTHER_STATEMENT]}
+    assert parse_manifest_line(4, json.dumps({'bucket': 'b', 'region': 'eu-west-2', 'policy': json.dumps(policy)})) \
+        == (4, 'b', 'eu-west-2', policy)
+
+
+@pytest.mark.parametrize("line", ['bucket-a', 'bucket-a,us-east-1,extra', ',us-east-1', '{"bucket": "b"}',
+                                  '{"bucket": "b", "region": "us-east-1", "policy": []}', '{"bucket": '])
+def test_parse_manifest_line__malformed(line):
+    with pytest.raises(ValueError):
+        parse_manifest_line(1, line)
+
+
+def test_render__new_policy(renderer):
+    [rendered] = render(renderer, ['bucket-a,eu-west-2'])
+
+    assert rendered == {'bucket': 'bucket-a', 'region': 'eu-west-2', 'changed': True, 'policy': {
+        'Version': '2012-10-17',
+        'Statement': [restrict_region.generate_ip_address_policy('bucket-a',
+                                                                ['52.93.153.170/32', '2a05:d07a:c000::/40'])]
+    }}
+
+
+def test_render__merges_into_current_policy(renderer):
+    current = {'Version': '2012-10-17', 'Statement': [
+        OTHER_STATEMENT, restrict_region.generate_ip_address_policy('bucket-a', ['15.230.56.104/32'])]}
+
+    [rendered] = render(renderer, [json.dumps({'bucket': 'bucket-a', 'region': 'us-east-1', 'policy': current})])
+
+    assert rendered['changed']
+    assert rendered['policy']['Statement'] == [OTHER_STATEMENT, restrict_region.generate_ip_address_policy(
+        'bucket-a', ['15.230.56.104/31', '2600:1f19:8000::/36'])]
+
+
+def test_render__diff_against_current_policies_directory(ip_ranges_path, tmp_path):
+    (tmp_path / 'bucket-a.json').write_text(json.dumps({'Policy': json.dumps({'Version': '2012-10-17', 'Statement': [
+        OTHER_STATEMENT, restrict_region.generate_ip_address_policy('bucket-a', ['15.230.56.104/32'])]})}))
+    (tmp_path / 'bucket-b.json').write_text(json.dumps({'Version': '2012-10-17', 'Statement': [
+        restrict_region.generate_ip_address_policy('bucket-b', ['15.230.56.104/31', '2600:1f19:8000::/36'])]}))
+    renderer = PolicyRenderer(load_index(ip_ranges_path), current_policies=str(tmp_path))
+
+    changed, unchanged, new = render(renderer, ['bucket-a,us-east-1', 'bucket-b,us-east-1', 'bucket-c,us-east-1'],
+                                     diff=True)
+
+    assert changed['summary'] == 'changed DenyGetObjectForNonMatchingIp'
+    assert changed['changed_statements'][0]['desired']['Condition']['NotIpAddress']['aws:SourceIp'] == \
+        ['15.230.56.104/31', '2600:1f19:8000::/36']
+    assert not changed['added'] and not changed['removed']
+    assert unchanged == {'bucket': 'bucket-b', 'region': 'us-east-1', 'changed': False, 'summary': 'no changes',
+                         'added': [], 'removed': [], 'changed_statements': []}
+    assert new['summary'] == 'added DenyGetObjectForNonMatchingIp'
+
+
+def test_render__errors_do_not_stop_the_manifest(renderer):
+    rendered = render(renderer, ['bucket-a,us-east-1', 'bucket-b', 'bucket-c,mars-north-1', 'bucket-d,eu-west-2'])
+
+    assert [document.get('bucket') for document in rendered] == ['bucket-a', None, None, 'bucket-d']
+    assert rendered[1] == {'line': 2, 'error': 'expected bucket,region'}
+    assert rendered[2] == {'line': 3, 'error': 'the feed has no AMAZON prefixes in mars-north-1'}
+
+
+def test_render__streams_the_manifest(mocker: MockerFixture, renderer):
+    aggregate_prefixes = mocker.patch('restrict_download_region.render.aggregate_prefixes',
+                                      side_effect=restrict_region.aggregate_prefixes)
+    regions = itertools.cycle(['us-east-1', 'eu-west-2'])
+    endless_manifest = ('bucket-%d,%s\n' % (i, next(regions)) for i in itertools.count())
+
+    # an endless manifest is rendered line by line
+    rendered = list(itertools.islice(renderer.render_lines(endless_manifest), 1000))
+
+    assert rendered[-1]['bucket'] == 'bucket-999'
+    # every region's prefixes are aggregated once
+    assert aggregate_prefixes.call_count == 2
+
+
+def test_main(ip_ranges_path, tmp_path, capsys):
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text('bucket-a,us-east-1\nbucket-b,eu-west-2\n')
+
+    assert main(['--ip-ranges', ip_ranges_path, str(manifest)]) == 0
+
+    out, _ = capsys.readouterr()
+    assert [json.loads(line)['bucket'] for line in out.splitlines()] == ['bucket-a', 'bucket-b']
+
+
+def test_main__reports_errors(ip_ranges_path, mocker: MockerFixture, capsys):
+    mocker.patch.object(sys, 'stdin', io.StringIO('bucket-a,us-east-1\nnot-a-line\n'))
+
+    assert main(['--ip-ranges', ip_ranges_path, '--diff']) == 1
+
+    out, err = capsys.readouterr()
+    assert len(out.splitlines()) == 2
+    assert err == '1 manifest lines could not be rendered\n'
+
+
+def test_python_m(ip_ranges_path):
+    root = os.path.join(os.path.dirname(__file__), '..', '..')
+
+    completed = subprocess.run([sys.executable, '-m', 'restrict_download_region', '--ip-ranges', ip_ranges_path],
+                               input='bucket-a,eu-west-2\n', capture_output=True, text=True, cwd=root, timeout=60)
+
+    assert completed.returncode == 0, completed.stderr
+    assert json.loads(completed.stdout)['policy']['Statement'][0]['Resource'] == 'arn:aws:s3:::bucket-a/*'
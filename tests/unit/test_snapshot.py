@@ -0,0 +1,106 @@
+from restrict_download_region.cidr import aggregate_prefixes, fingerprint_prefixes
+from restrict_download_region.ip_ranges import RegionIndex
+from restrict_download_region.publisher import (LocalPrefixStore, RegionArtifact, artifact_key,
+                                                read_region_artifact)
+from restrict_download_region.snapshot import HEADER, Snapshot, load_snapshot, pack_snapshot, write_snapshot
+import json
+import pkg_resources
+import pytest
+
+
+@pytest.fixture
+def region_prefixes():
+    with open(pkg_resources.resource_filename(__name__, 'sample_ip_ranges.json'), 'rb') as f:
+        index = RegionIndex.from_document(json.load(f))
+    return aggregate_prefixes(index.prefixes('us-east-1', service=None))
+
+
+def test_round_trip(region_prefixes):
+    snapshot = Snapshot(pack_snapshot(region_prefixes, '1640995200'))
+
+    assert snapshot.prefixes() == region_prefixes
+    assert len(snapshot) == len(region_prefixes)
+    assert snapshot.sync_token == '1640995200'
+    assert snapshot.fingerprint == fingerprint_prefixes(region_prefixes)
+
+
+def test_round_trip_keeps_order_within_each_version():
+    prefixes = ['10.0.0.0/8', '2600:1f18::/33', '0.0.0.0/0', '192.168.1.128/25', '::/0',
+                '2a05:d07a:a000::/40', '255.255.255.255/32', 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128']
+
+    snapshot = Snapshot(pack_snapshot(prefixes))
+
+    assert snapshot.prefixes() == ['10.0.0.0/8', '0.0.0.0/0', '192.168.1.128/25', '255.255.255.255/32',
+                                   '2600:1f18::/33', '::/0', '2a05:d07a:a000::/40',
+                                   'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128']
+    assert snapshot.sync_token is None
+
+
+def test_empty():
+    snapshot = Snapshot(pack_snapshot([], fingerprint=False))
+
+    assert snapshot.prefixes() == []
+    assert snapshot.fingerprint is None
+    assert snapshot.size == HEADER.size
+
+
+def test_load_snapshot_maps_file(tmp_path, region_prefixes):
+    path = str(tmp_path / 'us-east-1.snapshot')
+    write_snapshot(path, region_prefixes, '1640995200')
+
+    snapshot = load_snapshot(path)
+
+    assert snapshot.prefixes() == region_prefixes
+    assert list(snapshot.ipv4_networks())[0] == (int.from_bytes(bytes(
+        int(octet) for octet in region_prefixes[0].split('/')[0].split('.')), 'big'),
+        int(region_prefixes[0].split('/')[1]))
+
+
+def test_smaller_than_json():
+    prefixes = ['3.%d.%d.0/24' % (i // 256, i % 256) for i in range(0, 2000, 2)] + \
+        ['2600:1f18:%x::/48' % i for i in range(0, 2000, 2)]
+    artifact = RegionArtifact('us-east-1', 'AMAZON', '1640995200', fingerprint_prefixes(prefixes), prefixes)
+
+    assert len(artifact.to_snapshot()) < len(artifact.to_json()) * 2 / 3
+
+
+@pytest.mark.parametrize('corrupt', [
+    lambda data: data[:-1],
+    lambda data: data + b'\0',
+    lambda data: data[:HEADER.size - 1],
+    lambda data: b'XXXX' + data[4:],
+    lambda data: data[:4] + b'\x02\x00' + data[6:],
+    lambda data: data[:-1] + bytes([data[-1] ^ 1]),
+])
+def test_corrupt_snapshot(corrupt, region_prefixes):
+    with pytest.raises(ValueError):
+        Snapshot(corrupt(pack_snapshot(region_prefixes)))
+
+
+def test_pack_rejects_host_bits():
+    with pytest.raises(ValueError):
+        pack_snapshot(['10.0.0.1/8'])
+
+
+def test_pack_rejects_long_sync_token():
+    with pytest.raises(ValueError):
+        pack_snapshot(['10.0.0.0/8'], 'x' * 33)
+
+
+def test_read_region_artifact_prefers_snapshot(tmp_path, region_prefixes):
+    store = LocalPrefixStore(str(tmp_path))
+    artifact = RegionArtifact('us-east-1', 'AMAZON', '1640995200', fingerprint_prefixes(region_prefixes),
+                              region_prefixes)
+    store.put(artifact_key('us-east-1', 'AMAZON', 'snapshot'), artifact.to_snapshot())
+    # a stale json artifact must not be read while the snapshot exists
+    store.put(artifact_key('us-east-1'), artifact._replace(sync_token='1').to_json())
+
+    assert read_region_artifact(store, 'us-east-1') == artifact
+
+
+def test_read_region_artifact_rejects_snapshot_without_fingerprint(tmp_path, region_prefixes):
+    store = LocalPrefixStore(str(tmp_path))
+    store.put(artifact_key('us-east-1', 'AMAZON', 'snapshot'), pack_snapshot(region_prefixes, fingerprint=False))
+
+    with pytest.raises(ValueError):
+        read_region_artifact(store, 'us-east-1')
@@ -0,0 +1,269 @@
+from restrict_download_region.fanout import UPDATED, apply_to_buckets
+from restrict_download_region.metrics import Metrics, MemorySink
+from restrict_download_region.throttle import (AdaptiveConcurrency, ThrottleController, TokenBucket,
+                                               is_throttling_error, is_transient_error)
+import restrict_download_region.restrict_region as restrict_region
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from pytest_mock import MockerFixture
+import boto3
+import json
+import threading
+import time
+import pytest
+
+
+def client_error(code, status=400, operation='PutBucketPolicy'):
+    return ClientError({'Error': {'Code': code, 'Message': ''}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                       operation)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def sink():
+    return MemorySink()
+
+
+def controller(max_attempts=5, maximum=8, sleep=None, rate=0):
+    return ThrottleController(TokenBucket(rate), AdaptiveConcurrency(maximum), max_attempts,
+                              base_delay=0.1, max_delay=0.3, sleep=sleep or (lambda seconds: None))
+
+
+@pytest.mark.parametrize("error, throttling", [
+    (client_error('SlowDown', 503), True),
+    (client_error('Throttling'), True),
+    (client_error('TooManyRequestsException', 429), True),
+    (client_error('InternalError', 503), True),
+    (client_error('AccessDenied', 403), False),
+    (client_error('NoSuchBucketPolicy', 404), False),
+    (ValueError("not a client error"), False)])
+def test_is_throttling_error(error, throttling):
+    assert is_throttling_error(error) == throttling
+
+
+@pytest.mark.parametrize("error, transient", [
+    (ReadTimeoutError(endpoint_url='https://my-bucket.s3.amazonaws.com'), True),
+    (ConnectTimeoutError(endpoint_url='https://my-bucket.s3.amazonaws.com'), True),
+    (EndpointConnectionError(endpoint_url='https://my-bucket.s3.amazonaws.com'), True),
+    (client_error('InternalError', 500), True),
+    (client_error('BadGateway', 502), True),
+    (client_error('AccessDenied', 403), False),
+    (client_error('MalformedPolicy', 400), False),
+    (ValueError("not a client error"), False)])
+def test_is_transient_error(error, transient):
+    assert is_transient_error(error) == transient
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock, sleep=clock.sleep)
+
+    # the burst is free, then the calls are spaced at the rate
+    assert [bucket.acquire() for _ in range(5)] == [0, 0, 0, 0.5, 0.5]
+    clock.now += 10
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_token_bucket__unlimited():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=0, clock=clock, sleep=clock.sleep)
+
+    assert sum(bucket.acquire() for _ in range(1000)) == 0
+    assert not clock.sleeps
+
+
+def test_adaptive_concurrency():
+    concurrency = AdaptiveConcurrency(8)
+    generation = 0
+
+    concurrency.throttled(generation)
+    # calls that started before the decrease don't lower the limit again
+    concurrency.throttled(generation)
+    assert concurrency.limit == 4
+    concurrency.throttled(generation + 1)
+    concurrency.throttled(generation + 2)
+    concurrency.throttled(generation + 3)
+    assert concurrency.limit == 1
+
+    for _ in range(1 + 2 + 3):
+        concurrency.succeeded()
+    assert concurrency.limit == 4
+
+
+def test_adaptive_concurrency__slot_waits_for_limit():
+    concurrency = AdaptiveConcurrency(2)
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+
+    def call():
+        with concurrency.slot():
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+
+
+def test_throttle_controller__retries_throttled_calls(mocker: MockerFixture, sink):
+    operation = mocker.Mock(side_effect=[client_error('SlowDown', 503), client_error('SlowDown', 503), 'done'])
+    sleep = mocker.Mock()
+    throttle = controller(sleep=sleep)
+
+    with Metrics('Test', sink).phase('put_bucket_policy') as phase:
+        assert throttle.call(phase, operation, Bucket='my-bucket') == 'done'
+
+    operation.assert_called_with(Bucket='my-bucket')
+    delays = [call.args[0] for call in sleep.call_args_list]
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 0.1 and 0 <= delays[1] <= 0.2
+    document = sink.phases('put_bucket_policy')[0]
+    assert document['Retries'] == 2
+    assert document['ThrottleWait'] == pytest.approx(sum(delays) * 1000)
+    assert document['Concurrency'] == 2
+
+
+def test_throttle_controller__gives_up(mocker: MockerFixture, sink):
+    operation = mocker.Mock(side_effect=client_error('SlowDown', 503))
+    sleep = mocker.Mock()
+
+    with pytest.raises(ClientError):
+        with Metrics('Test', sink).phase('put_bucket_policy') as phase:
+            controller(max_attempts=3, sleep=sleep).call(phase, operation)
+
+    assert operation.call_count == 3
+    # backoff is capped
+    assert all(0 <= call.args[0] <= 0.3 for call in sleep.call_args_list)
+    assert sink.phases('put_bucket_policy')[0]['Retries'] == 2
+
+
+def test_throttle_controller__other_errors_are_not_retried(mocker: MockerFixture):
+    operation = mocker.Mock(side_effect=client_error('AccessDenied', 403))
+    sleep = mocker.Mock()
+
+    with pytest.raises(ClientError):
+        controller(sleep=sleep).call(restrict_region.metrics.phase('put_bucket_policy'), operation)
+
+    assert operation.call_count == 1
+    assert not sleep.called
+
+
+def test_throttle_controller__retries_transient_errors_without_lowering_concurrency(mocker: MockerFixture, sink):
+    operation = mocker.Mock(side_effect=[ReadTimeoutError(endpoint_url='https://my-bucket.s3.amazonaws.com'),
+                                         client_error('InternalError', 500), 'done'])
+    throttle = controller()
+
+    with Metrics('Test', sink).phase('get_bucket_policy') as phase:
+        assert throttle.call(phase, operation) == 'done'
+
+    assert operation.call_count == 3
+    assert throttle.concurrency.limit == 8
+    assert sink.phases('get_bucket_policy')[0]['Retries'] == 2
+
+
+def test_throttle_controller__without_phase(mocker: MockerFixture):
+    operation = mocker.Mock(side_effect=[client_error('SlowDown', 503), 'done'])
+
+    assert controller().call(None, operation, Bucket='my-bucket') == 'done'
+    assert operation.call_count == 2
+
+
+def test_discovery_and_prefix_store_are_paced_and_retried(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(restrict_region, 's3_throttle', controller())
+    mocker.patch.object(restrict_region, 'BUCKET_TAG', 'restrict-region=true')
+    mocker.patch.object(restrict_region, 'AWS_REGION', 'us-east-1')
+    mocker.patch.object(restrict_region, 'PREFIX_STORE_BUCKET', 'prefixes')
+    mock_s3 = mocker.MagicMock(spec=boto3.client('s3', region_name='us-east-1'))
+    timeout = ReadTimeoutError(endpoint_url='https://s3.amazonaws.com')
+    mock_s3.list_buckets.side_effect = [client_error('SlowDown', 503, 'ListBuckets'), {'Buckets': [{'Name': 'a'}]}]
+    mock_s3.get_bucket_location.side_effect = [timeout, {'LocationConstraint': None}]
+    mock_s3.get_bucket_tagging.side_effect = [client_error('InternalError', 500, 'GetBucketTagging'),
+                                              {'TagSet': [{'Key': 'restrict-region', 'Value': 'true'}]}]
+    mock_s3.get_object.side_effect = [timeout, {'Body': mocker.Mock(read=lambda: b'{}')}]
+    mocker.patch.dict(restrict_region._clients, {'s3': mock_s3})
+
+    assert restrict_region.discover_buckets(mock_s3) == (['a'], {})
+    assert restrict_region.get_prefix_store().get('manifest.json') == b'{}'
+
+
+def test_get_bucket_policy__retries_slow_down(mocker: MockerFixture):
+    mocker.patch.object(restrict_region, 's3_throttle', controller())
+    mock_s3 = mocker.MagicMock(spec=boto3.client('s3'))
+    policy = {"Version": "2012-10-17", "Statement": []}
+    mock_s3.get_bucket_policy.side_effect = [client_error('SlowDown', 503, 'GetBucketPolicy'),
+                                             {'Policy': json.dumps(policy)}]
+
+    assert restrict_region.get_bucket_policy(mock_s3, 'my-bucket') == policy
+    assert mock_s3.get_bucket_policy.call_count == 2
+
+
+class ThrottlingS3:
+    """
+    Throttles every call made while more than capacity calls are in flight
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.throttled = 0
+        self.policies = {}
+        self._lock = threading.Lock()
+
+    def _call(self, action):
+        with self._lock:
+            self.in_flight += 1
+            overloaded = self.in_flight > self.capacity
+            if overloaded:
+                self.throttled += 1
+        try:
+            time.sleep(0.002)
+            if overloaded:
+                raise client_error('SlowDown', 503)
+            return action()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def get_bucket_policy(self, Bucket):
+        return self._call(lambda: {'Policy': json.dumps({"Version": "2012-10-17", "Statement": []})})
+
+    def put_bucket_policy(self, Bucket, Policy):
+        return self._call(lambda: self.policies.__setitem__(Bucket, Policy))
+
+
+def test_multi_bucket_adapts_concurrency(mocker: MockerFixture):
+    throttle = ThrottleController(TokenBucket(0), AdaptiveConcurrency(16), max_attempts=20,
+                                  base_delay=0.002, max_delay=0.02)
+    mocker.patch.object(restrict_region, 's3_throttle', throttle)
+    s3 = ThrottlingS3(capacity=3)
+    bucket_names = ['bucket-%d' % index for index in range(64)]
+
+    results = apply_to_buckets(
+        bucket_names,
+        lambda bucket_name: restrict_region.restrict_bucket(s3, bucket_name, None, ['15.230.56.104/31']),
+        max_workers=16)
+
+    assert {result.status for result in results.values()} == {UPDATED}
+    assert sorted(s3.policies) == sorted(bucket_names)
+    assert s3.throttled
+    # the limit came down from the 16 workers towards what S3 accepts
+    assert throttle.concurrency.limit < 16
@@ -27,7 +27,13 @@ def test_get_bucket_policy__has_statement(mocker: MockerFixture):
     # function under test
     restrict_region.update_bucket_policy(mock_s3, "foobar", policy)
 
-    mock_s3.put_bucket_policy.assert_called_once_with(Bucket="foobar", Policy=json.dumps(policy))
+    # compact, with sorted keys and condition values
+    mock_s3.put_bucket_policy.assert_called_once_with(Bucket="foobar", Policy=(
+        '{"Statement":[{"Action":["s3:PutObject","s3:PutObjectAcl"],'
+        '"Condition":{"StringEquals":{"s3:x-amz-acl":["public-read"]}},"Effect":"Allow",'
+        '"Principal":{"AWS":["arn:aws:iam::111122223333:root","arn:aws:iam::444455556666:root"]},'
+        '"Resource":"arn:aws:s3:::DOC-EXAMPLE-BUCKET/*","Sid":"AddCannedAcl"}],"Version":"2012-10-17"}'))
+    assert json.loads(mock_s3.put_bucket_policy.call_args.kwargs['Policy']) == policy
     assert not mock_s3.delete_bucket_policy.called
 
 
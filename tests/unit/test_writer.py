@@ -0,0 +1,146 @@
+from restrict_download_region.writer import PolicyConflictError, write_policy
+import restrict_download_region.restrict_region as restrict_region
+from tests.unit.local_s3 import LocalS3
+from concurrent.futures import ThreadPoolExecutor
+from pytest_mock import MockerFixture
+import pytest
+
+
+def statement(sid):
+    return {'Sid': sid, 'Effect': 'Allow', 'Principal': {'AWS': '111122223333'}, 'Action': 's3:GetObject',
+            'Resource': 'arn:aws:s3:::my-bucket/%s/*' % sid}
+
+
+def add_statement(sid):
+    def merge(policy):
+        if any(existing.get('Sid') == sid for existing in policy['Statement']):
+            return False
+        policy['Statement'].append(statement(sid))
+        return True
+    return merge
+
+
+def empty_policy():
+    return {'Version': '2012-10-17', 'Statement': []}
+
+
+def test_write_policy__verifies_write(mocker: MockerFixture):
+    read = mocker.Mock(side_effect=[empty_policy(), {'Version': '2012-10-17', 'Statement': [statement('a')]}])
+    write = mocker.Mock()
+
+    assert write_policy(read, add_statement('a'), write, empty_policy())
+
+    write.assert_called_once_with({'Version': '2012-10-17', 'Statement': [statement('a')]})
+    # once right before and once after writing
+    assert read.call_count == 2
+
+
+def test_write_policy__unchanged(mocker: MockerFixture):
+    read = mocker.Mock()
+    write = mocker.Mock()
+
+    assert not write_policy(read, add_statement('a'), write, {'Version': '2012-10-17', 'Statement': [statement('a')]})
+
+    assert not read.called
+    assert not write.called
+
+
+def test_write_policy__changed_before_write_is_merged_again(mocker: MockerFixture):
+    edited = {'Version': '2012-10-17', 'Statement': [statement('b')]}
+    read = mocker.Mock(side_effect=[edited, edited, {'Version': '2012-10-17', 'Statement': [statement('b'),
+                                                                                           statement('a')]}])
+    write = mocker.Mock()
+    sleep = mocker.Mock()
+
+    assert write_policy(read, add_statement('a'), write, empty_policy(), sleep=sleep)
+
+    # the policy that was read before writing is the base of the second attempt
+    write.assert_called_once_with({'Version': '2012-10-17', 'Statement': [statement('b'), statement('a')]})
+    assert read.call_count == 3
+    assert 0 <= sleep.call_args.args[0] <= 0.2
+
+
+def test_write_policy__overwritten_after_write_is_written_again(mocker: MockerFixture):
+    overwritten = {'Version': '2012-10-17', 'Statement': [statement('b')]}
+    merged = {'Version': '2012-10-17', 'Statement': [statement('b'), statement('a')]}
+    read = mocker.Mock(side_effect=[empty_policy(), overwritten, overwritten, overwritten, merged])
+    write = mocker.Mock()
+
+    assert write_policy(read, add_statement('a'), write, empty_policy(), sleep=mocker.Mock())
+
+    assert [call.args[0] for call in write.call_args_list] == [
+        {'Version': '2012-10-17', 'Statement': [statement('a')]}, merged]
+
+
+def test_write_policy__settle_catches_late_overwrite(mocker: MockerFixture):
+    written = {'Version': '2012-10-17', 'Statement': [statement('a')]}
+    read = mocker.Mock(side_effect=[empty_policy(), written, empty_policy(), empty_policy(), empty_policy(),
+                                    written, written])
+    write = mocker.Mock()
+    sleep = mocker.Mock()
+
+    assert write_policy(read, add_statement('a'), write, empty_policy(), settle=0.5, sleep=sleep)
+
+    assert write.call_count == 2
+    assert sleep.call_args_list[0].args == (0.5,)
+
+
+def test_write_policy__gives_up(mocker: MockerFixture):
+    policies = iter(range(100))
+
+    def read():
+        # another writer changes the policy all the time
+        return {'Version': '2012-10-17', 'Statement': [statement('other-%d' % next(policies))]}
+    write = mocker.Mock()
+    sleep = mocker.Mock()
+
+    with pytest.raises(PolicyConflictError):
+        write_policy(read, add_statement('a'), write, attempts=3, backoff=1, max_backoff=1.5, sleep=sleep)
+
+    assert not write.called
+    # jittered, exponentially growing and capped, but not after the last attempt
+    delays = [call.args[0] for call in sleep.call_args_list]
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 1 and 0 <= delays[1] <= 1.5
+
+
+def test_apply_ip_restrict_policy__verified_write(mocker: MockerFixture):
+    mocker.patch.object(restrict_region, 'VERIFY_POLICY_WRITES', True)
+    s3 = LocalS3(latency=0)
+
+    assert restrict_region.apply_ip_restrict_policy(s3, 'my-bucket', None, empty_policy(), ['15.230.56.104/31'])
+    assert not restrict_region.apply_ip_restrict_policy(s3, 'my-bucket', None,
+                                                        restrict_region.get_bucket_policy(s3, 'my-bucket'),
+                                                        ['15.230.56.104/31'])
+    assert restrict_region.apply_ip_restrict_policy(s3, 'my-bucket', 'Delete',
+                                                    restrict_region.get_bucket_policy(s3, 'my-bucket'), None)
+
+    assert s3.policies == {}
+    assert s3.puts == 1
+
+
+def test_concurrent_writers_lose_no_statements(mocker: MockerFixture):
+    mocker.patch.object(restrict_region, 'VERIFY_POLICY_WRITES', True)
+    mocker.patch.object(restrict_region, 'POLICY_WRITE_ATTEMPTS', 50)
+    mocker.patch.object(restrict_region, 'POLICY_WRITE_SETTLE_MS', 20)
+    s3 = LocalS3()
+    bucket_name = 'my-bucket'
+    other_sids = ['Automation%d' % index for index in range(16)]
+
+    def other_automation(sid):
+        return write_policy(lambda: restrict_region.get_bucket_policy(s3, bucket_name), add_statement(sid),
+                            lambda policy: restrict_region.update_bucket_policy(s3, bucket_name, policy),
+                            attempts=50, backoff=0.005, max_backoff=0.05, settle=0.02)
+
+    def restrict():
+        return restrict_region.restrict_bucket(s3, bucket_name, None, ['15.230.56.104/31', '2600:1f19:8000::/36'])
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        futures = [executor.submit(other_automation, sid) for sid in other_sids] + \
+            [executor.submit(restrict) for _ in range(4)]
+        for future in futures:
+            future.result()
+
+    statements = restrict_region.get_bucket_policy(s3, bucket_name)['Statement']
+    assert sorted(statement['Sid'] for statement in statements) == sorted(
+        other_sids + [restrict_region.POLICY_STATEMENT_ID])